@@ -74,6 +74,12 @@ from flask_cache import Cache
 # register the cache instance and binds it on to your app
 app.cache = Cache(app)
 
+# the base schedule store is useless with a cache that is not shared between the processes (see kirin.base_schedule)
+if app.config['BASE_SCHEDULE_STORE_TIMEOUT'] and app.config['CACHE_TYPE'] in ('simple', 'null'):
+    logging.getLogger(__name__).warning('the base schedule store needs a shared CACHE_TYPE (like redis), '
+                                        'it is disabled with CACHE_TYPE %s', app.config['CACHE_TYPE'])
+    app.config['BASE_SCHEDULE_STORE_TIMEOUT'] = 0
+
 manager = Manager(app)
 
 from redis import Redis
@@ -98,6 +104,18 @@ logger.info('Configs: %s', app.config)
 
 
 rabbitmq_handler = RabbitMQHandler(app.config['RABBITMQ_CONNECTION_STRING'],
-                                   app.config['EXCHANGE'])
+                                   app.config['EXCHANGE'],
+                                   app.config['RABBITMQ_CONFIRM_BATCH_SIZE'])
+
+# the differential feeds are coalesced before their publication only if a max delay is configured
+feed_coalescer = None
+if app.config['PUBLISH_COALESCING_MAX_DELAY']:
+    import atexit
+    from kirin.core.handler import publish
+    from kirin.feed_coalescer import FeedCoalescer
+    feed_coalescer = FeedCoalescer(publish,
+                                   app.config['PUBLISH_COALESCING_MAX_DELAY'],
+                                   app.config['PUBLISH_COALESCING_MAX_SIZE'])
+    atexit.register(feed_coalescer.flush_all)
 
 import kirin.api
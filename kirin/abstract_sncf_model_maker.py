@@ -32,13 +32,12 @@ from __future__ import absolute_import, print_function, division
 import logging
 from datetime import timedelta
 
-import jmespath
-
-from kirin.utils import record_internal_failure
+from kirin.utils import record_internal_failure, navitia_concurrent_map
 from kirin.exceptions import ObjectNotFound
 from abc import ABCMeta
 import six
 from kirin.core import model
+from kirin import base_schedule
 
 
 def to_navitia_str(dt):
@@ -76,13 +75,10 @@ def headsigns(str):
     return [signs[0], alternative_headsign]
 
 
-def get_navitia_stop_time_sncf(cr, ci, ch, nav_vj):
+def get_navitia_stop_time_sncf(cr, ci, ch, vj):
     nav_external_code = "{cr}-{ci}-{ch}".format(cr=cr, ci=ci, ch=ch)
 
-    nav_stop_times = jmespath.search(
-        'stop_times[? stop_point.stop_area.codes[? value==`{nav_ext_code}` && type==`CR-CI-CH`]]'.format(
-            nav_ext_code=nav_external_code),
-        nav_vj)
+    nav_stop_times = vj.get_stop_times_by_stop_area_code('CR-CI-CH').get(nav_external_code)
 
     log_dict = None
     if not nav_stop_times:
@@ -100,6 +96,16 @@ class AbstractSNCFKirinModelBuilder(six.with_metaclass(ABCMeta, object)):
     def __init__(self, nav, contributor=None):
         self.navitia = nav
         self.contributor = contributor
+        # read once by build, not by lookup in the base schedule store
+        self.instance_data_pub_date = base_schedule.get_publication_date(nav)
+
+    @staticmethod
+    def parse(raw_data):
+        """
+        parse the received raw data, the parsed data can then be given to build
+        by default the raw data is given as it is to build
+        """
+        return raw_data
 
     def _get_navitia_vjs(self, headsign_str, since_dt, until_dt):
         """
@@ -118,17 +124,16 @@ class AbstractSNCFKirinModelBuilder(six.with_metaclass(ABCMeta, object)):
         # but most of the time (if not always) they refer to the same VJ
         # (the VJ switches headsign along the way).
         # So we do one VJ search for each headsign to ensure we get it, then deduplicate VJs
-        for train_number in headsigns(headsign_str):
-
+        def search_vjs(train_number):
             log.debug('searching for vj {} on {} in navitia'.format(train_number, since_dt))
 
-            navitia_vjs = self.navitia.vehicle_journeys(q={
+            navitia_vjs = base_schedule.get_vjs(self.navitia, 'headsign', train_number, q={
                 'headsign': train_number,
                 'since': to_navitia_str(extended_since_dt),
                 'until': to_navitia_str(extended_until_dt),
                 'depth': '2',  # we need this depth to get the stoptime's stop_area
                 'show_codes': 'true'  # we need the stop_points CRCICH codes
-            })
+            }, pub_date=self.instance_data_pub_date)
 
             if not navitia_vjs:
                 logging.getLogger(__name__).info('impossible to find train {t} on [{s}, {u}['
@@ -136,7 +141,10 @@ class AbstractSNCFKirinModelBuilder(six.with_metaclass(ABCMeta, object)):
                                                          s=extended_since_dt,
                                                          u=extended_until_dt))
                 record_internal_failure('missing train', contributor=self.contributor)
+            return navitia_vjs
 
+        # the headsigns are searched concurrently
+        for navitia_vjs in navitia_concurrent_map(self.navitia, search_vjs, headsigns(headsign_str)):
             for nav_vj in navitia_vjs:
                 vj = model.VehicleJourney(nav_vj, since_dt.date())
                 vjs[nav_vj['id']] = vj
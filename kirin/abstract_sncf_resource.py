@@ -30,7 +30,7 @@ from flask_restful import Resource
 
 import logging
 from datetime import datetime
-from kirin.utils import make_rt_update, record_call
+from kirin.utils import make_rt_update, record_call, manage_db_identical
 from kirin.exceptions import KirinException
 from kirin import core
 from kirin.core import model
@@ -46,15 +46,20 @@ class AbstractSNCFResource(Resource):
 
     def process_post(self, input_raw, contributor_type, is_new_complete=False):
 
-        # create a raw ire obj, save the raw_input into the db
+        # an identical payload has already been handled, there is nothing new to parse nor to publish
+        if manage_db_identical(input_raw, contributor_type, self.contributor):
+            record_call('Identical feed skipped', contributor=self.contributor)
+            logging.getLogger(__name__).info('identical feed skipped', extra={'contributor': self.contributor})
+            return 'OK', 200
+
+        # create a raw ire obj, save the raw_input into the db (as received, assuming UTF-8 encoding for all input)
         rt_update = make_rt_update(input_raw, contributor_type, contributor=self.contributor)
         start_datetime = datetime.utcnow()
         try:
-            # assuming UTF-8 encoding for all input
-            rt_update.raw_data = rt_update.raw_data.encode('utf-8')
-
-            # raw_input is interpreted
-            trip_updates = self.builder(self.navitia_wrapper, self.contributor).build(rt_update)
+            # raw_input is parsed only once and interpreted
+            # (the raw_data of rt_update is not used, it would be loaded again from the db)
+            builder = self.builder(self.navitia_wrapper, self.contributor)
+            trip_updates = builder.build(rt_update, data=builder.parse(input_raw))
             record_call('OK', contributor=self.contributor)
         except KirinException as e:
             rt_update.status = 'KO'
@@ -0,0 +1,227 @@
+# coding=utf-8
+
+# Copyright (c) 2001-2018, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+"""
+Kirin-side store of the base schedule vehicle journeys found in navitia
+
+The navitia vjs are stored (in the flask cache) as compact records, with only what kirin needs:
+the ids and codes of the vj and of its stop points, the codes (like CR-CI-CH) of the stop areas,
+the times and the timezones.
+They are indexed by headsign or source code (see INDEXES) and by the navitia query (and thus its period),
+for the current publication of the navitia instance: the records of a previous publication
+are never read again (and expire), so they do not need any TTL shorter than the publication's life.
+
+The lookups missing in the store are also kept in redis until the end of their period, to search them again
+after a new publication or a restart (see warm_up).
+
+The store is only useful with a flask cache shared between the processes (like redis): with a per-process cache,
+a record would only be found again by the process that stored it, and the warm up would only fill the cache of the
+celery worker running it. So the store is disabled at startup when the CACHE_TYPE is 'simple' or 'null'.
+"""
+import calendar
+import datetime
+import json
+import logging
+import time
+
+from kirin import app, redis
+from kirin.utils import navitia_concurrent_map
+
+INDEXES = ('headsign', 'source')
+
+
+def _compact_stop_area(stop_area):
+    return {k: stop_area[k] for k in ('id', 'codes', 'timezone') if k in stop_area}
+
+
+def _compact_stop_point(stop_point):
+    res = {k: stop_point[k] for k in ('id', 'codes') if k in stop_point}
+    if 'stop_area' in stop_point:
+        res['stop_area'] = _compact_stop_area(stop_point['stop_area'])
+    return res
+
+
+def _compact_stop_time(stop_time):
+    res = {k: stop_time[k] for k in ('arrival_time', 'departure_time') if k in stop_time}
+    if 'stop_point' in stop_time:
+        res['stop_point'] = _compact_stop_point(stop_time['stop_point'])
+    return res
+
+
+def compact_vj(nav_vj):
+    """
+    the record of a navitia vj, with the same structure but only the fields used by kirin
+    """
+    res = {k: nav_vj[k] for k in ('id', 'codes') if k in nav_vj}
+    if 'trip' in nav_vj:
+        res['trip'] = {k: nav_vj['trip'][k] for k in ('id',) if k in nav_vj['trip']}
+    res['stop_times'] = [_compact_stop_time(st) for st in nav_vj.get('stop_times', [])]
+    return res
+
+
+def _key(navitia, index, code, q, pub_date=None):
+    if pub_date is None:
+        pub_date = navitia.get_publication_date()
+    if not pub_date:
+        return None
+    query = '&'.join('{}={}'.format(k, v) for k, v in sorted(q.items()))
+    return 'base_schedule|{}|{}|{}|{}|{}'.format(navitia.url, pub_date, index, code, query)
+
+
+def _lookups_key(navitia):
+    return 'base_schedule.lookups|{}'.format(navitia.url)
+
+
+def _warm_key(navitia, pub_date):
+    return 'base_schedule.warm|{}|{}'.format(navitia.url, pub_date)
+
+
+def _period_end(q):
+    """
+    the end of the searched period, as a posix timestamp
+    the navitia datetimes are '%Y%m%dT%H%M%S' followed by 'Z', a utc offset or nothing (considered as UTC)
+    """
+    until = q['until']
+    dt = datetime.datetime.strptime(until[:15], '%Y%m%dT%H%M%S')
+    offset = until[15:]
+    if len(offset) == 5:
+        sign = -1 if offset[0] == '-' else 1
+        dt -= sign * datetime.timedelta(hours=int(offset[1:3]), minutes=int(offset[3:5]))
+    return calendar.timegm(dt.utctimetuple())
+
+
+def _is_enabled():
+    return bool(app.config.get('BASE_SCHEDULE_STORE_TIMEOUT'))
+
+
+def get_publication_date(navitia):
+    """
+    the publication date of the navitia instance, that keys the store (None if the store is disabled)
+
+    it is a navitia call: it should be read once by build and given to the lookups
+    """
+    if not _is_enabled():
+        return None
+    return navitia.get_publication_date()
+
+
+def _record_lookup(navitia, index, code, q):
+    """
+    keep the lookups (until the end of their period) to search them again after a new publication
+    """
+    member = json.dumps([index, code, q], sort_keys=True)
+    try:
+        redis.zadd(_lookups_key(navitia), **{member: _period_end(q)})
+    except Exception:
+        logging.getLogger(__name__).exception('impossible to record the lookup of {}'.format(code))
+
+
+def get_stored_vjs(navitia, index, code, q, pub_date=None):
+    """
+    return the stored records of the vjs of code found with the navitia query q, None if they are not in the store
+    (the publication date is asked to navitia if it is not given)
+    """
+    if not _is_enabled():
+        return None
+    key = _key(navitia, index, code, q, pub_date)
+    if key is None:
+        return None
+    return app.cache.get(key)
+
+
+def store_vjs(navitia, index, code, q, nav_vjs, pub_date=None):
+    """
+    store the navitia vjs of code found with the navitia query q and return their records
+    (the navitia vjs themselves if the store is disabled)
+    """
+    if not _is_enabled():
+        return nav_vjs
+    records = [compact_vj(v) for v in nav_vjs]
+    key = _key(navitia, index, code, q, pub_date)
+    if key is not None:
+        try:
+            app.cache.set(key, records, timeout=app.config.get('BASE_SCHEDULE_STORE_TIMEOUT'))
+        except Exception:
+            # the store is only an optimization
+            logging.getLogger(__name__).exception('impossible to store the vjs of {}'.format(code))
+    _record_lookup(navitia, index, code, q)
+    return records
+
+
+def get_vjs(navitia, index, code, q, pub_date=None):
+    """
+    return the records of the vjs of code (a headsign or a source code, see index) on the period of
+    the navitia query q
+
+    if they are not in the store, they are searched in navitia with q and stored
+    """
+    assert index in INDEXES
+    if not _is_enabled():
+        return navitia.vehicle_journeys(q=q)
+    records = get_stored_vjs(navitia, index, code, q, pub_date)
+    if records is None:
+        records = store_vjs(navitia, index, code, q, navitia.vehicle_journeys(q=q), pub_date)
+    return records
+
+
+def is_warm(navitia):
+    """
+    the store has been warmed up for the current publication of the navitia instance
+    """
+    return app.cache.get(_warm_key(navitia, navitia.get_publication_date())) is not None
+
+
+def warm_up(navitia):
+    """
+    search again the vjs of the lookups of the active service window (the lookups whose period is not over)
+    that are not in the store (like after a new publication or a restart)
+
+    return the nb of lookups and the nb of them already in the store
+    """
+    logger = logging.getLogger(__name__)
+    pub_date = navitia.get_publication_date()
+    key = _lookups_key(navitia)
+    now = time.time()
+    redis.zremrangebyscore(key, '-inf', now)
+    lookups = [json.loads(m) for m in redis.zrangebyscore(key, now, '+inf')]
+
+    def warm(lookup):
+        index, code, q = lookup
+        if get_stored_vjs(navitia, index, code, q, pub_date) is not None:
+            return True
+        try:
+            store_vjs(navitia, index, code, q, navitia.vehicle_journeys(q=q), pub_date)
+        except Exception:
+            logger.exception('impossible to warm up the vjs of {}'.format(code))
+        return False
+
+    hits = navitia_concurrent_map(navitia, warm, lookups)
+    app.cache.set(_warm_key(navitia, pub_date), True, timeout=app.config.get('BASE_SCHEDULE_STORE_TIMEOUT'))
+    return len(lookups), sum(hits)
@@ -0,0 +1,265 @@
+# coding=utf-8
+
+# Copyright (c) 2001-2018, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+"""
+Bulk persistence of a session holding realtime updates
+
+Instead of letting SQLAlchemy flush the session (one INSERT/UPDATE/DELETE per object, plus one per association row),
+the pending changes are written with a few multi-rows statements (with psycopg2's execute_values):
+    * INSERT ... ON CONFLICT DO UPDATE for vehicle_journey, trip_update and stop_time_update
+    * one DELETE for the stop_time_update removed from their trip_update (delete-orphan cascade)
+    * INSERT ... ON CONFLICT DO NOTHING for the associations between real_time_update and trip_update
+The written objects are then attached again to the session as clean persistent objects, as if they were just
+flushed by the ORM.
+
+Only the changes produced by core.handler.handle are supported, anything else falls back to the usual ORM flush.
+"""
+import datetime
+import logging
+
+from psycopg2.extras import execute_values
+import sqlalchemy
+from sqlalchemy.orm import scoped_session, make_transient, make_transient_to_detached
+from sqlalchemy.orm.attributes import get_history, PASSIVE_NO_INITIALIZE
+
+from kirin.core.model import VehicleJourney, TripUpdate, StopTimeUpdate, RealTimeUpdate, \
+    associate_realtimeupdate_tripupdate
+
+# max nb of rows in a multi-rows statement
+PAGE_SIZE = 1000
+
+
+def commit(session):
+    """
+    write the pending changes of the session in bulk and commit
+    """
+    changes = _collect_changes(session)
+    if changes is None:
+        logging.getLogger(__name__).debug('unsupported changes for bulk persistence, using the ORM flush')
+        session.commit()
+        return
+
+    new_objects, dirty_objects, orphans, associations = changes
+    connection = session.connection()
+    # the raw DBAPI cursor is used (in the transaction of the session), to avoid the compilation
+    # of huge multi-rows statements by SQLAlchemy
+    cursor = connection.connection.cursor()
+
+    _sync_foreign_keys(new_objects + dirty_objects)
+    to_write = new_objects + [o for o in dirty_objects if session.is_modified(o, include_collections=False)]
+
+    # order matters to respect the foreign keys
+    _upsert(cursor, connection.dialect, VehicleJourney, [o for o in to_write if isinstance(o, VehicleJourney)])
+    _insert(cursor, connection.dialect, RealTimeUpdate, [o for o in new_objects if isinstance(o, RealTimeUpdate)])
+    _upsert(cursor, connection.dialect, TripUpdate, [o for o in to_write if isinstance(o, TripUpdate)])
+    _delete(cursor, StopTimeUpdate, orphans)
+    _upsert(cursor, connection.dialect, StopTimeUpdate, [o for o in to_write if isinstance(o, StopTimeUpdate)])
+    _insert_associations(cursor, associations)
+    cursor.close()
+    for rtu in dirty_objects:
+        if isinstance(rtu, RealTimeUpdate):
+            _update_changed_columns(connection, rtu)
+
+    _mark_as_persisted(session, new_objects + dirty_objects, orphans)
+    session.commit()
+
+
+def _collect_changes(session):
+    """
+    return the new and dirty objects of the session, the orphan StopTimeUpdate to delete
+    and the new (real_time_update.id, trip_update.vj_id) associations
+    return None if the changes cannot be handled in bulk
+    """
+    supported_types = (VehicleJourney, TripUpdate, StopTimeUpdate, RealTimeUpdate)
+    if session.deleted:
+        return None
+
+    new_objects = []
+    for obj in session.new:
+        if not isinstance(obj, supported_types):
+            return None
+        # pending orphans are not persisted by the ORM either
+        if isinstance(obj, StopTimeUpdate) and obj.trip_update is None:
+            continue
+        new_objects.append(obj)
+
+    dirty_objects = []
+    for obj in session.dirty:
+        if not isinstance(obj, supported_types):
+            return None
+        dirty_objects.append(obj)
+
+    orphans = []
+    associations = set()
+    # Note: the history of a collection that is not loaded is made of None
+    for obj in new_objects + dirty_objects:
+        if isinstance(obj, TripUpdate):
+            history = get_history(obj, 'stop_time_updates', passive=PASSIVE_NO_INITIALIZE)
+            orphans.extend(st for st in history.deleted or () if sqlalchemy.inspect(st).persistent)
+            history = get_history(obj, 'real_time_updates', passive=PASSIVE_NO_INITIALIZE)
+            if history.deleted:
+                return None
+            associations.update((rtu.id, obj) for rtu in history.added or ())
+        elif isinstance(obj, RealTimeUpdate):
+            history = get_history(obj, 'trip_updates', passive=PASSIVE_NO_INITIALIZE)
+            if history.deleted:
+                return None
+            associations.update((obj.id, tu) for tu in history.added or ())
+
+    # the orphans are dirty too (their trip_update is reset), but they are deleted
+    orphan_set = set(orphans)
+    dirty_objects = [o for o in dirty_objects if o not in orphan_set]
+    return new_objects, dirty_objects, orphans, associations
+
+
+def _sync_foreign_keys(objects):
+    """
+    the foreign keys are usually synchronized with the relationships by the ORM during the flush
+    """
+    for obj in objects:
+        if isinstance(obj, TripUpdate) and obj.vj is not None:
+            obj.vj_id = obj.vj.id
+    for obj in objects:
+        if isinstance(obj, StopTimeUpdate) and obj.trip_update is not None:
+            obj.trip_update_id = obj.trip_update.vj_id
+
+
+def _to_row(obj):
+    state = sqlalchemy.inspect(obj)
+    loaded = state.dict
+    row = {}
+    for prop in state.mapper.column_attrs:
+        column = prop.columns[0]
+        # the instrumented getattr is only needed for the expired attributes
+        value = loaded[prop.key] if prop.key in loaded else getattr(obj, prop.key)
+        if value is None and column.default is not None and not state.persistent:
+            # the ORM applies the python-side defaults of the columns that are not set
+            value = column.default.arg(None) if column.default.is_callable else column.default.arg
+        row[column.name] = value
+    return row
+
+
+def _quoted(column_names):
+    # some column names are reserved words (like 'order')
+    return ', '.join('"{}"'.format(n) for n in column_names)
+
+
+def _upsert(cursor, dialect, model_class, objects):
+    """
+    INSERT ... ON CONFLICT (primary key) DO UPDATE all columns (except created_at)
+    """
+    if not objects:
+        return
+    table = model_class.__table__
+    pk_names = [c.name for c in table.primary_key.columns]
+    updates = []
+    for c in table.columns:
+        if c.name in pk_names or c.name == 'created_at':
+            continue
+        if c.name == 'updated_at':
+            # the connections are in UTC (see model.set_utc_on_connect)
+            updates.append('updated_at = LOCALTIMESTAMP')
+        else:
+            updates.append('"{c}" = EXCLUDED."{c}"'.format(c=c.name))
+    on_conflict = 'DO UPDATE SET {}'.format(', '.join(updates)) if updates else 'DO NOTHING'
+    _insert(cursor, dialect, model_class, objects,
+            on_conflict='ON CONFLICT ({}) {}'.format(_quoted(pk_names), on_conflict))
+
+
+def _insert(cursor, dialect, model_class, objects, on_conflict=''):
+    """
+    multi-rows INSERT (by pages of PAGE_SIZE rows)
+    """
+    if not objects:
+        return
+    table = model_class.__table__
+    names = [c.name for c in table.columns]
+    # the values are converted by the column types, as SQLAlchemy does (like the LargeBinary columns)
+    processors = [(n, c.type.dialect_impl(dialect).bind_processor(dialect)) for n, c in zip(names, table.columns)]
+    rows = (_to_row(o) for o in objects)
+    execute_values(cursor,
+                   'INSERT INTO {t} ({cols}) VALUES %s {c}'.format(t=table.name, cols=_quoted(names), c=on_conflict),
+                   [tuple(p(row[n]) if p else row[n] for n, p in processors) for row in rows],
+                   page_size=PAGE_SIZE)
+
+
+def _delete(cursor, model_class, objects):
+    if not objects:
+        return
+    cursor.execute('DELETE FROM {t} WHERE id = ANY(%s::uuid[])'.format(t=model_class.__table__.name),
+                   ([o.id for o in objects],))
+
+
+def _insert_associations(cursor, associations):
+    if not associations:
+        return
+    execute_values(cursor,
+                   'INSERT INTO {t} (real_time_update_id, trip_update_id) VALUES %s ON CONFLICT DO NOTHING'
+                   .format(t=associate_realtimeupdate_tripupdate.name),
+                   [(rtu_id, tu.vj_id) for rtu_id, tu in associations],
+                   page_size=PAGE_SIZE)
+
+
+def _update_changed_columns(connection, obj):
+    state = sqlalchemy.inspect(obj)
+    values = {}
+    for prop in state.mapper.column_attrs:
+        if state.attrs[prop.key].history.has_changes():
+            values[prop.columns[0].name] = getattr(obj, prop.key)
+    if not values:
+        return
+    table = obj.__table__
+    if 'updated_at' in table.columns:
+        values['updated_at'] = datetime.datetime.utcnow()
+    connection.execute(table.update().where(table.c.id == obj.id).values(**values))
+
+
+def _mark_as_persisted(session, objects, orphans):
+    """
+    make the written objects persistent and clean, and remove the orphans from the session,
+    so that the session does not try to flush them again
+
+    Only the public API of SQLAlchemy is used: the objects are expunged, their attribute history is reset
+    as if they were just loaded (make_transient_to_detached), then they are attached again.
+    The attributes that are not loaded are expired, and everything is expired on commit anyway.
+    """
+    if isinstance(session, scoped_session):
+        session = session()
+    # all the objects must be clean before any of them is attached again,
+    # as attaching one cascades to its relationships
+    for obj in objects + orphans:
+        if obj in session:
+            session.expunge(obj)
+    for obj in objects:
+        if sqlalchemy.inspect(obj).key is not None:
+            make_transient(obj)
+        make_transient_to_detached(obj)
+    for obj in objects:
+        session.add(obj)
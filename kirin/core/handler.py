@@ -32,14 +32,14 @@ import datetime
 import logging
 import socket
 from datetime import timedelta
-import pytz
 
 import kirin
-from kirin.core import model
+from kirin.core import model, bulk_persist
 from kirin.core.model import TripUpdate, StopTimeUpdate
-from kirin.core.populate_pb import convert_to_gtfsrt
+from kirin.core.populate_pb import convert_to_gtfsrt, serialize_entity, serialize_feed
 from kirin.exceptions import MessageNotPublished
-from kirin.utils import get_timezone
+from kirin.rabbitmq_handler import PublishNacked
+from kirin.utils import get_timezone, get_utc_offset, local_to_utc
 
 
 def persist(real_time_update):
@@ -47,7 +47,10 @@ def persist(real_time_update):
     receive a RealTimeUpdate and persist it in the database
     """
     model.db.session.add(real_time_update)
-    model.db.session.commit()
+    if kirin.app.config.get('USE_BULK_PERSISTENCE'):
+        bulk_persist.commit(model.db.session)
+    else:
+        model.db.session.commit()
 
 
 def log_stu_modif(trip_update, stu, string_additional_info):
@@ -127,6 +130,19 @@ def manage_consistency(trip_update):
     return True
 
 
+def index_by_dated_vj(trip_updates):
+    """
+    index the given TripUpdates by (navitia_trip_id, start_timestamp) of their VehicleJourney
+
+    the index is built once so that finding the TripUpdate of a dated VJ is a simple dict lookup
+    (if several TripUpdates share the same dated VJ, the first one is kept)
+    """
+    index = {}
+    for tu in trip_updates:
+        index.setdefault((tu.vj.navitia_trip_id, tu.vj.get_start_timestamp()), tu)
+    return index
+
+
 def handle(real_time_update, trip_updates, contributor, is_new_complete=False):
     """
     receive a RealTimeUpdate with at least one TripUpdate filled with the data received
@@ -136,38 +152,111 @@ def handle(real_time_update, trip_updates, contributor, is_new_complete=False):
     if not real_time_update:
         raise TypeError()
     id_timestamp_tuples = [(tu.vj.navitia_trip_id, tu.vj.get_start_timestamp()) for tu in trip_updates]
-    old_trip_updates = TripUpdate.find_by_dated_vjs(id_timestamp_tuples)
-    for trip_update in trip_updates:
-        # find if there is already a row in db
-        old = next((tu for tu in old_trip_updates if tu.vj.navitia_trip_id == trip_update.vj.navitia_trip_id
-                    and tu.vj.get_start_timestamp() == trip_update.vj.get_start_timestamp()), None)
-        # merge the base schedule, the current realtime, and the new realtime
-        current_trip_update = merge(trip_update.vj.navitia_vj, old, trip_update, is_new_complete=is_new_complete)
-
-        # manage and adjust consistency if possible
-        if current_trip_update and manage_consistency(current_trip_update):
-            # we have to link the current_vj_update with the new real_time_update
-            # this link is done quite late to avoid too soon persistence of trip_update by sqlalchemy
-            current_trip_update.real_time_updates.append(real_time_update)
-
+    old_trip_updates = index_by_dated_vj(TripUpdate.find_by_dated_vjs(id_timestamp_tuples))
+    modified_trip_updates = set()
+    # everything is flushed at once by persist(), there is no need to flush on the lazy loads of the loop
+    with model.db.session.no_autoflush:
+        for trip_update, id_timestamp in zip(trip_updates, id_timestamp_tuples):
+            # find if there is already a row in db
+            old = old_trip_updates.get(id_timestamp)
+            # merge the base schedule, the current realtime, and the new realtime
+            current_trip_update = merge(trip_update.vj.navitia_vj, old, trip_update,
+                                        is_new_complete=is_new_complete)
+
+            # manage and adjust consistency if possible
+            if current_trip_update and manage_consistency(current_trip_update):
+                # we have to link the current_vj_update with the new real_time_update
+                # this link is done quite late to avoid too soon persistence of trip_update by sqlalchemy
+                current_trip_update.real_time_updates.append(real_time_update)
+
+            # merge can modify the status or the message of the db trip update even if it returns None
+            if current_trip_update is None and old is not None \
+                    and model.db.session.is_modified(old, include_collections=False):
+                current_trip_update = old
+            if current_trip_update is not None:
+                modified_trip_updates.add(current_trip_update)
+
+        # the serialized entities are persisted with their trip update
+        for tu in modified_trip_updates:
+            tu.pb_entity = serialize_entity(tu)
+        entities = [(tu.vj.id, tu.pb_entity) for tu in real_time_update.trip_updates]
+
+    persist_start = datetime.datetime.utcnow()
     persist(real_time_update)
+    persist_duration = (datetime.datetime.utcnow() - persist_start).total_seconds()
 
-    feed = convert_to_gtfsrt(real_time_update.trip_updates)
-    feed_str = feed.SerializeToString()
-    publish(feed_str, contributor)
+    feed = convert_to_gtfsrt([])
+    if kirin.feed_coalescer is not None:
+        kirin.feed_coalescer.add(contributor, entities)
+        size = sum(len(entity) for _, entity in entities)
+    else:
+        feed_str = serialize_feed(feed, (entity for _, entity in entities))
+        publish(feed_str, contributor)
+        size = len(feed_str)
 
     data_time = datetime.datetime.utcfromtimestamp(feed.header.timestamp)
-    log_dict = {'contributor': contributor, 'timestamp': data_time, 'trip_update_count': len(feed.entity),
-                'size': len(feed_str)}
+    log_dict = {'contributor': contributor, 'timestamp': data_time, 'trip_update_count': len(entities),
+                'size': size, 'persist_duration': persist_duration}
     return real_time_update, log_dict
 
 
-def _get_datetime(local_circulation_date, time, timezone):
-    dt = datetime.datetime.combine(local_circulation_date, time)
-    dt = timezone.localize(dt).astimezone(pytz.UTC)
-    # in the db dt with timezone cannot coexist with dt without tz
-    # since at the beginning there was dt without tz, we need to erase the tz info
-    return dt.replace(tzinfo=None)
+def _batch_to_utc(local_dts, timezones):
+    """
+    bring a column of local datetimes (None allowed) to UTC, each one with its own timezone
+
+    In the common case, all the datetimes share the same timezone and their local days have the same UTC offset
+    (no DST change): the offset is looked up once per local day and the whole column is a subtraction of it.
+    Otherwise each datetime is converted on its own.
+    """
+    dts = [dt for dt in local_dts if dt is not None]
+    if not dts:
+        return list(local_dts)
+
+    tz = timezones[0]
+    if all(t is tz for t in timezones):
+        offsets = set(get_utc_offset(tz, d) for d in set(dt.date() for dt in dts))
+        if len(offsets) == 1 and None not in offsets:
+            offset = offsets.pop()
+            return [dt - offset if dt is not None else None for dt in local_dts]
+
+    return [local_to_utc(dt, t) if dt is not None else None for dt, t in zip(local_dts, timezones)]
+
+
+def _get_base_schedule(navitia_vj, local_circulation_date):
+    """
+    compute the base schedule of all the stop_times of the navitia vj at once
+
+    the past-midnight are handled on the local times, then the whole local arrival and departure columns
+    are brought to UTC in batch
+    returns a list of (base_arrival, base_departure) UTC datetimes (None if there is no such time in navitia)
+    """
+    local_arrivals = []
+    local_departures = []
+    timezones = []
+    last_nav_dep = None
+    for navitia_stop in navitia_vj.get('stop_times', []):
+        nav_departure_time = navitia_stop.get('departure_time')
+        nav_arrival_time = navitia_stop.get('arrival_time')
+        timezones.append(get_timezone(navitia_stop))
+
+        local_arrival = local_departure = None
+        if nav_arrival_time is not None:
+            if last_nav_dep is not None and last_nav_dep > nav_arrival_time:
+                # last departure is after arrival, it's a past-midnight
+                local_circulation_date += timedelta(days=1)
+            local_arrival = datetime.datetime.combine(local_circulation_date, nav_arrival_time)
+
+        if nav_departure_time is not None:
+            if nav_arrival_time is not None and nav_arrival_time > nav_departure_time:
+                # departure is before arrival, it's a past-midnight
+                local_circulation_date += timedelta(days=1)
+            local_departure = datetime.datetime.combine(local_circulation_date, nav_departure_time)
+
+        local_arrivals.append(local_arrival)
+        local_departures.append(local_departure)
+        last_nav_dep = nav_departure_time
+
+    return zip(_batch_to_utc(local_arrivals, timezones), _batch_to_utc(local_departures, timezones))
 
 
 def _get_update_info_of_stop_time(base_time, input_status, input_delay):
@@ -272,32 +361,18 @@ def merge(navitia_vj, db_trip_update, new_trip_update, is_new_complete=False):
         res.stop_time_updates = []
         return res
 
-    last_nav_dep = None
     last_departure = None
-    local_circulation_date = new_trip_update.vj.get_local_circulation_date()
+    navitia_stops = navitia_vj.get('stop_times', [])
+    # we compute the arrival time and departure time on base schedule and take past mid-night into
+    # consideration
+    # TODO handle forbidden pickup/dropoff (in those case set departure/arrival at None)
+    base_schedule = _get_base_schedule(navitia_vj, new_trip_update.vj.get_local_circulation_date())
 
     has_changes = False
-    for nav_order, navitia_stop in enumerate(navitia_vj.get('stop_times', [])):
-        # TODO handle forbidden pickup/dropoff (in those case set departure/arrival at None)
-        nav_departure_time = navitia_stop.get('departure_time')
-        nav_arrival_time = navitia_stop.get('arrival_time')
-        timezone = get_timezone(navitia_stop)
-
-        # we compute the arrival time and departure time on base schedule and take past mid-night into
-        # consideration
-        base_arrival = base_departure = None
-        if nav_arrival_time is not None:
-            if last_nav_dep is not None and last_nav_dep > nav_arrival_time:
-                # last departure is after arrival, it's a past-midnight
-                local_circulation_date += timedelta(days=1)
-            base_arrival = _get_datetime(local_circulation_date, nav_arrival_time, timezone)
-
-        if nav_departure_time is not None:
-            if nav_arrival_time is not None and nav_arrival_time > nav_departure_time:
-                # departure is before arrival, it's a past-midnight
-                local_circulation_date += timedelta(days=1)
-            base_departure = _get_datetime(local_circulation_date, nav_departure_time, timezone)
-
+    # the db stop_time_updates are reused in place (and not replaced by new ones), to only update
+    # the modified rows (and columns) in the db instead of deleting and inserting all of them
+    reused_db_sts = set()
+    for nav_order, (navitia_stop, (base_arrival, base_departure)) in enumerate(zip(navitia_stops, base_schedule)):
         stop_id = navitia_stop.get('stop_point', {}).get('id')
         new_st = new_trip_update.find_stop(stop_id, nav_order)
 
@@ -313,8 +388,15 @@ def merge(navitia_vj, db_trip_update, new_trip_update, is_new_complete=False):
                                                    new_st,
                                                    navitia_stop['stop_point'],
                                                    order=nav_order)
-            has_changes |= (db_st is None) or db_st.is_ne(new_st_update)
-            res_st = new_st_update if has_changes else db_st
+            if db_st is not None and db_st not in reused_db_sts:
+                if db_st.is_ne(new_st_update):
+                    has_changes = True
+                    db_st.update_from(new_st_update)
+                reused_db_sts.add(db_st)
+                res_st = db_st
+            else:
+                has_changes = True
+                res_st = new_st_update
 
         elif db_trip_update is None and new_st is not None:
             """
@@ -340,11 +422,15 @@ def merge(navitia_vj, db_trip_update, new_trip_update, is_new_complete=False):
                         *** Here, we MUST NOT do anything, only update stop time's order ***
             """
             db_st = db_trip_update.find_stop(stop_id, nav_order)
-            res_st = db_st if db_st is not None else StopTimeUpdate(navitia_stop['stop_point'],
-                                                                    departure=base_departure,
-                                                                    arrival=base_arrival,
-                                                                    order=nav_order)
-            has_changes |= (db_st is None)
+            if db_st is not None and db_st not in reused_db_sts:
+                reused_db_sts.add(db_st)
+                res_st = db_st
+            else:
+                has_changes = True
+                res_st = StopTimeUpdate(navitia_stop['stop_point'],
+                                        departure=base_departure,
+                                        arrival=base_arrival,
+                                        order=nav_order)
         else:
             """
             Last case: nothing is recorded yet and there is no update info in the new trip update
@@ -358,7 +444,6 @@ def merge(navitia_vj, db_trip_update, new_trip_update, is_new_complete=False):
 
         last_departure = res_st.departure
         res_stoptime_updates.append(res_st)
-        last_nav_dep = nav_departure_time
 
     if has_changes:
         res.stop_time_updates = res_stoptime_updates
@@ -374,6 +459,6 @@ def publish(feed, contributor):
     try:
         kirin.rabbitmq_handler.publish(feed, contributor)
 
-    except socket.error:
+    except (socket.error, PublishNacked):
         logging.getLogger(__name__).exception('impossible to publish in rabbitmq')
         raise MessageNotPublished()
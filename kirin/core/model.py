@@ -35,6 +35,8 @@ from sqlalchemy.orm import backref, deferred
 from sqlalchemy.ext.orderinglist import ordering_list
 from flask_sqlalchemy import SQLAlchemy
 import datetime
+import hashlib
+import zlib
 import sqlalchemy
 from sqlalchemy import desc
 
@@ -119,19 +121,45 @@ class VehicleJourney(db.Model):
                                                                          start_time)
                                                ).astimezone(utc)
         self.navitia_vj = navitia_vj  # Not persisted
+        self._timezone = tzinfo  # Not persisted
 
     def get_start_timestamp(self):
         return get_utc_localized_timestamp_safe(self.start_timestamp)
 
-    def get_local_circulation_date(self):
+    def get_timezone(self):
+        """
+        timezone of the first stop_time of the navitia vj, resolved only once per VehicleJourney
+        """
         from kirin.utils import get_timezone
 
+        tzinfo = getattr(self, '_timezone', None)
+        if tzinfo is None:
+            tzinfo = self._timezone = get_timezone(self.navitia_vj.get('stop_times', [{}])[0])
+        return tzinfo
+
+    def get_stop_times_by_stop_area_code(self, code_type):
+        """
+        index of the stop_times of the navitia vj by the codes of type code_type of their stop_area,
+        built only once per VehicleJourney (and code_type)
+        """
+        indexes = getattr(self, '_stop_times_by_code', None)
+        if indexes is None:
+            indexes = self._stop_times_by_code = {}
+        index = indexes.get(code_type)
+        if index is None:
+            index = indexes[code_type] = {}
+            for st in self.navitia_vj.get('stop_times', []):
+                codes = ((st.get('stop_point') or {}).get('stop_area') or {}).get('codes') or []
+                # a stop_time is indexed only once by code, even if its stop_area has this code twice
+                for value in set(c.get('value') for c in codes if c.get('type') == code_type):
+                    index.setdefault(value, []).append(st)
+        return index
+
+    def get_local_circulation_date(self):
         if self.navitia_vj is None:
             return None
 
-        first_stop_time = self.navitia_vj.get('stop_times', [{}])[0]
-        tzinfo = get_timezone(first_stop_time)
-        return self.get_start_timestamp().astimezone(tzinfo).date()
+        return self.get_start_timestamp().astimezone(self.get_timezone()).date()
 
     def get_utc_circulation_date(self):
         return self.get_start_timestamp().date()
@@ -197,21 +225,28 @@ class StopTimeUpdate(db.Model, TimestampMixin):
         if status:
             self.arrival_status = status
 
+    # attributes compared by is_ne() and copied by update_from()
+    _compared_attributes = ('stop_id', 'message', 'order',
+                            'departure', 'departure_delay', 'departure_status',
+                            'arrival', 'arrival_delay', 'arrival_status')
+
     def is_ne(self, other):
         """
         we don't want to override the __ne__ function to avoid side effects
         :param other:
         :return:
         """
-        return (self.stop_id != other.stop_id or
-                self.message != other.message or
-                self.order != other.order or
-                self.departure != other.departure or
-                self.departure_delay != other.departure_delay or
-                self.departure_status != other.departure_status or
-                self.arrival != other.arrival or
-                self.arrival_delay != other.arrival_delay or
-                self.arrival_status != other.arrival_status)
+        return any(getattr(self, attr) != getattr(other, attr) for attr in self._compared_attributes)
+
+    def update_from(self, other):
+        """
+        copy the attributes of other in place
+        only the modified attributes are set, so only the modified columns are updated in the db
+        """
+        for attr in self._compared_attributes:
+            value = getattr(other, attr)
+            if getattr(self, attr) != value:
+                setattr(self, attr, value)
 
 associate_realtimeupdate_tripupdate = db.Table('associate_realtimeupdate_tripupdate',
                                     db.metadata,
@@ -247,6 +282,9 @@ class TripUpdate(db.Model, TimestampMixin):
                                         order_by="StopTimeUpdate.order",
                                         collection_class=ordering_list('order'),
                                         cascade='all, delete-orphan')
+    # serialized gtfs-rt entity of the trip update (see populate_pb.serialize_entity),
+    # refreshed by core.handle each time the trip update is modified
+    pb_entity = deferred(db.Column(db.LargeBinary, nullable=True))
 
     def __init__(self, vj=None, status='none', contributor=None):
         self.created_at = datetime.datetime.utcnow()
@@ -284,6 +322,21 @@ class TripUpdate(db.Model, TimestampMixin):
                                  format(end_dt=end_dt)))
         return query.all()
 
+    @classmethod
+    def find_pb_entities_by_contributor_period(cls, contributors, start_date=None, end_date=None):
+        """
+        return the query of the (vj_id, pb_entity) of the trip updates, without loading the trip updates
+        (same filters as find_by_contributor_period)
+        """
+        query = db.session.query(cls.vj_id, cls.pb_entity).join(cls.vj).filter(cls.contributor.in_(contributors))
+        if start_date:
+            start_dt = datetime.datetime.combine(start_date, datetime.time(0, 0))
+            query = query.filter(VehicleJourney.start_timestamp >= start_dt)
+        if end_date:
+            end_dt = datetime.datetime.combine(end_date, datetime.time(0, 0)) + datetime.timedelta(days=1)
+            query = query.filter(VehicleJourney.start_timestamp <= end_dt)
+        return query
+
     @classmethod
     def remove_by_contributors_and_period(cls, contributors, start_date=None, end_date=None):
         trip_updates_to_remove = cls.find_by_contributor_period(contributors=contributors,
@@ -301,12 +354,63 @@ class TripUpdate(db.Model, TimestampMixin):
         # For IRE since we dont care of the order search only with stop_id if no element found
         # Note: if the trip_update stops list is not a strict ending sublist of stops list of navitia_vj
         # then the whole trip is ignored in model_maker.
-        first = next((st for st in self.stop_time_updates
-                      if st.stop_id == stop_id and st.order == order), None)
+        by_stop_and_order, by_stop = self._get_stop_index()
+        first = by_stop_and_order.get((stop_id, order))
         if first:
             return first
-        return next((st for st in self.stop_time_updates
-                     if st.stop_id == stop_id), None)
+        return by_stop.get(stop_id)
+
+    def _get_stop_index(self):
+        """
+        lazily build the indexes used by find_stop:
+            * (stop_id, order) -> first matching StopTimeUpdate
+            * stop_id -> first matching StopTimeUpdate
+        the indexes are invalidated as soon as the stop_time_updates (or their stop_id/order) are modified
+        Note: not done in __init__ as it is not called when loaded from db
+        """
+        index = getattr(self, '_stop_index', None)
+        if index is None:
+            by_stop_and_order = {}
+            by_stop = {}
+            for st in self.stop_time_updates:
+                by_stop_and_order.setdefault((st.stop_id, st.order), st)
+                by_stop.setdefault(st.stop_id, st)
+            index = self._stop_index = (by_stop_and_order, by_stop)
+        return index
+
+    def invalidate_stop_index(self):
+        self._stop_index = None
+
+
+@sqlalchemy.event.listens_for(TripUpdate.stop_time_updates, 'append')
+@sqlalchemy.event.listens_for(TripUpdate.stop_time_updates, 'remove')
+def _invalidate_stop_index_on_collection_change(trip_update, stop_time_update, initiator):
+    trip_update.invalidate_stop_index()
+
+
+@sqlalchemy.event.listens_for(TripUpdate.stop_time_updates, 'init_collection')
+@sqlalchemy.event.listens_for(TripUpdate.stop_time_updates, 'dispose_collection')
+def _invalidate_stop_index_on_collection_replace(trip_update, collection, collection_adapter):
+    trip_update.invalidate_stop_index()
+
+
+@sqlalchemy.event.listens_for(StopTimeUpdate.stop_id, 'set')
+@sqlalchemy.event.listens_for(StopTimeUpdate.order, 'set')
+def _invalidate_stop_index_on_stop_change(stop_time_update, value, old_value, initiator):
+    trip_update = stop_time_update.__dict__.get('trip_update')
+    if trip_update is not None and value != old_value:
+        trip_update.invalidate_stop_index()
+
+
+def make_content_hash(data):
+    """
+    sha1 of the received data (the text is hashed as utf-8)
+    """
+    if data is None:
+        return None
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    return hashlib.sha1(data).hexdigest()
 
 
 class RealTimeUpdate(db.Model, TimestampMixin):
@@ -326,6 +430,10 @@ class RealTimeUpdate(db.Model, TimestampMixin):
     db.Index('status_idx', status)
     error = db.Column(db.Text, nullable=True)
     raw_data = deferred(db.Column(db.Text, nullable=True))
+    # the binary payloads (like gtfs-rt protobufs) are stored compressed with zlib instead of in raw_data
+    raw_data_zlib = deferred(db.Column(db.LargeBinary, nullable=True))
+    # hash of the received data, to detect identical payloads without loading them (see make_content_hash)
+    content_hash = db.Column(db.Text, nullable=True)
     contributor = db.Column(db.Text, nullable=True)
 
     trip_updates = db.relationship("TripUpdate", secondary=associate_realtimeupdate_tripupdate, cascade='all',
@@ -334,25 +442,38 @@ class RealTimeUpdate(db.Model, TimestampMixin):
     __table_args__ = (db.Index('realtime_update_created_at', 'created_at'),
                       db.Index('realtime_update_contributor_and_created_at', 'created_at', 'contributor'))
 
-    def __init__(self, raw_data, connector, contributor, status='OK', error=None, received_at=None):
+    def __init__(self, raw_data, connector, contributor, status='OK', error=None, received_at=None,
+                 binary_raw_data=None):
         self.id = gen_uuid()
         self.raw_data = raw_data
+        self.raw_data_zlib = zlib.compress(binary_raw_data) if binary_raw_data is not None else None
+        self.content_hash = make_content_hash(binary_raw_data if binary_raw_data is not None else raw_data)
         self.connector = connector
         self.status = status
         self.error = error
         self.contributor = contributor
         self.received_at = received_at if received_at else datetime.datetime.utcnow()
 
+    def get_raw_data(self):
+        """
+        the received data, decompressed if it is a binary payload
+        """
+        if self.raw_data_zlib is not None:
+            return zlib.decompress(self.raw_data_zlib)
+        return self.raw_data
+
     @classmethod
     def get_probes_by_contributor(cls):
         """
         create a dict of probes
         """
         from kirin import app
+        from kirin.utils import get_gtfs_rt_feeds
         result = {'last_update': {},
                   'last_valid_update': {},
                   'last_update_error': {}}
         contributor = [app.config['CONTRIBUTOR'], app.config['COTS_CONTRIBUTOR'], app.config['GTFS_RT_CONTRIBUTOR']]
+        contributor += [f['contributor'] for f in get_gtfs_rt_feeds() if f['contributor'] not in contributor]
         for c in contributor:
             sql = db.session.query(cls.created_at, cls.status, cls.updated_at, cls.error)
             sql = sql.filter(cls.contributor == c)
@@ -119,5 +119,25 @@ def fill_trip_update(pb_trip_update, trip_update):
 
 
 def fill_entity(pb_entity, trip_update):
-    pb_entity.id = trip_update.vj_id
+    # vj_id is only set by the ORM at flush time, and the entity can be built before
+    pb_entity.id = trip_update.vj_id if trip_update.vj_id else trip_update.vj.id
     fill_trip_update(pb_entity.trip_update, trip_update)
+
+
+def serialize_entity(trip_update):
+    """
+    serialize the entity of trip_update as a FeedMessage without header
+    """
+    feed = gtfs_realtime_pb2.FeedMessage()
+    fill_entity(feed.entity.add(), trip_update)
+    return feed.SerializePartialToString()
+
+
+def serialize_feed(feed, serialized_entities):
+    """
+    serialize feed with the serialized entities (see serialize_entity) appended to its entities
+
+    the concatenation of serialized protobuf messages is parsed as the merge of those messages,
+    so the entities do not have to be built again from the trip updates
+    """
+    return feed.SerializeToString() + b''.join(serialized_entities)
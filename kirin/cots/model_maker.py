@@ -33,7 +33,6 @@ from __future__ import absolute_import, print_function, division
 
 import logging
 from datetime import datetime
-from dateutil import parser
 from flask.globals import current_app
 from kirin.abstract_sncf_model_maker import AbstractSNCFKirinModelBuilder, get_navitia_stop_time_sncf
 # For perf benches:
@@ -43,7 +42,7 @@ import ujson
 from kirin.core import model
 from kirin.cots.message_handler import MessageHandler
 from kirin.exceptions import InvalidArguments
-from kirin.utils import record_internal_failure
+from kirin.utils import record_internal_failure, parse_iso_datetime
 
 
 def get_value(sub_json, key, nullable=False):
@@ -77,19 +76,29 @@ def _retrieve_interesting_pdp(list_pdp):
     :return: Filtered array
     Notes:  - written in a yield-fashion to switch implementation if possible, but we need random access for now
             - see 'test_retrieve_interesting_pdp' for a functional example
+            - single pass (after a backward pass to know if any following stop_time has an arrival time),
+              as freight-like itineraries can be long
     """
+    # has_following_arrival[idx] is True if a station in list_pdp[idx:] has an arrival time
+    has_following_arrival = [False] * (len(list_pdp) + 1)
+    for idx in range(len(list_pdp) - 1, -1, -1):
+        pdp = list_pdp[idx]
+        has_following_arrival[idx] = has_following_arrival[idx + 1] or \
+            bool(get_value(pdp, 'horaireVoyageurArrivee', nullable=True) and is_station(pdp))
+
     res = []
     picked_one = False
     for idx, pdp in enumerate(list_pdp):
+        departure = get_value(pdp, 'horaireVoyageurDepart', nullable=True)
+        arrival = get_value(pdp, 'horaireVoyageurArrivee', nullable=True)
         # At start, do not consume until there's a departure time (horaireVoyageurDepart)
-        if not picked_one and not get_value(pdp, 'horaireVoyageurDepart', nullable=True):
+        if not picked_one and not departure:
             continue
         # exclude stop_times that are not legit stations
         if not is_station(pdp):
             continue
         # exclude stop_times that have no departure nor arrival time (empty stop_times)
-        if not get_value(pdp, 'horaireVoyageurDepart', nullable=True) and \
-                not get_value(pdp, 'horaireVoyageurArrivee', nullable=True):
+        if not departure and not arrival:
             continue
         # stop consuming once all following stop_times are missing arrival time
         # * if a stop_time only has departure time, travelers can only hop in, but if they are be able to
@@ -98,12 +107,8 @@ def _retrieve_interesting_pdp(list_pdp):
         # * if no stop_time has arrival time anymore, then stop_times are useless as traveler cannot
         #   hop off, so no point hopping in anymore, so we remove all the stop_times until the end
         #   (should not happen in practice).
-        if not get_value(pdp, 'horaireVoyageurArrivee', nullable=True):
-            has_following_arrival = any(
-                get_value(follow_pdp, 'horaireVoyageurArrivee', nullable=True) and is_station(follow_pdp)
-                for follow_pdp in list_pdp[idx:])
-            if not has_following_arrival:
-                break
+        if not arrival and not has_following_arrival[idx]:
+            break
 
         picked_one = True
         res.append(pdp)
@@ -113,7 +118,7 @@ def _retrieve_interesting_pdp(list_pdp):
 def as_date(s):
     if s is None:
         return None
-    return parser.parse(s, dayfirst=False, yearfirst=True)
+    return parse_iso_datetime(s)
 
 
 def as_duration(seconds):
@@ -176,43 +181,53 @@ class KirinModelBuilder(AbstractSNCFKirinModelBuilder):
             grant_type=current_app.config['COTS_PAR_IV_GRANT_TYPE'],
             timeout=current_app.config['COTS_PAR_IV_REQUEST_TIMEOUT'])
 
-    def build(self, rt_update):
+    @staticmethod
+    def parse(raw_data):
+        """
+        parse the COTS raw json
+        """
+        try:
+            json = ujson.loads(raw_data)
+        except ValueError as e:
+            raise InvalidArguments("invalid json: {}".format(e.message))
+
+        if 'nouvelleVersion' not in json:
+            raise InvalidArguments('No object "nouvelleVersion" available in feed provided')
+        return json
+
+    def build(self, rt_update, data=None):
         """
         parse the COTS raw json stored in the rt_update object (in Kirin db)
         and return a list of trip updates
+        data is the COTS json already parsed (see parse), to avoid parsing again the raw json
 
         The TripUpdates are not yet associated with the RealTimeUpdate
 
         Most of the realtime information parsed is contained in the 'nouvelleVersion' sub-object
         (see fixtures and documentation)
         """
-        try:
-            json = ujson.loads(rt_update.raw_data)
-        except ValueError as e:
-            raise InvalidArguments("invalid json: {}".format(e.message))
-
-        if 'nouvelleVersion' not in json:
-            raise InvalidArguments('No object "nouvelleVersion" available in feed provided')
+        json = data if data is not None else self.parse(rt_update.raw_data)
 
         dict_version = get_value(json, 'nouvelleVersion')
-        vjs = self._get_vjs(dict_version)
+        # the interesting pdps are filtered only once for the message
+        pdps = _retrieve_interesting_pdp(get_value(dict_version, 'listePointDeParcours'))
+        vjs = self._get_vjs(dict_version, pdps)
 
-        trip_updates = [self._make_trip_update(vj, dict_version) for vj in vjs]
+        trip_updates = [self._make_trip_update(vj, dict_version, pdps) for vj in vjs]
 
         return trip_updates
 
-    def _get_vjs(self, json_train):
+    def _get_vjs(self, json_train, pdps):
         train_numbers = get_value(json_train, 'numeroCourse')
-        pdps = _retrieve_interesting_pdp(get_value(json_train, 'listePointDeParcours'))
         if not pdps:
             raise InvalidArguments('invalid json, "listePointDeParcours" has no valid stop_time in '
                                    'json elt {elt}'.format(elt=ujson.dumps(json_train)))
 
         str_time_start = get_value(get_value(pdps[0], 'horaireVoyageurDepart'), 'dateHeure')
-        vj_start = parser.parse(str_time_start, dayfirst=False, yearfirst=True, ignoretz=False)
+        vj_start = as_date(str_time_start)
 
         str_time_end = get_value(get_value(pdps[-1], 'horaireVoyageurArrivee'), 'dateHeure')
-        vj_end = parser.parse(str_time_end, dayfirst=False, yearfirst=True, ignoretz=False)
+        vj_end = as_date(str_time_end)
 
         return self._get_navitia_vjs(train_numbers, vj_start, vj_end)
 
@@ -222,9 +237,10 @@ class KirinModelBuilder(AbstractSNCFKirinModelBuilder):
         log_dict.update({'contributor': self.contributor})
         logger.info('metrology', extra=log_dict)
 
-    def _make_trip_update(self, vj, json_train):
+    def _make_trip_update(self, vj, json_train, pdps):
         """
         create the new TripUpdate object
+        pdps are the interesting "Points de Parcours" of json_train (see _retrieve_interesting_pdp)
         Following the COTS spec: https://github.com/CanalTP/kirin/blob/master/documentation/cots_connector.md
         """
         logger = logging.getLogger(__name__)
@@ -250,12 +266,11 @@ class KirinModelBuilder(AbstractSNCFKirinModelBuilder):
 
         # all other status is considered an 'update' of the trip
         trip_update.status = 'update'
-        pdps = _retrieve_interesting_pdp(get_value(json_train, 'listePointDeParcours'))
 
         # manage realtime information stop_time by stop_time
         for pdp in pdps:
             # retrieve navitia's stop_time information corresponding to the current COTS pdp
-            nav_st, log_dict = self._get_navitia_stop_time(pdp, vj.navitia_vj)
+            nav_st, log_dict = self._get_navitia_stop_time(pdp, vj)
             if log_dict:
                 record_internal_failure(log_dict['log'], contributor=self.contributor)
                 log_dict.update({'contributor': self.contributor})
@@ -335,16 +350,16 @@ class KirinModelBuilder(AbstractSNCFKirinModelBuilder):
         return trip_update
 
     @staticmethod
-    def _get_navitia_stop_time(pdp, nav_vj):
+    def _get_navitia_stop_time(pdp, vj):
         """
         get a navitia stop from a Point de Parcours dict
         the dict MUST contain cr, ci, ch tags
 
-        it searches in the vj's stops for a stop_area with the external code
+        it searches in the vj's stops (indexed by code) for a stop_area with the external code
         cr-ci-ch
         we also return error messages as 'missing stop point', 'duplicate stops'
         """
         return get_navitia_stop_time_sncf(cr=get_value(pdp, 'cr'),
                                           ci=get_value(pdp, 'ci'),
                                           ch=get_value(pdp, 'ch'),
-                                          nav_vj=nav_vj)
+                                          vj=vj)
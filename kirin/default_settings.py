@@ -17,6 +17,15 @@ NAVITIA_URL = os.getenv('KIRIN_NAVITIA_URL', None)
 
 NAVITIA_TIMEOUT = 5
 
+# max nb of concurrent queries on a navitia instance (the vjs of a feed are searched concurrently),
+# 1 to query navitia sequentially
+NAVITIA_MAX_CONCURRENT_QUERIES = int(os.getenv('KIRIN_NAVITIA_MAX_CONCURRENT_QUERIES', 1))
+
+# max duration (in seconds) of a concurrent vj search in navitia
+# (with gevent's monkey patching, see USE_GEVENT, the calls are run in greenlets and interrupted after this
+# duration, otherwise they are run in threads and only not waited for anymore)
+NAVITIA_CONCURRENT_QUERY_TIMEOUT = float(os.getenv('KIRIN_NAVITIA_CONCURRENT_QUERY_TIMEOUT', 10))
+
 NAVITIA_INSTANCE = os.getenv('KIRIN_NAVITIA_INSTANCE', 'sncf')
 
 NAVITIA_TOKEN = os.getenv('KIRIN_NAVITIA_TOKEN', None)
@@ -51,11 +60,19 @@ COTS_PAR_IV_REQUEST_TIMEOUT = int(os.getenv('KIRIN_COTS_COTS_PAR_IV_REQUEST_TIME
                                             timedelta(seconds=2).total_seconds()))
 
 
-# TODO better conf for multi GTFS-RT
+# the gtfs-rt feed posted on /gtfs_rt, also polled if GTFS_RT_FEEDS is empty
 NAVITIA_GTFS_RT_INSTANCE = os.getenv('KIRIN_NAVITIA_GTFS_RT_INSTANCE', 'sherbrooke')
 NAVITIA_GTFS_RT_TOKEN = os.getenv('KIRIN_NAVITIA_GTFS_RT_TOKEN', None)
 GTFS_RT_CONTRIBUTOR = os.getenv('KIRIN_GTFS_RT_CONTRIBUTOR', 'realtime.sherbrooke')
 GTFS_RT_FEED_URL = os.getenv('KIRIN_GTFS_RT_FEED_URL', None)
+# the polled gtfs-rt feeds, as a json list of feeds like:
+# {"contributor": "realtime.sherbrooke", "feed_url": "http://...", "coverage": "sherbrooke",
+#  "token": null, "navitia_url": "http://...", "timeout": 1, "poll_interval": 1, "max_poll_interval": 60}
+# (only contributor, feed_url and coverage are mandatory, see utils.get_gtfs_rt_feeds)
+GTFS_RT_FEEDS = json.loads(os.getenv('KIRIN_GTFS_RT_FEEDS', '[]'))
+# default max poll interval (in seconds) of the gtfs-rt feeds: if greater than the poll_interval of a feed,
+# its poll interval is adapted (between both) to the update cadence of the feed, 0 to always poll every poll_interval
+GTFS_RT_MAX_POLL_INTERVAL = int(os.getenv('KIRIN_GTFS_RT_MAX_POLL_INTERVAL', 0))
 NB_DAYS_TO_KEEP_TRIP_UPDATE = int(os.getenv('NB_DAYS_TO_KEEP_TRIP_UPDATE', 2))
 NB_DAYS_TO_KEEP_RT_UPDATE = int(os.getenv('NB_DAYS_TO_KEEP_RT_UPDATE', 10))
 
@@ -70,21 +87,57 @@ RABBITMQ_CONNECTION_STRING = os.getenv('KIRIN_RABBITMQ_CONNECTION_STRING',
 # max nb of retries before giving up publishing
 MAX_RETRIES = 10
 
+# nb of messages published before waiting for the confirms of the broker, 0 to disable the publisher confirms
+RABBITMQ_CONFIRM_BATCH_SIZE = int(os.getenv('KIRIN_RABBITMQ_CONFIRM_BATCH_SIZE', 0))
+
 # queue used for task of type load_realtime, all instances of kirin must use the same queue
 # to be able to load balance tasks between them
 LOAD_REALTIME_QUEUE = 'kirin_load_realtime'
 
+# max nb of trip updates in a message of the full feed sent to a starting kraken
+# (the feed is then streamed in several messages), 0 to send the whole feed in one message
+FULL_FEED_CHUNK_SIZE = int(os.getenv('KIRIN_FULL_FEED_CHUNK_SIZE', 0))
+
 # amqp exhange used for sending disruptions
 EXCHANGE = os.getenv('KIRIN_RABBITMQ_EXCHANGE', 'navitia')
 
 ENABLE_RABBITMQ = boolean(os.getenv('KIRIN_ENABLE_RABBITMQ', True))
 
+# the differential feeds of a contributor can be coalesced before their publication, to publish less messages:
+# they are published at the latest after the max delay (in seconds, 0 to publish each feed immediately),
+# or as soon as the coalesced feed reaches the max size (in bytes)
+# the coalesced feeds are buffered in the memory of each process: the ones of a killed process are only published
+# with the next full feed, so the max delay must stay small
+PUBLISH_COALESCING_MAX_DELAY = float(os.getenv('KIRIN_PUBLISH_COALESCING_MAX_DELAY', 0))
+PUBLISH_COALESCING_MAX_SIZE = int(os.getenv('KIRIN_PUBLISH_COALESCING_MAX_SIZE', 1024 * 1024))
+
+# persist the realtime updates with a few multi-rows INSERT ... ON CONFLICT statements instead of the ORM flush
+USE_BULK_PERSISTENCE = boolean(os.getenv('KIRIN_USE_BULK_PERSISTENCE', False))
+
+# nb of trips of a gtfs-rt feed searched in the same navitia call (with a has_code(...) or ... filter),
+# 0 to search the trips one by one
+GTFS_RT_VJ_BATCH_SIZE = int(os.getenv('KIRIN_GTFS_RT_VJ_BATCH_SIZE', 0))
+
+# duration (in seconds) of the fingerprints of the trip_update entities of the last gtfs-rt feed, kept in redis:
+# only the entities that changed since the last feed are handled, 0 to handle all the entities of each feed
+GTFS_RT_ENTITY_FINGERPRINT_TIMEOUT = int(os.getenv('KIRIN_GTFS_RT_ENTITY_FINGERPRINT_TIMEOUT', 0))
+
 
 NAVITIA_QUERY_CACHE_TIMEOUT = int(os.getenv('KIRIN_NAVITIA_QUERY_CACHE_TIMEOUT',
                                             timedelta(days=1).total_seconds()))  # in seconds
 NAVITIA_PUBDATE_CACHE_TIMEOUT = int(os.getenv('KIRIN_NAVITIA_PUBDATE_CACHE_TIMEOUT',
                                               timedelta(minutes=5).total_seconds()))  # in seconds
 
+# duration (in seconds) of the base schedule vjs kept in the store of kirin (see kirin.base_schedule),
+# the store is invalidated by a new navitia publication so it can be long (like a day), 0 to disable the store
+# the store needs a CACHE_TYPE shared between the processes (like redis), it is disabled with 'simple' or 'null'
+# (the store is then warmed up by the celery task warm_up_base_schedule)
+BASE_SCHEDULE_STORE_TIMEOUT = int(os.getenv('KIRIN_BASE_SCHEDULE_STORE_TIMEOUT', 0))
+
+# skip the feeds (ire, cots and gtfs-rt) identical to the last one successfully handled for the same contributor:
+# the payload is hashed and, if its hash is the one of the last RealTimeUpdate, only its updated_at is changed
+SKIP_IDENTICAL_FEEDS = boolean(os.getenv('KIRIN_SKIP_IDENTICAL_FEEDS', False))
+
 CACHE_TYPE = os.getenv('KIRIN_CACHE_TYPE', 'simple')
 
 NEW_RELIC_CONFIG_FILE = os.getenv('KIRIN_NEW_RELIC_CONFIG_FILE', None)
@@ -225,5 +278,10 @@ CELERYBEAT_SCHEDULE = {
         'task': 'kirin.tasks.purge_cots_rt_update',
         'schedule': schedules.crontab(hour='4', minute='15'),
         'options': {'expires': timedelta(hours=1).total_seconds()}
+    },
+    'warm_up_base_schedule': {
+        'task': 'kirin.tasks.warm_up_base_schedule',
+        'schedule': timedelta(minutes=1),
+        'options': {'expires': timedelta(minutes=1).total_seconds()}
     }
 }
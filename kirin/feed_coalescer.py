@@ -0,0 +1,157 @@
+# coding=utf-8
+
+# Copyright (c) 2001-2018, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+import collections
+import logging
+import threading
+import time
+
+from kirin.core.populate_pb import convert_to_gtfsrt, serialize_feed
+
+
+class FeedCoalescer(object):
+    """
+    coalesce the differential feeds of a contributor before publishing them:
+    the serialized entities (see populate_pb.serialize_entity) are buffered by contributor,
+    and the entity of a vj replaces the previous one of the same vj still in the buffer
+
+    the buffer of a contributor is published in one feed:
+        * as soon as its size reaches max_size (in bytes)
+        * at the latest max_delay seconds after its first entity (with a threading.Timer, that works with or
+          without gevent, and checked by each add() too)
+
+    the publication is asynchronous for the caller of add(): if it fails, the error is logged and the
+    entities are kept in the buffer, to be published again max_delay seconds later
+
+    Note: the buffers are in the memory of the process, they are only flushed at a normal exit.
+    The entities buffered when a process is killed (SIGKILL, worker recycled...) are lost, they will only be
+    published with the next full feed, so max_delay must stay small (a few seconds).
+    """
+    def __init__(self, publish, max_delay, max_size, timer=threading.Timer, clock=time.time):
+        self._publish = publish  # publish(feed_str, contributor)
+        self.max_delay = max_delay
+        self.max_size = max_size
+        self._timer = timer  # timer(interval, function, args) like threading.Timer
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._buffers = {}  # contributor -> _Buffer
+        self._timers = {}  # contributor -> threading.Timer flushing the buffer after max_delay
+
+    def add(self, contributor, entities):
+        """
+        add the (vj_id, serialized entity) of a differential feed of contributor
+
+        never raises a publication error: the published feed holds the entities of other messages too
+        """
+        with self._lock:
+            buf = self._buffers.get(contributor)
+            if buf is None:
+                buf = self._buffers[contributor] = _Buffer(self._clock())
+                self._start_timer(contributor, buf)
+            for vj_id, entity in entities:
+                buf.add(vj_id, entity)
+            # the delay is also checked here, in case the timer is late
+            # (a buffer that could not be published is only tried again after the delay)
+            must_flush = (buf.size >= self.max_size and not buf.failed) or self._clock() - buf.start >= self.max_delay
+        if must_flush:
+            self.flush(contributor)
+
+    def flush(self, contributor):
+        """
+        publish the buffered entities of contributor, if any
+        return False if the publication failed (the entities are then kept in the buffer)
+        """
+        with self._lock:
+            buf = self._buffers.pop(contributor, None)
+            timer = self._timers.pop(contributor, None)
+        if timer is not None:
+            timer.cancel()
+        if buf is None:
+            return True
+        try:
+            self._publish(serialize_feed(convert_to_gtfsrt([]), buf.entities.values()), contributor)
+        except Exception:
+            logging.getLogger(__name__).exception('impossible to publish the coalesced feed of %s, '
+                                                  'it will be published again later', contributor)
+            self._restore(contributor, buf)
+            return False
+        return True
+
+    def flush_all(self):
+        for contributor in list(self._buffers):
+            self.flush(contributor)
+
+    def _start_timer(self, contributor, buf):
+        # must be called with the lock
+        timer = self._timer(self.max_delay, self._on_timer, args=(contributor, buf))
+        timer.daemon = True
+        self._timers[contributor] = timer
+        timer.start()
+
+    def _on_timer(self, contributor, buf):
+        with self._lock:
+            # the buffer might already have been published by an add()
+            if self._buffers.get(contributor) is not buf:
+                return
+        self.flush(contributor)
+
+    def _restore(self, contributor, failed_buf):
+        """
+        put back the entities of a buffer that could not be published,
+        the entities buffered since then are more recent and replace them
+        """
+        with self._lock:
+            current = self._buffers.get(contributor)
+            if current is not None:
+                for vj_id, entity in current.entities.items():
+                    failed_buf.add(vj_id, entity)
+                timer = self._timers.pop(contributor, None)
+                if timer is not None:
+                    timer.cancel()
+            # the next try is max_delay seconds later
+            failed_buf.start = self._clock()
+            failed_buf.failed = True
+            self._buffers[contributor] = failed_buf
+            self._start_timer(contributor, failed_buf)
+
+
+class _Buffer(object):
+    def __init__(self, start):
+        self.start = start
+        self.failed = False  # True if a publication of the buffer has failed
+        self.entities = collections.OrderedDict()  # vj_id -> serialized entity
+        self.size = 0
+
+    def add(self, vj_id, entity):
+        previous = self.entities.pop(vj_id, None)
+        if previous is not None:
+            self.size -= len(previous)
+        self.entities[vj_id] = entity
+        self.size += len(entity)
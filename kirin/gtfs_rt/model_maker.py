@@ -38,18 +38,29 @@ from kirin.core import model
 from kirin.exceptions import KirinException, InvalidArguments, ObjectNotFound
 from kirin.utils import make_navitia_wrapper, make_rt_update, floor_datetime
 from kirin import new_relic
-from kirin.utils import record_internal_failure, record_call
+from kirin.utils import record_internal_failure, record_call, navitia_concurrent_map
 from kirin.utils import get_timezone
-from kirin import app
+from kirin import app, redis
+from kirin import base_schedule
 import itertools
 import calendar
+import hashlib
 
-def handle(proto, navitia_wrapper, contributor):
-    data = str(proto)  # temp, for the moment, we save the protobuf as text
-    rt_update = make_rt_update(data, 'gtfs-rt', contributor=contributor)
+# nb of seconds the kirin vjs of a trip are kept in the cache (see KirinModelBuilder._make_db_vj)
+VJ_CACHE_TIMEOUT = 1200
+
+
+def handle(proto, navitia_wrapper, contributor, raw_proto=None):
+    """
+    raw_proto is the received protobuf (proto is serialized again if not provided), it is stored compressed
+    """
+    if raw_proto is None:
+        raw_proto = proto.SerializeToString()
+    rt_update = make_rt_update(None, 'gtfs-rt', contributor=contributor, binary_data=raw_proto)
     start_datetime = datetime.datetime.utcnow()
     try:
-        trip_updates = KirinModelBuilder(navitia_wrapper, contributor).build(rt_update, data=proto)
+        builder = KirinModelBuilder(navitia_wrapper, contributor)
+        trip_updates = builder.build(rt_update, data=proto)
         record_call('OK', contributor=contributor)
     except KirinException as e:
         rt_update.status = 'KO'
@@ -67,6 +78,8 @@ def handle(proto, navitia_wrapper, contributor):
         raise
 
     real_time_update, log_dict = core.handle(rt_update, trip_updates, contributor)
+    # the entities are considered as handled only once their trip updates are merged
+    builder.save_entity_fingerprints()
 
     # After merging trip_updates information of gtfs-rt, navitia and kirin database, if there is no new information
     # destinated to navitia, update real_time_update with status = 'KO' and a proper error message.
@@ -85,6 +98,15 @@ def handle(proto, navitia_wrapper, contributor):
     logging.getLogger(__name__).info('Simple feed publication', extra=log_dict)
 
 
+def _entity_key(entity):
+    trip = entity.trip_update.trip
+    return '{}|{}'.format(trip.trip_id, trip.start_date)
+
+
+def _entity_fingerprint(entity):
+    return hashlib.sha1(entity.trip_update.SerializeToString()).hexdigest()
+
+
 def to_str(date):
     # the date is in UTC, thus we don't have to care about the coverage's timezone
     return date.strftime("%Y%m%dT%H%M%SZ")
@@ -100,6 +122,10 @@ class KirinModelBuilder(object):
         self.period_filter_tolerance = datetime.timedelta(hours=3)
         self.stop_code_key = 'source'  # TODO conf
         self.instance_data_pub_date = self.navitia.get_publication_date()
+        # fingerprints of the trip_update entities of the built feed (see save_entity_fingerprints)
+        self.entity_fingerprints = {}
+        # fingerprints of the entities changed since the last feed, recorded once they gave trip_updates
+        self.changed_entity_fingerprints = {}
 
     def build(self, rt_update, data):
         """
@@ -114,25 +140,89 @@ class KirinModelBuilder(object):
 
         trip_updates = []
 
-        for entity in data.entity:
-            if not entity.trip_update:
-                continue
-            tu = self._make_trip_updates(entity.trip_update, data_time=data_time)
+        entities = [e for e in data.entity if e.trip_update]
+        nb_entities = len(entities)
+        if app.config.get('GTFS_RT_ENTITY_FINGERPRINT_TIMEOUT'):
+            entities = self._filter_changed_entities(entities)
+            self.log.debug('{} changed entities out of {}'.format(len(entities), nb_entities))
+
+        batch_size = app.config.get('GTFS_RT_VJ_BATCH_SIZE')
+        if batch_size:
+            self._prefetch_navitia_vjs([e.trip_update.trip.trip_id for e in entities],
+                                       data_time=data_time, batch_size=batch_size)
+
+        # the vjs of the trips are searched concurrently
+        entities_vjs = navitia_concurrent_map(self.navitia,
+                                              lambda e: self._get_navitia_vjs(e.trip_update.trip, data_time=data_time),
+                                              entities)
+        for entity, vjs in zip(entities, entities_vjs):
+            tu = self._make_trip_updates(entity.trip_update, vjs, data_time=data_time)
             trip_updates.extend(tu)
+            key = _entity_key(entity)
+            if tu and key in self.changed_entity_fingerprints:
+                # an entity without trip_update (like a vj not found) is handled again in the next feed
+                self.entity_fingerprints[key] = self.changed_entity_fingerprints[key]
 
-        if not trip_updates:
+        # if all the entities are unchanged, it's up to core.handle to find that there is no new information
+        if not trip_updates and len(entities) == nb_entities:
             rt_update.status = 'KO'
             rt_update.error = 'No information for this gtfs-rt with timestamp: {}'.format(data.header.timestamp)
             self.log.error('No information for this gtfs-rt with timestamp: {}'.format(data.header.timestamp))
 
         return trip_updates
 
+    def _fingerprints_key(self):
+        # the fingerprints are invalidated by a new publication of navitia, as the base schedule may have changed
+        return '|'.join(['kirin.gtfs_rt.entity_fingerprints', self.contributor or '', str(self.instance_data_pub_date)])
+
+    def _filter_changed_entities(self, entities):
+        """
+        return the entities whose trip_update is not the same as in the last feed handled for the contributor:
+        the unchanged trip_updates are already in the db, there is no need to search their vjs and to merge them again
+        """
+        # the fingerprints are computed before the build, as it modifies the stop_sequence of the entities
+        fingerprints = {_entity_key(e): _entity_fingerprint(e) for e in entities}
+        try:
+            previous_fingerprints = redis.hgetall(self._fingerprints_key())
+        except Exception:
+            # without the fingerprints, all the entities are handled
+            self.log.exception('impossible to get the fingerprints of the entities of {}'.format(self.contributor))
+            previous_fingerprints = {}
+        changed_entities = []
+        for e in entities:
+            key = _entity_key(e)
+            if previous_fingerprints.get(key) == fingerprints[key]:
+                # the unchanged entities are kept for the next feed
+                self.entity_fingerprints[key] = fingerprints[key]
+            else:
+                self.changed_entity_fingerprints[key] = fingerprints[key]
+                changed_entities.append(e)
+        return changed_entities
+
+    def save_entity_fingerprints(self):
+        """
+        replace the fingerprints of the contributor by those of the handled feed
+        (only the entities that gave trip_updates are recorded)
+        """
+        if not self.entity_fingerprints:
+            return
+        key = self._fingerprints_key()
+        try:
+            pipe = redis.pipeline()
+            pipe.delete(key)
+            pipe.hmset(key, self.entity_fingerprints)
+            pipe.expire(key, app.config['GTFS_RT_ENTITY_FINGERPRINT_TIMEOUT'])
+            pipe.execute()
+        except Exception:
+            # the next feed will be entirely handled
+            self.log.exception('impossible to save the fingerprints of the entities of {}'.format(self.contributor))
+
     def _get_stop_code(self, nav_stop):
         for c in nav_stop.get('codes', []):
             if c['type'] == self.stop_code_key:
                 return c['value']
 
-    def _make_trip_updates(self, input_trip_update, data_time):
+    def _make_trip_updates(self, input_trip_update, vjs, data_time):
         """
         If trip_update.stop_time_updates is not a strict ending subset of vj.stop_times we reject the trip update
         On the other hand:
@@ -141,7 +231,6 @@ class KirinModelBuilder(object):
         2. For the first stop point absent in trip_update.stop_time_updates we create a stop_time_update
         with no delay for that stop
         """
-        vjs = self._get_navitia_vjs(input_trip_update.trip, data_time=data_time)
         trip_updates = []
         for vj in vjs:
             trip_update = model.TripUpdate(vj=vj)
@@ -195,15 +284,29 @@ class KirinModelBuilder(object):
         """
         return '{}.{}.{}'.format(self.__class__, self.navitia.url, self.instance_data_pub_date)
 
-    @app.cache.memoize(timeout=1200)
-    def _make_db_vj(self, vj_source_code, since, until):
-        navitia_vjs = self.navitia.vehicle_journeys(q={
+    def _make_vj_query(self, vj_source_code, since, until):
+        return {
             'filter': 'vehicle_journey.has_code({}, {})'.format(self.stop_code_key, vj_source_code),
             'since': to_str(since),
             'until': to_str(until),
             'depth': '2',  # we need this depth to get the stoptime's stop_area
-        })
+        }
 
+    def _make_db_vj(self, vj_source_code, since, until):
+        key = self._vj_cache_key(vj_source_code, since, until)
+        vjs = app.cache.get(key)
+        if vjs is None:
+            navitia_vjs = base_schedule.get_vjs(self.navitia, 'source', vj_source_code,
+                                                q=self._make_vj_query(vj_source_code, since, until),
+                                                pub_date=self.instance_data_pub_date)
+            vjs = self._make_vjs(vj_source_code, navitia_vjs, since, until)
+            app.cache.set(key, vjs, timeout=VJ_CACHE_TIMEOUT)
+        return vjs
+
+    def _make_vjs(self, vj_source_code, navitia_vjs, since, until):
+        """
+        make the kirin vj from the navitia vjs found for vj_source_code on [since, until]
+        """
         if not navitia_vjs:
             self.log.info('impossible to find vj {t} on [{s}, {u}]'
                           .format(t=vj_source_code,
@@ -262,11 +365,78 @@ class KirinModelBuilder(object):
             record_internal_failure('Error while creating kirin VJ', contributor=self.contributor)
             return []
 
+    def _get_period(self, data_time):
+        since = floor_datetime(data_time - self.period_filter_tolerance)
+        until = floor_datetime(data_time + self.period_filter_tolerance + datetime.timedelta(hours=1))
+        return since, until
+
+    def _vj_cache_key(self, vj_source_code, since, until):
+        # the key of the kirin vjs of vj_source_code in the cache of _make_db_vj
+        # (the repr of the model builder holds the navitia instance and its publication date)
+        return 'gtfs_rt.vjs|{}|{}|{}|{}'.format(repr(self), vj_source_code, to_str(since), to_str(until))
+
+    def _prefetch_navitia_vjs(self, vj_source_codes, data_time, batch_size):
+        """
+        search the vjs of several trips in navitia with a few calls (by pages of batch_size codes)
+        and put them in the cache of _make_db_vj, to avoid one navitia call by trip
+
+        the codes already in the cache or in the base schedule store are skipped
+        """
+        since, until = self._get_period(data_time)
+        codes = []
+        seen = set()
+        for code in vj_source_codes:
+            if code in seen:
+                continue
+            seen.add(code)
+            if app.cache.get(self._vj_cache_key(code, since, until)) is not None:
+                continue
+            if base_schedule.get_stored_vjs(self.navitia, 'source', code, self._make_vj_query(code, since, until),
+                                           pub_date=self.instance_data_pub_date) is not None:
+                continue
+            codes.append(code)
+
+        def search_page(page):
+            # a code can match several vjs (and the vjs are detected as duplicates),
+            # so we ask for more vjs than codes to detect the truncated responses
+            count = 2 * len(page)
+            navitia_vjs = self.navitia.vehicle_journeys(q={
+                'filter': ' or '.join('vehicle_journey.has_code({}, {})'.format(self.stop_code_key, c)
+                                      for c in page),
+                'since': to_str(since),
+                'until': to_str(until),
+                'depth': '2',  # we need this depth to get the stoptime's stop_area
+                'show_codes': 'true',  # we need the codes to dispatch the vjs on the trips
+                'count': str(count),
+            })
+            return page, navitia_vjs, len(navitia_vjs) < count
+
+        # the pages are searched concurrently
+        pages = [codes[i:i + batch_size] for i in range(0, len(codes), batch_size)]
+        for page, navitia_vjs, is_complete in navitia_concurrent_map(self.navitia, search_page, pages):
+            if not is_complete:
+                # any vj of the page may have a duplicate (or be) in the missing part of the response:
+                # nothing is kept from this page, its trips will be searched alone
+                self.log.debug('truncated response for the vjs of {}'.format(page))
+                continue
+            vjs_by_code = {code: [] for code in page}
+            for nav_vj in navitia_vjs:
+                for c in nav_vj.get('codes', []):
+                    if c.get('type') == self.stop_code_key and c.get('value') in vjs_by_code:
+                        vjs_by_code[c['value']].append(nav_vj)
+
+            for code, code_vjs in vjs_by_code.items():
+                code_vjs = base_schedule.store_vjs(self.navitia, 'source', code,
+                                                   self._make_vj_query(code, since, until), code_vjs,
+                                                   pub_date=self.instance_data_pub_date)
+                app.cache.set(self._vj_cache_key(code, since, until),
+                              self._make_vjs(code, code_vjs, since, until),
+                              timeout=VJ_CACHE_TIMEOUT)
+
     def _get_navitia_vjs(self, trip, data_time):
         vj_source_code = trip.trip_id
 
-        since = floor_datetime(data_time - self.period_filter_tolerance)
-        until = floor_datetime(data_time + self.period_filter_tolerance + datetime.timedelta(hours=1))
+        since, until = self._get_period(data_time)
         self.log.debug('searching for vj {} on [{}, {}] in navitia'.format(vj_source_code, since, until))
 
         return self._make_db_vj(vj_source_code, since, until)
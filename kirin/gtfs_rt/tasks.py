@@ -30,12 +30,13 @@
 # www.navitia.io
 
 import logging
+import time
+import zlib
 import requests
 from kirin import gtfs_realtime_pb2
-import navitia_wrapper
-from kirin.tasks import celery
+from kirin.tasks import celery, get_navitia_wrapper
 from kirin.utils import should_retry_exception, make_kirin_lock_name, get_lock, manage_db_error, \
-    manage_db_no_new
+    manage_db_no_new, manage_db_identical
 from kirin.gtfs_rt import model_maker
 from retrying import retry
 from kirin import app, redis
@@ -52,32 +53,153 @@ class InvalidFeed(Exception):
     pass
 
 
-def _is_newer(config):
-    logger = logging.LoggerAdapter(logging.getLogger(__name__), extra={'contributor': config['contributor']})
-    contributor = config['contributor']
+# a session by feed url, to reuse its connections from one polling to the next
+_sessions = {}
+
+
+def _get_session(feed_url):
+    session = _sessions.get(feed_url)
+    if session is None:
+        session = _sessions[feed_url] = requests.Session()
+        # the feeds are decompressed by requests
+        session.headers['Accept-Encoding'] = 'gzip'
+    return session
+
+
+def _get_next_polling_key(contributor):
+    return '|'.join([contributor, 'polling_next'])
+
+
+def _get_cadence_keys(contributor):
+    return '|'.join([contributor, 'polling_interval']), '|'.join([contributor, 'polling_last_change'])
+
+
+def _is_adaptive(feed):
+    return feed.get('max_poll_interval') > feed['poll_interval']
+
+
+def get_due_feeds(feeds, now=None):
+    """
+    return the feeds to poll now, and plan their next polling poll_interval seconds later
+    (or the poll interval learned for the adaptive feeds, see adapt_poll_interval)
+
+    the first polling of a feed is delayed by a part of its poll_interval (depending on its contributor),
+    so that the feeds with the same poll_interval are not all polled on the same second
+    If Redis get/set fail, all the feeds are polled
+    """
+    now = now if now is not None else time.time()
+    try:
+        keys = [_get_next_polling_key(f['contributor']) for f in feeds] + \
+               [_get_cadence_keys(f['contributor'])[0] for f in feeds]
+        values = redis.mget(*keys)
+    except Exception as e:
+        logging.getLogger(__name__).debug('exception occurred when getting the next pollings of gtfs: %s', str(e))
+        return feeds
+
+    due_feeds = []
+    plannings = {}
+    for feed, next_polling, learned_interval in zip(feeds, values[:len(feeds)], values[len(feeds):]):
+        interval = feed['poll_interval']
+        if next_polling is None:
+            next_polling = now + zlib.crc32(feed['contributor'].encode('utf-8')) % interval if interval > 1 else now
+        if now >= float(next_polling):
+            due_feeds.append(feed)
+            if _is_adaptive(feed) and learned_interval is not None:
+                interval = float(learned_interval)
+                # the requests saved compared to a polling every poll_interval seconds
+                new_relic.record_custom_event('kirin_gtfs_rt_polling',
+                                              {'contributor': feed['contributor'],
+                                               'poll_interval': interval,
+                                               'saved_requests': int(interval / feed['poll_interval']) - 1})
+            next_polling = now + interval
+        plannings[_get_next_polling_key(feed['contributor'])] = next_polling
     try:
-        head = requests.head(config['feed_url'], timeout=config.get('timeout', 1))
+        pipe = redis.pipeline()
+        for key, next_polling in plannings.items():
+            # the planning of a removed feed expires
+            pipe.set(key, next_polling, ex=max(int(next_polling - now), 1) * 2)
+        pipe.execute()
+    except Exception as e:
+        logging.getLogger(__name__).debug('exception occurred when planning the pollings of gtfs: %s', str(e))
+    return due_feeds
+
+
+def adapt_poll_interval(config, feed_timestamp=None, now=None):
+    """
+    learn the update cadence of an adaptive feed (with a max_poll_interval greater than its poll_interval)
+
+    feed_timestamp is the header timestamp of the received feed, None if the feed did not change (304)
+    * when the feed changed, the producer is considered to publish a feed every (time since the last change),
+      the feed is then polled twice as often
+    * when it did not change, the poll interval is increased by half
+    the poll interval is kept between poll_interval and max_poll_interval
+    """
+    if not _is_adaptive(config):
+        return
+    now = now if now is not None else time.time()
+    interval_key, last_change_key = _get_cadence_keys(config['contributor'])
+    try:
+        interval, last_change = redis.mget(interval_key, last_change_key)
+        interval = float(interval) if interval is not None else config['poll_interval']
+        if feed_timestamp is not None:
+            # a feed without timestamp is considered as new
+            change = feed_timestamp or now
+            if last_change is None or float(last_change) != change:
+                if last_change is not None:
+                    interval = (change - float(last_change)) / 2.
+                redis.set(last_change_key, change)
+            else:
+                interval *= 1.5
+        else:
+            interval *= 1.5
+        interval = min(max(interval, config['poll_interval']), config['max_poll_interval'])
+        redis.set(interval_key, interval, ex=int(config['max_poll_interval']) * 10)
+    except Exception as e:
+        logging.getLogger(__name__).debug('exception occurred when adapting the poll interval of gtfs for %s: %s',
+                                          config['contributor'], str(e))
 
-        new_etag = head.headers.get("ETag")
-        if not new_etag:
-            return True  # unable to get a ETag, we continue the polling
 
-        etag_key = '|'.join([contributor, 'polling_HEAD'])
-        old_etag = redis.get(etag_key)
+def _get_validators_keys(contributor):
+    return '|'.join([contributor, 'polling_HEAD']), '|'.join([contributor, 'polling_Last-Modified'])
 
-        if new_etag == old_etag:
-            logger.info('get the same ETag of %s, skipping the polling for %s',
-                        etag_key,
-                        contributor)
-            return False
 
-        redis.set(etag_key, new_etag)
+def _get_feed(config):
+    """
+    conditional GET of the feed, with the ETag and Last-Modified of the last received feed
 
+    return None if the feed did not change (304)
+    If Redis get/set fail, we just do a plain GET
+    """
+    logger = logging.LoggerAdapter(logging.getLogger(__name__), extra={'contributor': config['contributor']})
+    contributor = config['contributor']
+    etag_key, last_modified_key = _get_validators_keys(contributor)
+    headers = {}
+    try:
+        etag, last_modified = redis.mget(etag_key, last_modified_key)
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+    except Exception as e:
+        logger.debug('exception occurred when getting the validators of gtfs for %s: %s', contributor, str(e))
+
+    response = _get_session(config['feed_url']).get(config['feed_url'], headers=headers,
+                                                    timeout=config.get('timeout', 1))
+    if response.status_code == 304:
+        logger.info('the feed of %s is not modified, skipping the polling', contributor)
+        return None
+    response.raise_for_status()
+
+    try:
+        for key, header in ((etag_key, 'ETag'), (last_modified_key, 'Last-Modified')):
+            value = response.headers.get(header)
+            if value:
+                redis.set(key, value)
+            else:
+                redis.delete(key)
     except Exception as e:
-        logger.debug('exception occurred when checking the newer version of gtfs for %s: %s',
-                     contributor,
-                     str(e))
-    return True  # whatever the exception is, we don't want to break the polling
+        logger.debug('exception occurred when setting the validators of gtfs for %s: %s', contributor, str(e))
+    return response
 
 
 @celery.task(bind=True)
@@ -96,38 +218,38 @@ def gtfs_poller(self, config):
             new_relic.ignore_transaction()
             return
 
-        # We do a HEAD request at the very beginning of polling and we compare it with the previous one to check if
-        # the gtfs-rt is changed.
-        # If the HEAD request or Redis get/set fail, we just ignore this part and do the polling anyway
-        if not _is_newer(config):
-            new_relic.ignore_transaction()
-            manage_db_no_new(connector='gtfs-rt', contributor=contributor)
-            return
-
+        # the gtfs-rt is only sent back if it changed since the last polling (304 otherwise)
         try:
-            response = requests.get(config['feed_url'], timeout=config.get('timeout', 1))
-            response.raise_for_status()
-
+            response = _get_feed(config)
         except Exception as e:
             manage_db_error(data='', connector='gtfs-rt', contributor=contributor,
                             status='KO', error='Http Error')
             logger.debug(str(e))
             return
 
-        nav = navitia_wrapper.Navitia(url=config['navitia_url'],
-                                      token=config['token'],
-                                      timeout=5,
-                                      cache=redis,
-                                      query_timeout=app.config.get('NAVITIA_QUERY_CACHE_TIMEOUT', 600),
-                                      pubdate_timeout=app.config.get('NAVITIA_PUBDATE_CACHE_TIMEOUT', 600))\
-            .instance(config['coverage'])
+        if response is None:
+            new_relic.ignore_transaction()
+            adapt_poll_interval(config)
+            manage_db_no_new(connector='gtfs-rt', contributor=contributor)
+            return
+
+        # the feed is hashed before being parsed, an identical feed has no new trip update to handle
+        if manage_db_identical(response.content, connector='gtfs-rt', contributor=contributor):
+            new_relic.ignore_transaction()
+            adapt_poll_interval(config)
+            logger.info('identical feed for %s, skipping the polling', contributor)
+            return
+
+        nav = get_navitia_wrapper(config)
 
         proto = gtfs_realtime_pb2.FeedMessage()
         try:
             proto.ParseFromString(response.content)
         except DecodeError:
-            manage_db_error(proto, 'gtfs-rt', contributor=contributor, status='KO', error='Decode Error')
+            manage_db_error(response.content, 'gtfs-rt', contributor=contributor, status='KO',
+                            error='Decode Error')
             logger.debug('invalid protobuf')
         else:
-            model_maker.handle(proto, nav, contributor)
+            adapt_poll_interval(config, feed_timestamp=proto.header.timestamp)
+            model_maker.handle(proto, nav, contributor, raw_proto=response.content)
             logger.info('%s for %s is finished', func_name, contributor)
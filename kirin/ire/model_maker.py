@@ -28,10 +28,11 @@
 # IRC #navitia on freenode
 # https://groups.google.com/d/forum/navitia
 # www.navitia.io
+import io
 import itertools
 import logging
-from datetime import datetime
-from dateutil import parser
+import re
+from datetime import datetime, timedelta
 from flask.globals import current_app
 
 from kirin.abstract_sncf_model_maker import AbstractSNCFKirinModelBuilder, get_navitia_stop_time_sncf
@@ -40,7 +41,7 @@ from kirin.core import model
 # http://effbot.org/zone/celementtree.htm
 import xml.etree.cElementTree as ElementTree
 from kirin.exceptions import InvalidArguments
-from kirin.utils import record_internal_failure
+from kirin.utils import record_internal_failure, parse_dmy_datetime
 
 
 def get_node(elt, xpath, nullable=False):
@@ -63,7 +64,10 @@ def get_value(elt, xpath, nullable=False):
 def as_date(s):
     if s is None:
         return None
-    return parser.parse(s, dayfirst=True, yearfirst=False)
+    return parse_dmy_datetime(s)
+
+
+_DURATION_RE = re.compile(r'^(\d{1,2}):(\d{2})$')
 
 
 def as_duration(s):
@@ -73,12 +77,18 @@ def as_duration(s):
 
     >>> as_duration("12:45")
     datetime.timedelta(0, 45900)
+    >>> as_duration("2:05")
+    datetime.timedelta(0, 7500)
     >>> as_duration("bob")
     Traceback (most recent call last):
     ValueError: time data 'bob' does not match format '%H:%M'
     """
     if s is None:
         return None
+    match = _DURATION_RE.match(s)
+    if match is not None and int(match.group(1)) < 24 and int(match.group(2)) < 60:
+        return timedelta(hours=int(match.group(1)), minutes=int(match.group(2)))
+    # the unexpected formats are handled (or rejected) by strptime
     d = datetime.strptime(s, '%H:%M')
     return d - datetime.strptime('00:00', '%H:%M')
 
@@ -100,30 +110,107 @@ def get_navitia_stop_time(navitia_vj, stop_id):
     return nav_st
 
 
+# the children of a point (PointAval or PointSupprime) needed to build its stop time update
+_POINT_USED_TAGS = frozenset(['CRPR', 'CIPR', 'CHPR', 'IndicateurPRGare', 'MotifExterne', 'TypeHoraire'])
+
+# the element of the TypeModification under which each kind of point is considered by the builder
+_POINT_PARENT_TAGS = {'PointAval': 'HoraireProjete', 'PointSupprime': 'Suppression'}
+
+
+def _add_station(stations, point):
+    """
+    add the point to the stations if it is a station, with only the children needed to build its stop time update
+    the children of the other points are freed, since they are not considered by the builder
+
+    Note: the points without IndicateurPRGare are kept for the builder to report them as invalid
+    """
+    is_station = point.findtext('IndicateurPRGare')
+    if is_station is not None and not as_bool(is_station):
+        point.clear()
+        return
+    point[:] = [child for child in point if child.tag in _POINT_USED_TAGS]
+    stations.append(point)
+
+
+class IREMessage(object):
+    """
+    an IRE message parsed by KirinModelBuilder.parse:
+        * root is the InfoRetard element, its points have been emptied (or pruned for the stations)
+        * downstream_points are the stations of the delay (PointAval)
+        * deleted_points are the stations of the removal (PointSupprime)
+    """
+    def __init__(self, root, downstream_points, deleted_points):
+        self.root = root
+        self.downstream_points = downstream_points
+        self.deleted_points = deleted_points
+
+
 class KirinModelBuilder(AbstractSNCFKirinModelBuilder):
 
     def __init__(self, nav, contributor=None):
         super(KirinModelBuilder, self).__init__(nav, contributor)
 
-    def build(self, rt_update):
+    @staticmethod
+    def parse(raw_data):
         """
-        parse raw xml in the rt_update object
-        and return a list of trip updates
+        parse the IRE raw xml in one pass and return an IREMessage
 
-        The TripUpdates are not yet associated with the RealTimeUpdate
+        the points (the bulk of a big message) are gathered as soon as they are parsed,
+        and only the content needed by the builder is kept
+        like in the builder, only the PointAval of the delay (the first TypeModification/HoraireProjete)
+        and the PointSupprime of the removal (the first TypeModification/Suppression) are gathered
         """
+        if isinstance(raw_data, unicode):
+            raw_data = raw_data.encode('utf-8')
+        stations_by_tag = {'PointAval': [], 'PointSupprime': []}
+        # the TypeModification, HoraireProjete and Suppression considered by the builder, by tag
+        scopes = {}
+        # the elements being parsed, from the root
+        path = []
         try:
-            root = ElementTree.fromstring(rt_update.raw_data)
+            # the 'start' events track the parents of the points, which are complete at their 'end' event
+            events = ElementTree.iterparse(io.BytesIO(raw_data), events=('start', 'end'))
+            for event, elt in events:
+                if event == 'start':
+                    if elt.tag == 'TypeModification' and len(path) == 1 or \
+                            elt.tag in ('HoraireProjete', 'Suppression') and path and \
+                            path[-1] is scopes.get('TypeModification'):
+                        scopes.setdefault(elt.tag, elt)
+                    path.append(elt)
+                    continue
+                path.pop()
+                stations = stations_by_tag.get(elt.tag)
+                if stations is None:
+                    continue
+                scope = scopes.get(_POINT_PARENT_TAGS[elt.tag])
+                if scope is not None and any(parent is scope for parent in path):
+                    _add_station(stations, elt)
+                else:
+                    # the points elsewhere are not considered by the builder
+                    elt.clear()
+            root = events.root
         except ElementTree.ParseError as e:
             raise InvalidArguments("invalid xml: {}".format(e.message))
 
         if root.tag != 'InfoRetard':
             raise InvalidArguments('{} is not a valid xml root, it must be "InfoRetard"'.format(root.tag))
+        return IREMessage(root, stations_by_tag['PointAval'], stations_by_tag['PointSupprime'])
+
+    def build(self, rt_update, data=None):
+        """
+        parse raw xml in the rt_update object
+        and return a list of trip updates
+        data is the IREMessage already parsed (see parse), to avoid parsing again the raw xml
+
+        The TripUpdates are not yet associated with the RealTimeUpdate
+        """
+        ire_message = data if data is not None else self.parse(rt_update.raw_data)
+        root = ire_message.root
 
         vjs = self._get_vjs(get_node(root, 'Train'))
 
         # TODO handle also root[DernierPointDeParcoursObserve] in the modification
-        trip_updates = [self._make_trip_update(vj, get_node(root, 'TypeModification')) for vj in vjs]
+        trip_updates = [self._make_trip_update(vj, get_node(root, 'TypeModification'), ire_message) for vj in vjs]
 
         return trip_updates
 
@@ -137,9 +224,10 @@ class KirinModelBuilder(AbstractSNCFKirinModelBuilder):
 
         return self._get_navitia_vjs(train_numbers, vj_start, vj_end)
 
-    def _make_trip_update(self, vj, xml_modification):
+    def _make_trip_update(self, vj, xml_modification, ire_message):
         """
         create the TripUpdate object
+        the points are the stations gathered in ire_message
         """
         trip_update = model.TripUpdate(vj=vj)
         trip_update.contributor = self.contributor
@@ -147,11 +235,11 @@ class KirinModelBuilder(AbstractSNCFKirinModelBuilder):
         delay = xml_modification.find('HoraireProjete')
         if delay:
             trip_update.status = 'update'
-            for downstream_point in delay.iter('PointAval'):
+            for downstream_point in ire_message.downstream_points:
                 # we need only to consider the station
                 if not as_bool(get_value(downstream_point, 'IndicateurPRGare')):
                     continue
-                nav_st, log_dict = self._get_navitia_stop_time(downstream_point, vj.navitia_vj)
+                nav_st, log_dict = self._get_navitia_stop_time(downstream_point, vj)
                 if log_dict:
                     record_internal_failure(log_dict['log'], contributor=self.contributor)
                     log_dict.update({'contributor': self.contributor})
@@ -180,13 +268,13 @@ class KirinModelBuilder(AbstractSNCFKirinModelBuilder):
                 # it's a partial delete
                 trip_update.status = 'update'
                 deleted_points = itertools.chain([removal.find('PRDebut')],
-                                                 removal.iter('PointSupprime'),
+                                                 ire_message.deleted_points,
                                                  [removal.find('PRFin')])
                 for deleted_point in deleted_points:
                     # we need only to consider the stations
                     if not as_bool(get_value(deleted_point, 'IndicateurPRGare')):
                         continue
-                    nav_st, log_dict = self._get_navitia_stop_time(deleted_point, vj.navitia_vj)
+                    nav_st, log_dict = self._get_navitia_stop_time(deleted_point, vj)
                     if log_dict:
                         record_internal_failure(log_dict['log'], contributor=self.contributor)
                         log_dict.update({'contributor': self.contributor})
@@ -216,19 +304,19 @@ class KirinModelBuilder(AbstractSNCFKirinModelBuilder):
         return trip_update
 
     @staticmethod
-    def _get_navitia_stop_time(downstream_point, nav_vj):
+    def _get_navitia_stop_time(downstream_point, vj):
         """
         get a navitia stop from an xml node
         the xml node MUST contains a CR, CI, CH tags
 
-        it searchs in the vj's stops for a stop_area with the external code
+        it searchs in the vj's stops (indexed by code) for a stop_area with the external code
         CR-CI-CH
         we also return error messages as 'missing stop point', 'duplicate stops'
         """
         return get_navitia_stop_time_sncf(cr=get_value(downstream_point, 'CRPR'),
                                           ci=get_value(downstream_point, 'CIPR'),
                                           ch=get_value(downstream_point, 'CHPR'),
-                                          nav_vj=nav_vj)
+                                          vj=vj)
 
     @staticmethod
     def _get_delay(xml):
@@ -28,35 +28,75 @@
 # IRC #navitia on freenode
 # https://groups.google.com/d/forum/navitia
 # www.navitia.io
-from kombu import BrokerConnection, Exchange, Queue, Consumer, Producer
+from kombu import BrokerConnection, Exchange, Queue, Consumer
 from kombu.pools import producers, connections
 import logging
 from amqp.exceptions import ConnectionForced
 import gevent
-from retrying import retry
 import retrying
 from kirin import task_pb2
 from google.protobuf.message import DecodeError
 import socket
 from kirin.core.model import TripUpdate, db
-from kirin.core.populate_pb import convert_to_gtfsrt
+from kirin.core.populate_pb import convert_to_gtfsrt, serialize_entity, serialize_feed
 import gtfs_realtime_pb2
 from kirin.utils import str_to_date, record_call
 from socket import error
 import time
+import itertools
+import weakref
 from datetime import datetime
 from kombu.mixins import ConsumerProducerMixin
 
 
+# nb of rows fetched at once when streaming the trip updates (with a server side cursor)
+STREAM_PAGE_SIZE = 1000
+
+
+def iter_serialized_entities(contributors, begin_date, end_date):
+    """
+    yield the serialized entities of the trip updates of the contributors on the period
+    the cached entities are streamed from the db, only the missing ones are built from the trip updates
+    """
+    missing_vj_ids = []
+    query = TripUpdate.find_pb_entities_by_contributor_period(contributors, begin_date, end_date)
+    for vj_id, pb_entity in query.yield_per(STREAM_PAGE_SIZE):
+        if pb_entity is None:
+            missing_vj_ids.append(vj_id)
+        else:
+            yield pb_entity
+    for i in range(0, len(missing_vj_ids), STREAM_PAGE_SIZE):
+        page = missing_vj_ids[i:i + STREAM_PAGE_SIZE]
+        for trip_update in TripUpdate.query.filter(TripUpdate.vj_id.in_(page)):
+            yield serialize_entity(trip_update)
+
+
+def iter_chunks(iterable, chunk_size):
+    """
+    yield lists of chunk_size elements of iterable (the last one can be shorter)
+    if chunk_size is 0, everything is yielded in one list
+    at least one list is yielded (empty if iterable is empty)
+    """
+    iterator = iter(iterable)
+    chunk = list(itertools.islice(iterator, chunk_size or None))
+    while True:
+        yield chunk
+        chunk = list(itertools.islice(iterator, chunk_size or None))
+        if not chunk:
+            return
+
+
 class RTReloader(ConsumerProducerMixin):
     """
     ConsumerProducerMixin: a RPC model
     """
-    def __init__(self, connection, rpc_queue, exchange, max_retries):
+    def __init__(self, connection, rpc_queue, exchange, max_retries, chunk_size=0):
         self.connection = connection
         self.rpc_queue = rpc_queue
         self.exchange = exchange
         self.max_retries = max_retries
+        # max nb of trip updates in a message of the full feed, 0 for a single message
+        self.chunk_size = chunk_size
 
     def get_consumers(self, Consumer, channel):
         return [Consumer(
@@ -100,49 +140,145 @@ class RTReloader(ConsumerProducerMixin):
             if hasattr(task.load_realtime, "end_date"):
                 if task.load_realtime.end_date:
                     end_date = str_to_date(task.load_realtime.end_date)
-            feed = convert_to_gtfsrt(TripUpdate.find_by_contributor_period(task.load_realtime.contributors,
-                                                                           begin_date,
-                                                                           end_date),
-                                     gtfs_realtime_pb2.FeedHeader.FULL_DATASET)
-
-            feed_str = feed.SerializeToString()
-            log.info('Starting of full feed publication {}, {}'.format(len(feed_str), task), extra={'size': len(feed_str), 'task': task})
-            # http://docs.celeryproject.org/projects/kombu/en/latest/userguide/producers.html#bypassing-routing-by-using-the-anon-exchange
-            self.producer.publish(feed_str,
-                                  routing_key=task.load_realtime.queue_name,
-                                  retry=True,
-                                  retry_policy={
-                                      'interval_start': 0,  # First retry immediately,
-                                      'interval_step': 2,   # then increase by 2s for every retry.
-                                      'interval_max': 10,   # but don't exceed 10s between retries.
-                                      'max_retries':  self.max_retries,     # give up after 10 (by default) tries.
-                                      })
+            entities = iter_serialized_entities(task.load_realtime.contributors, begin_date, end_date)
+            size = 0
+            trip_update_count = 0
+            message_count = 0
+            # the entities are streamed, and published by chunks if a chunk_size is configured
+            # (so the memory needed does not depend on the size of the full feed)
+            for chunk in iter_chunks(entities, self.chunk_size):
+                feed = convert_to_gtfsrt([], gtfs_realtime_pb2.FeedHeader.FULL_DATASET)
+                feed_str = serialize_feed(feed, chunk)
+                log.info('Starting of full feed publication {}, {}'.format(len(feed_str), task),
+                         extra={'size': len(feed_str), 'task': task, 'chunk': message_count})
+                self._publish(feed_str, task.load_realtime.queue_name)
+                size += len(feed_str)
+                trip_update_count += len(chunk)
+                message_count += 1
             duration = (datetime.utcnow() - start_datetime).total_seconds()
             log.info('End of full feed publication', extra={'duration': duration, 'task': task})
-            record_call('Full feed publication', size=len(feed_str), routing_key=task.load_realtime.queue_name,
-                        duration=duration, trip_update_count=len(feed.entity),
+            record_call('Full feed publication', size=size, routing_key=task.load_realtime.queue_name,
+                        duration=duration, trip_update_count=trip_update_count, message_count=message_count,
                         contributor=task.load_realtime.contributors)
         finally:
             db.session.remove()
 
+    def _publish(self, feed_str, queue_name):
+        # http://docs.celeryproject.org/projects/kombu/en/latest/userguide/producers.html#bypassing-routing-by-using-the-anon-exchange
+        self.producer.publish(feed_str,
+                              routing_key=queue_name,
+                              retry=True,
+                              retry_policy={
+                                  'interval_start': 0,  # First retry immediately,
+                                  'interval_step': 2,   # then increase by 2s for every retry.
+                                  'interval_max': 10,   # but don't exceed 10s between retries.
+                                  'max_retries':  self.max_retries,     # give up after 10 (by default) tries.
+                                  })
+
+
+class PublishNacked(Exception):
+    """
+    the broker has rejected (basic.nack) some messages of a batch of publisher confirms
+    """
+    pass
+
+
+class PublishConfirms(object):
+    """
+    batched publisher confirms (a RabbitMQ extension) on a channel:
+    the acks of the broker are only waited for every batch_size messages
+    Note: the messages of a batch not yet confirmed when the channel is lost are not published again
+    Note: a nack is only known when the confirms are received, so the PublishNacked error is raised
+    on the publication that waits for the batch, not necessarily on the one that has been rejected
+    """
+    def __init__(self, channel, batch_size, timeout=10):
+        self.channel = channel
+        self.batch_size = batch_size
+        self.timeout = timeout  # in seconds
+        # the delivery tags of the messages are their index on the channel (starting at 1)
+        self.last_published = 0
+        self.last_acked = 0
+        self.nacked_count = 0  # nb of nacks received since the last check
+        channel.confirm_select()
+        channel.events['basic_ack'].add(self._on_ack)
+        channel.events['basic_nack'].add(self._on_nack)
+
+    def _on_ack(self, delivery_tag, multiple):
+        self.last_acked = max(self.last_acked, delivery_tag)
+
+    def _on_nack(self, delivery_tag, multiple):
+        # a nacked message is confirmed too, it will just never be delivered
+        self.last_acked = max(self.last_acked, delivery_tag)
+        self.nacked_count += 1
+
+    def on_publish(self):
+        self.last_published += 1
+        if self.last_published - self.last_acked >= self.batch_size:
+            self.wait()
+        self._check_nacks()
+
+    def wait(self):
+        # raise a socket.timeout if the broker does not confirm in time
+        while self.last_acked < self.last_published:
+            self.channel.connection.drain_events(timeout=self.timeout)
+        self._check_nacks()
+
+    def _check_nacks(self):
+        if self.nacked_count:
+            nacked_count, self.nacked_count = self.nacked_count, 0
+            raise PublishNacked('{} nack(s) received from the broker, up to message {} on the channel'
+                                .format(nacked_count, self.last_acked))
+
 
 class RabbitMQHandler(object):
-    def __init__(self, connection_string, exchange):
+    def __init__(self, connection_string, exchange, confirm_batch_size=0):
         self._connection = BrokerConnection(connection_string)
         self._connections = {self._connection}  # set of connection for the heartbeat
         self._exchange = Exchange(exchange, durable=True, delivry_mode=2, type='topic')
+        # 0 to disable the publisher confirms
+        self._confirm_batch_size = confirm_batch_size
+        self._confirms = weakref.WeakKeyDictionary()  # channel -> PublishConfirms
         monitor_heartbeats(self._connections)
 
-    @retry(wait_fixed=200, stop_max_attempt_number=3)
     def publish(self, item, contributor):
-        with self._connection.channel() as channel:
-            with Producer(channel) as producer:
-                producer.publish(item, exchange=self._exchange, routing_key=contributor, declare=[self._exchange])
+        """
+        the producers (and their connection) are kept in a pool, so the exchange is only declared once
+        per connection (kombu keeps track of the declared entities)
+        a lost connection (eg. detected by the heartbeat) is transparently revived by kombu
+        """
+        with producers[self._connection].acquire(block=True) as producer:
+            # the pooled connections are monitored by the heartbeat too
+            self._connections.add(producer.connection)
+            # the channel must be in confirm mode before publishing
+            confirms = self._get_confirms(producer.channel) if self._confirm_batch_size else None
+            producer.publish(item, exchange=self._exchange, routing_key=contributor, declare=[self._exchange],
+                             retry=True,
+                             retry_policy={
+                                 'interval_start': 0,  # First retry immediately,
+                                 'interval_step': 0.2,  # then increase by 0.2s for every retry.
+                                 'max_retries': 2,  # give up after 3 tries.
+                             })
+            if confirms is None:
+                return
+            if producer.channel is confirms.channel:
+                confirms.on_publish()
+            else:
+                # the channel has been revived by a retry, this message cannot be confirmed,
+                # but the next ones will be
+                self._get_confirms(producer.channel)
+
+    def _get_confirms(self, channel):
+        # a revived channel is a new one, with its own delivery tags
+        confirms = self._confirms.get(channel)
+        if confirms is None:
+            confirms = PublishConfirms(channel, self._confirm_batch_size)
+            self._confirms[channel] = confirms
+        return confirms
 
     def info(self):
         return self._connection.info()
 
-    def listen_load_realtime(self, queue_name, max_retries=10):
+    def listen_load_realtime(self, queue_name, max_retries=10, chunk_size=0):
         log = logging.getLogger(__name__)
 
         route = 'task.load_realtime.*'
@@ -151,29 +287,37 @@ class RabbitMQHandler(object):
         RTReloader(connection=self._connection,
                    rpc_queue=rt_queue,
                    exchange=self._exchange,
-                   max_retries=max_retries).run()
+                   max_retries=max_retries,
+                   chunk_size=chunk_size).run()
+
+
+# interval (in seconds) between two checks for a connection with heartbeat, when there is none yet
+NO_HEARTBEAT_CHECK_INTERVAL = 10
 
 
 def monitor_heartbeats(connections, rate=2):
     """
     launch the heartbeat of amqp, it's mostly for prevent the f@#$ firewall from droping the connection
     """
-    supports_heartbeats = False
-    interval = 10000
-    for conn in connections:
-        if conn.heartbeat and conn.supports_heartbeats:
-            supports_heartbeats = True
-            interval = min(conn.heartbeat / 2, interval)
-
-    if not supports_heartbeats:
-        logging.getLogger(__name__).info('heartbeat is not enabled')
-        return
+    def get_interval():
+        """
+        the interval is computed at each loop, as connections (from the producer pool) can be added later on
+        return None if no connection needs a heartbeat
+        """
+        heartbeats = [conn.heartbeat for conn in list(connections) if conn.heartbeat and conn.supports_heartbeats]
+        return min(heartbeats) / 2 if heartbeats else None
 
-    logging.getLogger(__name__).info('start rabbitmq monitoring')
+    if get_interval() is None:
+        logging.getLogger(__name__).info('heartbeat is not enabled (yet)')
+    else:
+        logging.getLogger(__name__).info('start rabbitmq monitoring')
 
     def heartbeat_check():
         to_remove = []
-        for conn in connections:
+        # the set of connections can be modified by the publications while a heartbeat_check yields
+        for conn in list(connections):
+            if not (conn.heartbeat and conn.supports_heartbeats):
+                continue
             logging.getLogger(__name__).debug('heartbeat_check for %s', conn)
             try:
                 conn.heartbeat_check(rate=rate)
@@ -183,11 +327,16 @@ def monitor_heartbeats(connections, rate=2):
                 to_remove.append(conn)
 
         for conn in to_remove:
-            connections.remove(conn)
+            connections.discard(conn)
 
     def loop():
         while True:
             try:
+                interval = get_interval()
+                if interval is None:
+                    # nothing to monitor for now, a connection with heartbeat might be added later
+                    gevent.sleep(NO_HEARTBEAT_CHECK_INTERVAL)
+                    continue
                 gevent.sleep(interval)
                 heartbeat_check()
             except Exception as e:
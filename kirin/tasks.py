@@ -37,15 +37,39 @@ from celery.signals import task_postrun, setup_logging
 from kirin.helper import make_celery
 
 from retrying import retry
-from kirin import app
+import navitia_wrapper
+from kirin import app, redis
+from kirin import base_schedule
+from kirin import new_relic
 import datetime
 from kirin.core.model import TripUpdate, RealTimeUpdate
-from utils import should_retry_exception, make_kirin_lock_name, get_lock
+from utils import should_retry_exception, make_kirin_lock_name, get_lock, get_gtfs_rt_feeds
 
 TASK_STOP_MAX_DELAY = app.config['TASK_STOP_MAX_DELAY']
 TASK_WAIT_FIXED = app.config['TASK_WAIT_FIXED']
 
 
+# a navitia wrapper by (navitia_url, token, coverage), to reuse its connections from one task to the next
+_navitia_wrappers = {}
+
+
+def get_navitia_wrapper(config):
+    """
+    return the navitia wrapper of the navitia_url, token and coverage of config
+    (the navitia responses are cached in redis)
+    """
+    key = (config['navitia_url'], config['token'], config['coverage'])
+    nav = _navitia_wrappers.get(key)
+    if nav is None:
+        nav = _navitia_wrappers[key] = navitia_wrapper.Navitia(
+            url=config['navitia_url'],
+            token=config['token'],
+            timeout=app.config.get('NAVITIA_TIMEOUT', 5),
+            cache=redis,
+            query_timeout=app.config.get('NAVITIA_QUERY_CACHE_TIMEOUT', 600),
+            pubdate_timeout=app.config.get('NAVITIA_PUBDATE_CACHE_TIMEOUT', 600)).instance(config['coverage'])
+    return nav
+
 
 
 
@@ -113,15 +137,70 @@ def purge_rt_update(self, config):
 
 
 
-from kirin.gtfs_rt.tasks import gtfs_poller
+@celery.task(bind=True)
+def base_schedule_warm_up(self, config):
+    """
+    warm up the base schedule store (see kirin.base_schedule) for a navitia instance,
+    if it has not yet been done for its current publication (or since the store has been emptied)
+    """
+    func_name = 'base_schedule_warm_up'
+    contributors = config['contributors']
+    logger = logging.LoggerAdapter(logging.getLogger(__name__), extra={'contributor': ', '.join(contributors)})
+
+    lock_name = make_kirin_lock_name(func_name, config['coverage'])
+    with get_lock(logger, lock_name, app.config['REDIS_LOCK_TIMEOUT_POLLER']) as locked:
+        if not locked:
+            logger.warning('%s for %s is already in progress', func_name, config['coverage'])
+            return
+
+        nav = get_navitia_wrapper(config)
+        if base_schedule.is_warm(nav):
+            return
+
+        start_datetime = datetime.datetime.utcnow()
+        nb_lookups, nb_hits = base_schedule.warm_up(nav)
+        log_dict = {'contributors': contributors,
+                    'coverage': config['coverage'],
+                    'nb_lookups': nb_lookups,
+                    'hit_ratio': float(nb_hits) / nb_lookups if nb_lookups else None,
+                    'duration': (datetime.datetime.utcnow() - start_datetime).total_seconds()}
+        new_relic.record_custom_event('kirin_base_schedule_warm_up', log_dict)
+        logger.info('base schedule warm up', extra=log_dict)
+
+
+@celery.task(bind=True)
+def warm_up_base_schedule(self):
+    """
+    warm up the base schedule store for the navitia instances of the contributors
+    (the warm up is only done at startup and after a new publication, see base_schedule_warm_up)
+    """
+    if not app.config.get('BASE_SCHEDULE_STORE_TIMEOUT'):
+        return
+    instances = {}
+    for contributor, navitia_url, coverage, token in [
+            (app.config.get('CONTRIBUTOR'), app.config.get('NAVITIA_URL'), app.config.get('NAVITIA_INSTANCE'),
+             app.config.get('NAVITIA_TOKEN')),
+            (app.config.get('COTS_CONTRIBUTOR'), app.config.get('NAVITIA_URL'), app.config.get('NAVITIA_INSTANCE'),
+             app.config.get('NAVITIA_TOKEN'))] + \
+            [(f['contributor'], f['navitia_url'], f['coverage'], f['token']) for f in get_gtfs_rt_feeds()]:
+        instances.setdefault((navitia_url, coverage, token), []).append(contributor)
+
+    for (navitia_url, coverage, token), contributors in instances.items():
+        base_schedule_warm_up.delay({'contributors': contributors,
+                                     'navitia_url': navitia_url,
+                                     'token': token,
+                                     'coverage': coverage})
+
+
+from kirin.gtfs_rt.tasks import gtfs_poller, get_due_feeds
 @celery.task(bind=True)
 def poller(self):
-    config = {'contributor': app.config.get('GTFS_RT_CONTRIBUTOR'),
-              'navitia_url': app.config.get('NAVITIA_URL'),
-              'token': app.config.get('NAVITIA_GTFS_RT_TOKEN'),
-              'coverage': app.config.get('NAVITIA_GTFS_RT_INSTANCE'),
-              'feed_url': app.config.get('GTFS_RT_FEED_URL')}
-    gtfs_poller.delay(config)
+    """
+    dispatch a gtfs_poller task for each gtfs-rt feed to poll (see GTFS_RT_FEEDS),
+    each feed is then polled independently of the others (with its own lock)
+    """
+    for config in get_due_feeds(get_gtfs_rt_feeds()):
+        gtfs_poller.delay(config)
 
 
 @celery.task(bind=True)
@@ -130,9 +209,10 @@ def purge_gtfs_trip_update(self):
     This task will remove ONLY TripUpdate, StoptimeUpdate and VehicleJourney that are created by gtfs-rt but the
     RealTimeUpdate are kept so that we can replay it for debug purpose. RealTimeUpdate will be remove by another task
     """
-    config = {'contributor': app.config.get('GTFS_RT_CONTRIBUTOR'),
-              'nb_days_to_keep': app.config.get('NB_DAYS_TO_KEEP_TRIP_UPDATE')}
-    purge_trip_update.delay(config)
+    for feed in get_gtfs_rt_feeds():
+        config = {'contributor': feed['contributor'],
+                  'nb_days_to_keep': app.config.get('NB_DAYS_TO_KEEP_TRIP_UPDATE')}
+        purge_trip_update.delay(config)
 
 
 @celery.task(bind=True)
@@ -28,10 +28,21 @@
 # IRC #navitia on freenode
 # https://groups.google.com/d/forum/navitia
 # www.navitia.io
+import datetime
+import functools
 import logging
-
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import re
+import sys
+
+import gevent
+import gevent.monkey
+import gevent.pool
 import pytz
+import six
 from aniso8601 import parse_date
+from dateutil import parser, tz
 from pythonjsonlogger import jsonlogger
 from flask.globals import current_app
 import navitia_wrapper
@@ -39,6 +50,7 @@ from kirin import new_relic
 from redis.exceptions import ConnectionError
 from contextlib import contextmanager
 from kirin.core import model
+from kirin.exceptions import SubServiceError
 
 
 def floor_datetime(datetime):
@@ -55,6 +67,56 @@ def str_to_date(value):
         return None
 
 
+_ISO_DATETIME_RE = re.compile(r'^(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})(?:(Z)|([+-])(\d{2}):?(\d{2}))?$')
+_DMY_DATETIME_RE = re.compile(r'^(\d{2})/(\d{2})/(\d{4}) (\d{2}):(\d{2}):(\d{2})$')
+# utc offset (in seconds) -> tzinfo
+_tz_offsets = {0: tz.tzutc()}
+
+
+def parse_iso_datetime(value):
+    """
+    parse a 'YYYY-MM-DDTHH:MM:SS+HHMM' datetime (like in COTS), a lot faster than dateutil
+    any other format is parsed by dateutil
+
+    >>> parse_iso_datetime('2018-11-02T12:15:00+0100')
+    datetime.datetime(2018, 11, 2, 12, 15, tzinfo=tzoffset(None, 3600))
+    >>> parse_iso_datetime('2018-11-02T12:15:00Z')
+    datetime.datetime(2018, 11, 2, 12, 15, tzinfo=tzutc())
+    >>> parse_iso_datetime('2018-11-02 12:15')
+    datetime.datetime(2018, 11, 2, 12, 15)
+    """
+    match = _ISO_DATETIME_RE.match(value)
+    if match is None:
+        return parser.parse(value, dayfirst=False, yearfirst=True, ignoretz=False)
+    year, month, day, hour, minute, second, utc, sign, tz_hours, tz_minutes = match.groups()
+    tzinfo = None
+    if utc:
+        tzinfo = _tz_offsets[0]
+    elif sign:
+        offset = (int(tz_hours) * 60 + int(tz_minutes)) * 60 * (-1 if sign == '-' else 1)
+        tzinfo = _tz_offsets.get(offset)
+        if tzinfo is None:
+            tzinfo = _tz_offsets[offset] = tz.tzoffset(None, offset)
+    return datetime.datetime(int(year), int(month), int(day), int(hour), int(minute), int(second), tzinfo=tzinfo)
+
+
+def parse_dmy_datetime(value):
+    """
+    parse a 'DD/MM/YYYY HH:MM:SS' datetime (like in IRE), a lot faster than dateutil
+    any other format is parsed by dateutil (day first)
+
+    >>> parse_dmy_datetime('21/09/2015 17:51:00')
+    datetime.datetime(2015, 9, 21, 17, 51)
+    >>> parse_dmy_datetime('21/09/2015 17:51')
+    datetime.datetime(2015, 9, 21, 17, 51)
+    """
+    match = _DMY_DATETIME_RE.match(value)
+    if match is None:
+        return parser.parse(value, dayfirst=True, yearfirst=False)
+    day, month, year, hour, minute, second = match.groups()
+    return datetime.datetime(int(year), int(month), int(day), int(hour), int(minute), int(second))
+
+
 class CustomJsonFormatter(jsonlogger.JsonFormatter):
     """
     jsonformatter with extra params
@@ -80,11 +142,104 @@ def make_navitia_wrapper():
     return navitia_wrapper.Navitia(url=url, token=token).instance(instance)
 
 
-def make_rt_update(data, connector, contributor, status='OK'):
+def get_gtfs_rt_feeds():
+    """
+    return the configurations of the polled gtfs-rt feeds (see GTFS_RT_FEEDS), completed with the default values
+    without GTFS_RT_FEEDS, the only feed is the one of GTFS_RT_CONTRIBUTOR
+    """
+    config = current_app.config
+    feeds = config.get('GTFS_RT_FEEDS') or [{'contributor': config.get('GTFS_RT_CONTRIBUTOR'),
+                                             'token': config.get('NAVITIA_GTFS_RT_TOKEN'),
+                                             'coverage': config.get('NAVITIA_GTFS_RT_INSTANCE'),
+                                             'feed_url': config.get('GTFS_RT_FEED_URL')}]
+    defaults = {'navitia_url': config.get('NAVITIA_URL'), 'token': None, 'timeout': 1, 'poll_interval': 1,
+                'max_poll_interval': config.get('GTFS_RT_MAX_POLL_INTERVAL', 0)}
+    result = []
+    for feed in feeds:
+        result.append(dict(defaults))
+        result[-1].update(feed)
+    return result
+
+
+# (navitia instance url, size, greenlets or threads) -> pool bounding the concurrent queries on this instance
+_navitia_pools = {}
+
+
+def _use_greenlets():
+    """
+    the greenlets only run concurrently (and their timeout is only enforced) on monkey patched sockets
+    """
+    return gevent.monkey.is_module_patched('socket')
+
+
+def _get_navitia_pool(navitia, size, use_greenlets):
+    key = (navitia.url, size, use_greenlets)
+    pool = _navitia_pools.get(key)
+    if pool is None:
+        # the pools are only created on their first use (so the threads are started after the fork of a worker)
+        pool = _navitia_pools[key] = gevent.pool.Pool(size) if use_greenlets else ThreadPool(size)
+    return pool
+
+
+def navitia_concurrent_map(navitia, func, items):
+    """
+    call func on each item (func is supposed to query the navitia instance of the wrapper navitia),
+    with at most NAVITIA_MAX_CONCURRENT_QUERIES concurrent calls on this instance (shared by all the callers)
+
+    return the results in the order of the items, the first exception (in the order of the items)
+    is raised once all the calls are done
+    """
+    items = list(items)
+    max_concurrency = current_app.config.get('NAVITIA_MAX_CONCURRENT_QUERIES', 1)
+    if max_concurrency <= 1 or len(items) <= 1:
+        return [func(i) for i in items]
+
+    app = current_app._get_current_object()
+    timeout = current_app.config.get('NAVITIA_CONCURRENT_QUERY_TIMEOUT')
+    use_greenlets = _use_greenlets()
+
+    def call(item):
+        # the greenlets and the threads do not inherit the flask context
+        with app.app_context():
+            try:
+                if not use_greenlets:
+                    return func(item), None
+                with gevent.Timeout(timeout, SubServiceError('navitia sub-service timeout')):
+                    return func(item), None
+            except Exception:
+                # the exception is raised by the caller (gevent would only print it)
+                return None, sys.exc_info()
+
+    pool = _get_navitia_pool(navitia, max_concurrency, use_greenlets)
+    if use_greenlets:
+        greenlets = [pool.spawn(call, i) for i in items]
+        gevent.joinall(greenlets)
+        calls = [g.get() for g in greenlets]
+    else:
+        # a blocking call cannot be interrupted in a thread: it is only not waited for after the timeout
+        # (counted from the end of the previous call waited for)
+        async_results = [pool.apply_async(call, (i,)) for i in items]
+        calls = []
+        for r in async_results:
+            try:
+                calls.append(r.get(timeout))
+            except multiprocessing.TimeoutError:
+                calls.append((None, (SubServiceError, SubServiceError('navitia sub-service timeout'), None)))
+    results = []
+    for res, exc_info in calls:
+        if exc_info:
+            six.reraise(*exc_info)
+        results.append(res)
+    return results
+
+
+def make_rt_update(data, connector, contributor, status='OK', binary_data=None):
     """
     Create an RealTimeUpdate object for the query and persist it
+    binary_data is a binary payload, stored compressed instead of data
     """
-    rt_update = model.RealTimeUpdate(data, connector=connector, contributor=contributor, status=status)
+    rt_update = model.RealTimeUpdate(data, connector=connector, contributor=contributor, status=status,
+                                     binary_raw_data=binary_data)
 
     model.db.session.add(rt_update)
     model.db.session.commit()
@@ -107,6 +262,39 @@ def record_call(status, **kwargs):
     new_relic.record_custom_event('kirin_status', params)
 
 
+def bounded_memoize(max_size):
+    """
+    process-wide memoization of a function called with hashable positional arguments
+
+    the cache is only meant for small values, cheap to recompute: it is simply flushed once full
+    """
+    def decorator(func):
+        cache = {}
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            try:
+                return cache[args]
+            except KeyError:
+                pass
+            if len(cache) >= max_size:
+                cache.clear()
+            res = cache[args] = func(*args)
+            return res
+
+        wrapper.cache = cache
+        return wrapper
+    return decorator
+
+
+@bounded_memoize(max_size=1000)
+def get_pytz_timezone(str_tz):
+    tz = pytz.timezone(str_tz)
+    if not tz:
+        raise Exception("impossible to find timezone: '{}'".format(str_tz))
+    return tz
+
+
 def get_timezone(stop_time):
     # TODO: we must use the coverage timezone, not the stop_area timezone, as they can be different.
     # We don't have this information now but we should have it in the near future
@@ -114,10 +302,40 @@ def get_timezone(stop_time):
     if not str_tz:
         raise Exception('impossible to convert local to utc without the timezone')
 
-    tz = pytz.timezone(str_tz)
-    if not tz:
-        raise Exception("impossible to find timezone: '{}'".format(str_tz))
-    return tz
+    return get_pytz_timezone(str_tz)
+
+
+@bounded_memoize(max_size=10000)
+def get_utc_offset(timezone, local_date):
+    """
+    get the UTC offset of a timezone for a whole local day
+    return None if the offset is not the same for the whole day (DST change)
+
+    >>> get_utc_offset(pytz.timezone('Europe/Paris'), datetime.date(2018, 6, 1))
+    datetime.timedelta(0, 7200)
+    >>> get_utc_offset(pytz.timezone('Europe/Paris'), datetime.date(2018, 3, 25))
+
+    """
+    day_start = datetime.datetime.combine(local_date, datetime.time.min)
+    day_end = datetime.datetime.combine(local_date, datetime.time.max)
+    offset = timezone.localize(day_start).utcoffset()
+    if timezone.localize(day_end).utcoffset() != offset:
+        return None
+    return offset
+
+
+def local_to_utc(local_dt, timezone):
+    """
+    convert a naive local datetime to a naive UTC datetime
+    (in the db dt with timezone cannot coexist with dt without tz,
+    since at the beginning there was dt without tz, we need to erase the tz info)
+
+    the offset of the day is used when there is no DST change this day, so it's only a subtraction
+    """
+    offset = get_utc_offset(timezone, local_dt.date())
+    if offset is not None:
+        return local_dt - offset
+    return timezone.localize(local_dt).astimezone(pytz.UTC).replace(tzinfo=None)
 
 
 def should_retry_exception(exception):
@@ -130,8 +348,8 @@ def make_kirin_lock_name(*args):
 
 
 def save_gtfs_rt_with_error(data, connector, contributor, status, error=None):
-    raw_data = str(data)
-    rt_update = make_rt_update(raw_data, connector=connector, contributor=contributor, status=status)
+    rt_update = make_rt_update(None, connector=connector, contributor=contributor, status=status,
+                               binary_data=str(data))
     rt_update.status = status
     rt_update.error = error
     model.db.session.add(rt_update)
@@ -160,7 +378,9 @@ def manage_db_error(data, connector, contributor, status, error=None):
     parameters: data, connector, contributor, status, error
     """
     last = model.RealTimeUpdate.get_last_rtu(connector, contributor)
-    if last and last.status == status and last.error == error and last.raw_data == str(data):
+    # the hashes are compared to avoid loading (and decompressing) the raw data of the last RealTimeUpdate
+    if last and last.status == status and last.error == error and \
+            last.content_hash == model.make_content_hash(str(data)):
         poke_updated_at(last)
     else:
         save_gtfs_rt_with_error(data, connector, contributor, status, error)
@@ -171,6 +391,22 @@ def manage_db_no_new(connector, contributor):
     poke_updated_at(last)
 
 
+def manage_db_identical(data, connector, contributor):
+    """
+    If SKIP_IDENTICAL_FEEDS is activated and the last RTUpdate of the contributor was successfully handled
+    with the same data, we just change its updated_at and return True: the data doesn't need to be handled again
+
+    parameters: data (the raw received payload), connector, contributor
+    """
+    if not current_app.config.get('SKIP_IDENTICAL_FEEDS'):
+        return False
+    last = model.RealTimeUpdate.get_last_rtu(connector, contributor)
+    if not last or last.status != 'OK' or last.content_hash != model.make_content_hash(data):
+        return False
+    poke_updated_at(last)
+    return True
+
+
 @contextmanager
 def get_lock(logger, lock_name, lock_timeout):
     from kirin import redis
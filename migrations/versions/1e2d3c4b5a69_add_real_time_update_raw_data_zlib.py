@@ -0,0 +1,24 @@
+"""
+Add the compressed binary raw data of real_time_update
+
+Revision ID: 1e2d3c4b5a69
+Revises: 4a1f3b9e2c7d
+Create Date: 2018-10-09 14:36:02.118345
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1e2d3c4b5a69'
+down_revision = '4a1f3b9e2c7d'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # the existing real_time_updates keep their raw_data as text
+    op.add_column('real_time_update', sa.Column('raw_data_zlib', sa.LargeBinary(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('real_time_update', 'raw_data_zlib')
@@ -0,0 +1,24 @@
+"""
+Add the serialized gtfs-rt entity of trip_update
+
+Revision ID: 4a1f3b9e2c7d
+Revises: 396958f93bb
+Create Date: 2018-10-02 10:12:45.431077
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4a1f3b9e2c7d'
+down_revision = '396958f93bb'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # NULL for the existing trip updates, the entity is then built from the trip update when needed
+    op.add_column('trip_update', sa.Column('pb_entity', sa.LargeBinary(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('trip_update', 'pb_entity')
@@ -0,0 +1,24 @@
+"""
+Add the hash of the raw data of real_time_update
+
+Revision ID: 5c0e9d8a7b16
+Revises: 1e2d3c4b5a69
+Create Date: 2018-10-11 10:12:45.503127
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5c0e9d8a7b16'
+down_revision = '1e2d3c4b5a69'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # the existing real_time_updates have no hash, they are never considered identical to a new payload
+    op.add_column('real_time_update', sa.Column('content_hash', sa.Text(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('real_time_update', 'content_hash')
@@ -30,7 +30,11 @@
 # www.navitia.io
 
 from __future__ import absolute_import, print_function, division
-from kirin.cots.model_maker import _retrieve_interesting_pdp
+
+import pytest
+
+from kirin.cots import model_maker
+from kirin.cots.model_maker import _retrieve_interesting_pdp, get_value
 
 
 def test_retrieve_interesting_pdp():
@@ -65,3 +69,35 @@ def test_retrieve_interesting_pdp():
          'horaireVoyageurDepart': {'dateHeure': '2018-09-01T12:08:00+0000'}},
         {'@id': '9th', 'typeArret': ''}]
     assert _retrieve_interesting_pdp(list_pdp) == [list_pdp[1], list_pdp[3], list_pdp[4], list_pdp[6]]
+
+
+@pytest.mark.parametrize('nb_pdp', [50, 500, 5000])
+def test_retrieve_interesting_pdp_scaling(nb_pdp, monkeypatch):
+    """
+    filtering of long itineraries where only the last stop_time has an arrival time
+
+    the search of a following arrival time used to be done for each stop_time without arrival time,
+    it is now computed once for all the stop_times, so the nb of lookups in the pdps must stay linear
+    with the number of pdps
+    """
+    list_pdp = [{'@id': str(i), 'typeArret': 'CH',
+                 'horaireVoyageurDepart': {'dateHeure': '2018-09-01T12:00:00+0000'}} for i in range(nb_pdp - 1)]
+    list_pdp.append({'@id': 'last', 'typeArret': 'CH',
+                     'horaireVoyageurArrivee': {'dateHeure': '2018-09-01T20:00:00+0000'}})
+    # a non-station point with an arrival time does not allow to hop off
+    list_pdp.insert(1, {'@id': 'not a station', 'typeArret': 'TOTO',
+                        'horaireVoyageurArrivee': {'dateHeure': '2018-09-01T12:01:00+0000'}})
+
+    calls = []
+
+    def counting_get_value(sub_json, key, nullable=False):
+        calls.append(key)
+        return get_value(sub_json, key, nullable)
+    monkeypatch.setattr(model_maker, 'get_value', counting_get_value)
+
+    res = _retrieve_interesting_pdp(list_pdp)
+
+    assert res == list_pdp[:1] + list_pdp[2:]
+    # with the former quadratic search, the lookups grew with the square of the number of pdps
+    assert len(calls) <= 5 * len(list_pdp)
+    assert _retrieve_interesting_pdp(list_pdp[:-1]) == []
@@ -0,0 +1,174 @@
+# coding=utf-8
+
+# Copyright (c) 2001-2018, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+from kirin import gtfs_realtime_pb2
+from kirin.feed_coalescer import FeedCoalescer
+
+
+def _entity(vj_id, trip_id):
+    feed = gtfs_realtime_pb2.FeedMessage()
+    entity = feed.entity.add()
+    entity.id = vj_id
+    entity.trip_update.trip.trip_id = trip_id
+    return vj_id, feed.SerializePartialToString()
+
+
+class FakeTimers(object):
+    """
+    the timers created by a FeedCoalescer, fired by the tests
+    """
+    def __init__(self):
+        self.timers = []
+
+    def __call__(self, interval, function, args):
+        timer = FakeTimer(function, args)
+        self.timers.append(timer)
+        return timer
+
+    def fire(self):
+        """
+        fire the pending timers
+        """
+        for timer in [t for t in self.timers if t.started and not t.cancelled]:
+            timer.cancelled = True
+            timer.function(*timer.args)
+
+
+class FakeTimer(object):
+    def __init__(self, function, args):
+        self.function = function
+        self.args = args
+        self.daemon = False
+        self.started = False
+        self.cancelled = False
+
+    def start(self):
+        self.started = True
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class PublishMock(object):
+    def __init__(self):
+        self.feeds = []
+
+    def __call__(self, feed_str, contributor):
+        feed = gtfs_realtime_pb2.FeedMessage()
+        feed.ParseFromString(feed_str)
+        self.feeds.append((contributor, [(e.id, e.trip_update.trip.trip_id) for e in feed.entity]))
+
+
+def test_coalescing_by_size():
+    """
+    the feeds are published when their size is reached, the last entity of a vj replaces the previous one
+    """
+    publish = PublishMock()
+    vj_1 = _entity('vj:1', 'first version')
+    coalescer = FeedCoalescer(publish, max_delay=60, max_size=3 * len(vj_1[1]))
+
+    coalescer.add('realtime.cots', [vj_1, _entity('vj:2', 'first version')])
+    coalescer.add('realtime.ire', [_entity('vj:1', 'ire')])
+    coalescer.add('realtime.cots', [_entity('vj:1', 'second version')])
+    assert publish.feeds == []
+
+    coalescer.add('realtime.cots', [_entity('vj:3', 'first version')])
+    assert publish.feeds == [('realtime.cots', [('vj:2', 'first version'),
+                                                ('vj:1', 'second version'),
+                                                ('vj:3', 'first version')])]
+
+    coalescer.flush_all()
+    assert publish.feeds[1:] == [('realtime.ire', [('vj:1', 'ire')])]
+
+
+def test_coalescing_by_delay():
+    """
+    the feeds are published at the latest after the max delay
+    """
+    publish = PublishMock()
+    timers = FakeTimers()
+    now = [0]
+    coalescer = FeedCoalescer(publish, max_delay=10, max_size=1024 * 1024, timer=timers, clock=lambda: now[0])
+
+    coalescer.add('realtime.cots', [_entity('vj:1', 'first version')])
+    coalescer.add('realtime.cots', [_entity('vj:2', 'first version')])
+    assert publish.feeds == []
+    assert len(timers.timers) == 1 and timers.timers[0].daemon
+
+    timers.fire()
+    assert publish.feeds == [('realtime.cots', [('vj:1', 'first version'), ('vj:2', 'first version')])]
+
+    # nothing is published again without a new feed
+    timers.fire()
+    assert len(publish.feeds) == 1
+
+    # the delay is also checked when a feed is added, in case the timer is late
+    coalescer.add('realtime.cots', [_entity('vj:3', 'first version')])
+    now[0] = 10
+    coalescer.add('realtime.cots', [_entity('vj:4', 'first version')])
+    assert publish.feeds[1:] == [('realtime.cots', [('vj:3', 'first version'), ('vj:4', 'first version')])]
+    assert all(t.cancelled for t in timers.timers)
+
+
+class FailingPublishMock(PublishMock):
+    def __init__(self):
+        super(FailingPublishMock, self).__init__()
+        self.fail = True
+
+    def __call__(self, feed_str, contributor):
+        if self.fail:
+            raise Exception('broker down')
+        super(FailingPublishMock, self).__call__(feed_str, contributor)
+
+
+def test_coalescing_publication_failure():
+    """
+    a failed publication does not raise in add(), the entities are kept and published again later
+    """
+    publish = FailingPublishMock()
+    timers = FakeTimers()
+    vj_1 = _entity('vj:1', 'first version')
+    coalescer = FeedCoalescer(publish, max_delay=10, max_size=len(vj_1[1]), timer=timers, clock=lambda: 0)
+
+    coalescer.add('realtime.cots', [vj_1])
+    coalescer.add('realtime.cots', [_entity('vj:2', 'first version')])
+    coalescer.add('realtime.cots', [_entity('vj:1', 'second version')])
+    assert publish.feeds == []
+
+    # the publication is tried again by the timer
+    timers.fire()
+    assert publish.feeds == []
+
+    publish.fail = False
+    timers.fire()
+    assert publish.feeds == [('realtime.cots', [('vj:2', 'first version'), ('vj:1', 'second version')])]
+
+    timers.fire()
+    assert len(publish.feeds) == 1
@@ -0,0 +1,181 @@
+# coding=utf-8
+
+#  Copyright (c) 2001-2018, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+
+import datetime
+import json
+from kirin import app, base_schedule
+from tests import mock_navitia
+from tests.check_utils import get_fixture_data, api_post
+from tests.mock_navitia import vj_R_vj1
+
+
+class Navitia(object):
+    url = 'http://navitia/coverage/bob'
+
+    def __init__(self):
+        self.pub_date = '20171115T195211.961411'
+        self.queries = []
+
+    def get_publication_date(self):
+        return self.pub_date
+
+    def vehicle_journeys(self, q):
+        self.queries.append(q)
+        return json.loads(vj_R_vj1.response.json_response)['vehicle_journeys']
+
+
+def test_compact_vj():
+    nav_vj = json.loads(vj_R_vj1.response.json_response)['vehicle_journeys'][0]
+    record = base_schedule.compact_vj(nav_vj)
+
+    assert record['id'] == 'R:vj1'
+    assert 'journey_pattern' not in record
+    assert len(record['stop_times']) == len(nav_vj['stop_times'])
+    st = record['stop_times'][0]
+    assert st['arrival_time'] == nav_vj['stop_times'][0]['arrival_time']
+    assert st['stop_point']['id'] == 'StopR1'
+    assert st['stop_point']['codes'] == [{'type': 'source', 'value': 'Code-StopR1'}]
+    assert st['stop_point']['stop_area']['timezone'] == nav_vj['stop_times'][0]['stop_point']['stop_area']['timezone']
+    assert 'coord' not in st['stop_point']
+
+
+def _query(until):
+    return {'filter': 'vehicle_journey.has_code(source, Code-R-vj1)',
+            'since': '20120615T120000Z',
+            'until': until,
+            'depth': '2'}
+
+
+def test_base_schedule_store_disabled(monkeypatch):
+    """
+    without the store, the navitia vjs are given as they are
+    """
+    monkeypatch.setitem(app.config, 'BASE_SCHEDULE_STORE_TIMEOUT', 0)
+    navitia = Navitia()
+    nav_vjs = navitia.vehicle_journeys(q=None)
+    with app.app_context():
+        assert base_schedule.store_vjs(navitia, 'source', 'Code-R-vj1', _query('20120615T190000Z'), nav_vjs) \
+            is nav_vjs
+        assert base_schedule.get_stored_vjs(navitia, 'source', 'Code-R-vj1', _query('20120615T190000Z')) is None
+
+
+def test_base_schedule_store(monkeypatch, fake_redis):
+    """
+    the vjs are searched in navitia only once by publication
+    """
+    monkeypatch.setitem(app.config, 'BASE_SCHEDULE_STORE_TIMEOUT', 3600)
+    monkeypatch.setattr(base_schedule, 'redis', fake_redis)
+    navitia = Navitia()
+    q = _query('20120615T190000Z')
+
+    with app.app_context():
+        app.cache.clear()
+        assert base_schedule.get_stored_vjs(navitia, 'source', 'Code-R-vj1', q) is None
+        records = base_schedule.get_vjs(navitia, 'source', 'Code-R-vj1', q)
+        assert [r['id'] for r in records] == ['R:vj1']
+        assert base_schedule.get_vjs(navitia, 'source', 'Code-R-vj1', q) == records
+        assert len(navitia.queries) == 1
+
+        # another period is another search
+        base_schedule.get_vjs(navitia, 'source', 'Code-R-vj1', _query('20120615T200000Z'))
+        assert len(navitia.queries) == 2
+
+        # a new publication invalidates the store
+        navitia.pub_date = '20171116T195211.961411'
+        base_schedule.get_vjs(navitia, 'source', 'Code-R-vj1', q)
+        assert len(navitia.queries) == 3
+
+
+def test_base_schedule_warm_up(monkeypatch, fake_redis):
+    """
+    after a new publication, the warm up searches again the lookups whose period is not over
+    """
+    monkeypatch.setitem(app.config, 'BASE_SCHEDULE_STORE_TIMEOUT', 3600)
+    monkeypatch.setattr(base_schedule, 'redis', fake_redis)
+    navitia = Navitia()
+    now = datetime.datetime.utcnow()
+    in_30_min = now + datetime.timedelta(minutes=30)
+    # the utc offset of the navitia datetimes is handled: this period ended 30 minutes ago
+    past_q = _query(in_30_min.strftime('%Y%m%dT%H%M%S+0100'))
+    active_q = _query(in_30_min.strftime('%Y%m%dT%H%M%SZ'))
+
+    with app.app_context():
+        app.cache.clear()
+        base_schedule.get_vjs(navitia, 'source', 'Code-R-vj1', past_q)
+        base_schedule.get_vjs(navitia, 'source', 'Code-R-vj1', active_q)
+        assert len(navitia.queries) == 2
+        assert not base_schedule.is_warm(navitia)
+        assert base_schedule.warm_up(navitia) == (1, 1)
+        assert base_schedule.is_warm(navitia)
+
+        navitia.pub_date = '20171116T195211.961411'
+        assert not base_schedule.is_warm(navitia)
+        assert base_schedule.warm_up(navitia) == (1, 0)
+        assert navitia.queries[2:] == [active_q]
+
+        # the records are now in the store
+        base_schedule.get_vjs(navitia, 'source', 'Code-R-vj1', active_q)
+        assert len(navitia.queries) == 3
+
+
+def test_base_schedule_store_with_sncf_wrapper(monkeypatch, fake_redis):
+    """
+    with the navitia wrapper of the SNCF contributors, the publication date is asked to navitia once by build,
+    and the vjs once by publication
+    """
+    monkeypatch.setitem(app.config, 'BASE_SCHEDULE_STORE_TIMEOUT', 3600)
+    monkeypatch.setattr(base_schedule, 'redis', fake_redis)
+    monkeypatch.setattr('kombu.messaging.Producer.publish', lambda *args, **kwargs: None)
+    queries = []
+    pub_dates = []
+
+    def query(self, query, q=None):
+        queries.append(query)
+        return mock_navitia.mock_navitia_query(self, query, q)
+
+    def get_publication_date(self):
+        pub_dates.append(self.url)
+        return mock_navitia.mock_publication_date(self)
+
+    monkeypatch.setattr('navitia_wrapper._NavitiaWrapper.query', query)
+    monkeypatch.setattr('navitia_wrapper._NavitiaWrapper.get_publication_date', get_publication_date)
+    with app.app_context():
+        app.cache.clear()
+
+    assert api_post('/ire', data=get_fixture_data('train_96231_delayed.xml')) == 'OK'
+    assert len(pub_dates) == 1
+    nb_queries = len(queries)
+    assert nb_queries > 0
+
+    # the train is found in the store
+    assert api_post('/ire', data=get_fixture_data('train_96231_normal.xml')) == 'OK'
+    assert len(pub_dates) == 2
+    assert len(queries) == nb_queries
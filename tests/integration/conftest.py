@@ -72,3 +72,57 @@ def mock_navitia_fixture(monkeypatch):
     Mock all calls to navitia for this fixture
     """
     monkeypatch.setattr('navitia_wrapper._NavitiaWrapper.query', mock_navitia.mock_navitia_query)
+
+
+class FakeRedis(object):
+    """
+    the parts of redis used by kirin: the values and hashes (like the fingerprints of the gtfs-rt entities
+    and the values used for the polling) and the sorted sets (like the lookups of the base schedule store)
+    """
+    def __init__(self):
+        self.values = {}
+        self.hashes = {}
+        self.sets = {}
+
+    def mget(self, *keys):
+        return [self.values.get(k) for k in keys]
+
+    def set(self, name, value, ex=None):
+        self.values[name] = value
+
+    def hgetall(self, name):
+        return dict(self.hashes.get(name, {}))
+
+    def hmset(self, name, mapping):
+        self.hashes[name] = dict(mapping)
+
+    def zadd(self, name, **kwargs):
+        self.sets.setdefault(name, {}).update(kwargs)
+
+    def zremrangebyscore(self, name, min, max):
+        self.sets[name] = {m: s for m, s in self.sets.get(name, {}).items() if not float(min) <= s <= float(max)}
+
+    def zrangebyscore(self, name, min, max):
+        return sorted(m for m, s in self.sets.get(name, {}).items() if float(min) <= s <= float(max))
+
+    def delete(self, name):
+        self.values.pop(name, None)
+        self.hashes.pop(name, None)
+        self.sets.pop(name, None)
+
+    def expire(self, name, time):
+        pass
+
+    def pipeline(self):
+        return self
+
+    def execute(self):
+        pass
+
+
+@pytest.fixture(scope='function')
+def fake_redis():
+    """
+    an in memory redis, to be patched where redis is used
+    """
+    return FakeRedis()
@@ -119,6 +119,8 @@ def test_cots_simple_post(mock_rabbitmq):
         assert rtu.contributor == 'realtime.cots'
         assert rtu.connector == 'cots'
         assert 'listePointDeParcours' in rtu.raw_data
+        # the raw data is stored as received
+        assert rtu.raw_data == cots_file.decode('utf-8')
     assert mock_rabbitmq.call_count == 1
 
 
@@ -233,6 +235,29 @@ def test_cots_delayed_post_twice(mock_rabbitmq):
     assert mock_rabbitmq.call_count == 2
 
 
+def test_cots_delayed_post_twice_identical_skipped(mock_rabbitmq, monkeypatch):
+    """
+    double delayed stops post, the second identical post is skipped
+    """
+    monkeypatch.setitem(app.config, 'SKIP_IDENTICAL_FEEDS', True)
+    cots_96231 = get_fixture_data('cots_train_96231_delayed.json')
+    res = api_post('/cots', data=cots_96231)
+    assert res == 'OK'
+    res = api_post('/cots', data=cots_96231)
+    assert res == 'OK'
+
+    with app.app_context():
+        rtus = RealTimeUpdate.query.all()
+        assert len(rtus) == 1
+        assert rtus[0].content_hash is not None
+        assert rtus[0].updated_at is not None
+        assert len(TripUpdate.query.all()) == 1
+        assert len(StopTimeUpdate.query.all()) == 6
+    check_db_96231_delayed(contributor='realtime.cots')
+    # the rabbit mq has been called only for the first post
+    assert mock_rabbitmq.call_count == 1
+
+
 def test_cots_mixed_statuses_inside_stop_times(mock_rabbitmq):
     """
     stops have mixed statuses (between their departure and arrival especially)
@@ -187,6 +187,11 @@ def test_gtfs_rt_simple_delay(basic_gtfs_rt_data, mock_rabbitmq):
         assert len(TripUpdate.query.all()) == 1
         assert len(StopTimeUpdate.query.all()) == 4
 
+        # the protobuf is stored compressed
+        rtu = RealTimeUpdate.query.first()
+        assert rtu.raw_data is None
+        assert rtu.get_raw_data() == basic_gtfs_rt_data.SerializeToString()
+
         trip_update = TripUpdate.find_by_dated_vj('R:vj1', datetime.datetime(2012, 6, 15, 14, 0))
 
         assert trip_update
@@ -680,6 +685,272 @@ def test_gtfs_rt_partial_update_diff_feed_2(partial_update_gtfs_rt_data_2,
                 assert len(trip_update.real_time_updates) == 1
 
 
+def test_gtfs_model_builder_with_batched_vjs(partial_update_gtfs_rt_data_3, monkeypatch):
+    """
+    the vjs of the trips are searched in navitia with only one call when GTFS_RT_VJ_BATCH_SIZE is set,
+    and are then found in the cache
+    """
+    queries = []
+
+    def query(self, query, q=None):
+        queries.append(q['filter'])
+        return mock_navitia.mock_navitia_query(self, query, q)
+    monkeypatch.setattr('navitia_wrapper._NavitiaWrapper.query', query)
+    monkeypatch.setitem(app.config, 'GTFS_RT_VJ_BATCH_SIZE', 2)
+
+    with app.app_context():
+        app.cache.clear()
+        rt_update = RealTimeUpdate('', connector='gtfs-rt', contributor='realtime.gtfs')
+        trip_updates = gtfs_rt.KirinModelBuilder(dumb_nav_wrapper()).build(rt_update, partial_update_gtfs_rt_data_3)
+
+        assert queries == ['vehicle_journey.has_code(source, Code-R-vj1) or '
+                           'vehicle_journey.has_code(source, Code-R-vj2)']
+        assert [tu.vj.navitia_trip_id for tu in trip_updates] == ['R:vj1', 'R:vj2']
+        assert [len(tu.stop_time_updates) for tu in trip_updates] == [4, 4]
+
+        # the second time, everything is in the cache
+        gtfs_rt.KirinModelBuilder(dumb_nav_wrapper()).build(rt_update, partial_update_gtfs_rt_data_3)
+        assert len(queries) == 1
+
+
+def test_gtfs_model_builder_with_truncated_batch(partial_update_gtfs_rt_data_3, monkeypatch):
+    """
+    nothing is kept from a truncated response of a batch, as a vj found might have a duplicate
+    in the missing part of the response: the trips are then searched alone
+    """
+    queries = []
+
+    def query(self, query, q=None):
+        queries.append(q['filter'])
+        res, code = mock_navitia.mock_navitia_query(self, query, q)
+        if ' or ' in q['filter']:
+            # only the vj of Code-R-vj1 is in the first page, with other vjs
+            vj_1 = [vj for vj in res['vehicle_journeys'] if vj['codes'][0]['value'] == 'Code-R-vj1'][0]
+            others = [dict(vj_1, id='other:{}'.format(i), codes=[{'type': 'source', 'value': 'other'}])
+                      for i in range(int(q['count']) - 1)]
+            res['vehicle_journeys'] = [vj_1] + others
+        return res, code
+    monkeypatch.setattr('navitia_wrapper._NavitiaWrapper.query', query)
+    monkeypatch.setitem(app.config, 'GTFS_RT_VJ_BATCH_SIZE', 2)
+
+    with app.app_context():
+        app.cache.clear()
+        rt_update = RealTimeUpdate('', connector='gtfs-rt', contributor='realtime.gtfs')
+        trip_updates = gtfs_rt.KirinModelBuilder(dumb_nav_wrapper()).build(rt_update, partial_update_gtfs_rt_data_3)
+
+        assert queries == ['vehicle_journey.has_code(source, Code-R-vj1) or '
+                           'vehicle_journey.has_code(source, Code-R-vj2)',
+                           'vehicle_journey.has_code(source, Code-R-vj1)',
+                           'vehicle_journey.has_code(source, Code-R-vj2)']
+        assert [tu.vj.navitia_trip_id for tu in trip_updates] == ['R:vj1', 'R:vj2']
+
+
+def test_gtfs_model_builder_with_entity_fingerprints(partial_update_gtfs_rt_data_3, monkeypatch,
+                                                     fake_redis):
+    """
+    with GTFS_RT_ENTITY_FINGERPRINT_TIMEOUT, only the trip_updates changed since the last feed are built
+    """
+    monkeypatch.setitem(app.config, 'GTFS_RT_ENTITY_FINGERPRINT_TIMEOUT', 3600)
+    monkeypatch.setattr('kirin.gtfs_rt.model_maker.redis', fake_redis)
+
+    def build(feed):
+        # the feed is parsed again, like in each polling (the builder modifies the stop_sequence of the feed)
+        data = gtfs_realtime_pb2.FeedMessage()
+        data.ParseFromString(feed.SerializeToString())
+        rt_update = RealTimeUpdate(None, connector='gtfs-rt', contributor='realtime.gtfs')
+        builder = gtfs_rt.KirinModelBuilder(dumb_nav_wrapper(), contributor='realtime.gtfs')
+        trip_updates = builder.build(rt_update, data)
+        builder.save_entity_fingerprints()
+        return rt_update, trip_updates
+
+    with app.app_context():
+        _, trip_updates = build(partial_update_gtfs_rt_data_3)
+        assert [tu.vj.navitia_trip_id for tu in trip_updates] == ['R:vj1', 'R:vj2']
+
+        # nothing changed, nothing is built (but it is not an error)
+        rt_update, trip_updates = build(partial_update_gtfs_rt_data_3)
+        assert trip_updates == []
+        assert rt_update.status == 'OK'
+
+        # only the changed trip is built
+        partial_update_gtfs_rt_data_3.entity[1].trip_update.stop_time_update[0].arrival.delay = 120
+        _, trip_updates = build(partial_update_gtfs_rt_data_3)
+        assert [tu.vj.navitia_trip_id for tu in trip_updates] == ['R:vj2']
+        assert trip_updates[0].stop_time_updates[0].arrival_delay == timedelta(minutes=2)
+
+
+def test_gtfs_model_builder_with_entity_fingerprints_of_missing_vj(partial_update_gtfs_rt_data_3, monkeypatch,
+                                                                    fake_redis):
+    """
+    the fingerprint of an entity is recorded only once it gave trip_updates:
+    an entity whose vj is not found is handled again in the next feed
+    """
+    monkeypatch.setitem(app.config, 'GTFS_RT_ENTITY_FINGERPRINT_TIMEOUT', 3600)
+    monkeypatch.setattr('kirin.gtfs_rt.model_maker.redis', fake_redis)
+    missing_codes = {'Code-R-vj2'}
+
+    def query(self, query, q=None):
+        res, code = mock_navitia.mock_navitia_query(self, query, q)
+        if any(c in q['filter'] for c in missing_codes):
+            res['vehicle_journeys'] = []
+        return res, code
+    monkeypatch.setattr('navitia_wrapper._NavitiaWrapper.query', query)
+
+    def build(feed):
+        data = gtfs_realtime_pb2.FeedMessage()
+        data.ParseFromString(feed.SerializeToString())
+        rt_update = RealTimeUpdate(None, connector='gtfs-rt', contributor='realtime.gtfs')
+        builder = gtfs_rt.KirinModelBuilder(dumb_nav_wrapper(), contributor='realtime.gtfs')
+        trip_updates = builder.build(rt_update, data)
+        builder.save_entity_fingerprints()
+        return trip_updates
+
+    with app.app_context():
+        app.cache.clear()
+        trip_updates = build(partial_update_gtfs_rt_data_3)
+        assert [tu.vj.navitia_trip_id for tu in trip_updates] == ['R:vj1']
+
+        # the vj is now found in navitia (and not in the cache anymore), the unchanged entity is built
+        missing_codes.clear()
+        app.cache.clear()
+        trip_updates = build(partial_update_gtfs_rt_data_3)
+        assert [tu.vj.navitia_trip_id for tu in trip_updates] == ['R:vj2']
+
+        # both are now recorded
+        assert build(partial_update_gtfs_rt_data_3) == []
+
+
+def test_gtfs_rt_conditional_get(requests_mock, monkeypatch, fake_redis):
+    """
+    the feed is polled with a conditional GET, with the ETag and Last-Modified of the last received feed
+    """
+    from kirin.gtfs_rt import tasks
+    monkeypatch.setattr(tasks, 'redis', fake_redis)
+    config = {'contributor': 'realtime.gtfs', 'feed_url': 'http://feed.gtfs/rt'}
+
+    requests_mock.get(config['feed_url'], content='bob',
+                      headers={'ETag': '"v1"', 'Last-Modified': 'Fri, 15 Jun 2012 15:00:00 GMT'})
+    assert tasks._get_feed(config).content == 'bob'
+    assert 'If-None-Match' not in requests_mock.last_request.headers
+
+    requests_mock.get(config['feed_url'], status_code=304)
+    assert tasks._get_feed(config) is None
+    assert requests_mock.last_request.headers['If-None-Match'] == '"v1"'
+    assert requests_mock.last_request.headers['If-Modified-Since'] == 'Fri, 15 Jun 2012 15:00:00 GMT'
+    assert 'gzip' in requests_mock.last_request.headers['Accept-Encoding']
+
+    # without validators, the next polling is a plain GET
+    requests_mock.get(config['feed_url'], content='bobette')
+    assert tasks._get_feed(config).content == 'bobette'
+    assert tasks._get_feed(config).content == 'bobette'
+    assert 'If-None-Match' not in requests_mock.last_request.headers
+    assert 'If-Modified-Since' not in requests_mock.last_request.headers
+
+
+def test_gtfs_rt_poller_identical_feed_skipped(basic_gtfs_rt_data, mock_rabbitmq, requests_mock, monkeypatch,
+                                               fake_redis):
+    """
+    with SKIP_IDENTICAL_FEEDS, a polled feed identical to the last handled one only pokes its updated_at:
+    no new RealTimeUpdate, nothing published
+    """
+    from contextlib import contextmanager
+    from kirin.gtfs_rt import tasks
+
+    @contextmanager
+    def get_lock(logger, lock_name, lock_timeout):
+        yield True
+
+    monkeypatch.setitem(app.config, 'SKIP_IDENTICAL_FEEDS', True)
+    monkeypatch.setattr(tasks, 'redis', fake_redis)
+    monkeypatch.setattr(tasks, 'get_lock', get_lock)
+    monkeypatch.setattr(tasks, 'get_navitia_wrapper', lambda config: dumb_nav_wrapper())
+    config = {'contributor': 'realtime.gtfs', 'feed_url': 'http://feed.gtfs/rt', 'poll_interval': 1}
+    requests_mock.get(config['feed_url'], content=basic_gtfs_rt_data.SerializeToString())
+
+    tasks.gtfs_poller(config)
+    with app.app_context():
+        rtus = RealTimeUpdate.query.all()
+        assert len(rtus) == 1
+        assert rtus[0].status == 'OK'
+        first_updated_at = rtus[0].updated_at
+    assert mock_rabbitmq.call_count == 1
+
+    tasks.gtfs_poller(config)
+    with app.app_context():
+        rtus = RealTimeUpdate.query.all()
+        assert len(rtus) == 1
+        assert rtus[0].status == 'OK'
+        assert rtus[0].updated_at is not None
+        assert rtus[0].updated_at != first_updated_at
+        assert len(TripUpdate.query.all()) == 1
+    assert mock_rabbitmq.call_count == 1
+
+
+def test_gtfs_rt_feeds_polling(monkeypatch, fake_redis):
+    """
+    each feed of GTFS_RT_FEEDS is polled every poll_interval seconds
+    """
+    from kirin.gtfs_rt import tasks
+    from kirin.utils import get_gtfs_rt_feeds
+    monkeypatch.setattr(tasks, 'redis', fake_redis)
+    monkeypatch.setitem(app.config, 'GTFS_RT_FEEDS', [
+        {'contributor': 'realtime.bob', 'feed_url': 'http://bob.gtfs/rt', 'coverage': 'bob'},
+        {'contributor': 'realtime.bobette', 'feed_url': 'http://bobette.gtfs/rt', 'coverage': 'bobette',
+         'token': 'bobette_token', 'poll_interval': 10}])
+
+    with app.app_context():
+        feeds = get_gtfs_rt_feeds()
+    assert [f['contributor'] for f in feeds] == ['realtime.bob', 'realtime.bobette']
+    assert feeds[0]['navitia_url'] == app.config['NAVITIA_URL']
+    assert feeds[0]['token'] is None
+    assert feeds[0]['poll_interval'] == 1
+    assert feeds[1]['token'] == 'bobette_token'
+
+    polled = [[f['contributor'] for f in tasks.get_due_feeds(feeds, now=1000 + t)] for t in range(20)]
+    assert all('realtime.bob' in p for p in polled)
+    bobette_pollings = [t for t, p in enumerate(polled) if 'realtime.bobette' in p]
+    assert len(bobette_pollings) == 2
+    assert bobette_pollings[1] - bobette_pollings[0] == 10
+
+
+def test_gtfs_rt_adaptive_polling(monkeypatch, fake_redis):
+    """
+    the poll interval of a feed with a max_poll_interval is adapted to the cadence of its producer
+    """
+    from kirin.gtfs_rt import tasks
+    monkeypatch.setattr(tasks, 'redis', fake_redis)
+    config = {'contributor': 'realtime.bob', 'poll_interval': 1, 'max_poll_interval': 60}
+
+    def interval():
+        return tasks.redis.values['realtime.bob|polling_interval']
+
+    # the producer publishes a new feed every 20s, the feed is polled every 10s
+    tasks.adapt_poll_interval(config, feed_timestamp=1000, now=1000)
+    tasks.adapt_poll_interval(config, feed_timestamp=1020, now=1021)
+    assert interval() == 10
+
+    # the feed did not change (304 or same timestamp), the polling is slowed down
+    tasks.adapt_poll_interval(config, now=1031)
+    assert interval() == 15
+    tasks.adapt_poll_interval(config, feed_timestamp=1020, now=1046)
+    assert interval() == 22.5
+    for _ in range(10):
+        tasks.adapt_poll_interval(config)
+    assert interval() == 60
+
+    # the learned interval is used to plan the pollings
+    assert tasks.get_due_feeds([config], now=2000) == [config]
+    assert tasks.get_due_feeds([config], now=2059) == []
+    assert tasks.get_due_feeds([config], now=2060) == [config]
+
+    # a feed without max_poll_interval is always polled every poll_interval
+    config['max_poll_interval'] = 0
+    tasks.adapt_poll_interval(config, feed_timestamp=1100)
+    assert interval() == 60
+    assert tasks.get_due_feeds([config], now=2120) == [config]
+    assert tasks.get_due_feeds([config], now=2121) == [config]
+
+
 '''
 vj.stop_times:  StopR1	StopR2	StopR3	StopR2	StopR4
 order:          0       1       2       3       4
@@ -1387,7 +1658,7 @@ def test_manage_db_with_http_error_without_insert():
     with app.app_context():
         manage_db_error('toto', 'gtfs-rt', contributor='realtime.gtfs', status='KO', error='Http Error')
         assert len(RealTimeUpdate.query.all()) == 1
-        assert RealTimeUpdate.query.first().raw_data == 'toto'
+        assert RealTimeUpdate.query.first().get_raw_data() == 'toto'
         assert RealTimeUpdate.query.first().status == 'KO'
         assert RealTimeUpdate.query.first().error == 'Http Error'
 
@@ -1397,7 +1668,7 @@ def test_manage_db_with_http_error_without_insert():
 
         manage_db_error('toto', 'gtfs-rt', contributor='realtime.gtfs', status='KO', error='Http Error')
         assert len(RealTimeUpdate.query.all()) == 1
-        assert RealTimeUpdate.query.first().raw_data == 'toto'
+        assert RealTimeUpdate.query.first().get_raw_data() == 'toto'
         assert RealTimeUpdate.query.first().status == 'KO'
         assert RealTimeUpdate.query.first().error == 'Http Error'
         assert RealTimeUpdate.query.first().created_at == created_at
@@ -1409,7 +1680,7 @@ def test_manage_db_with_http_error_without_insert():
 
         manage_db_error('toto', 'gtfs-rt', contributor='realtime.gtfs', status='KO', error='Http Error')
         assert len(RealTimeUpdate.query.all()) == 1
-        assert RealTimeUpdate.query.first().raw_data == 'toto'
+        assert RealTimeUpdate.query.first().get_raw_data() == 'toto'
         assert RealTimeUpdate.query.first().status == 'KO'
         assert RealTimeUpdate.query.first().error == 'Http Error'
         assert RealTimeUpdate.query.first().created_at == created_at
@@ -1423,7 +1694,7 @@ def test_manage_db_with_http_error_with_insert():
     with app.app_context():
         manage_db_error('toto', 'gtfs-rt', contributor='realtime.gtfs', status='KO', error='Http Error')
         assert len(RealTimeUpdate.query.all()) == 1
-        assert RealTimeUpdate.query.first().raw_data == 'toto'
+        assert RealTimeUpdate.query.first().get_raw_data() == 'toto'
         assert RealTimeUpdate.query.first().status == 'KO'
         assert RealTimeUpdate.query.first().error == 'Http Error'
 
@@ -1437,7 +1708,7 @@ def test_manage_db_with_http_error_with_insert():
 
         manage_db_error('toto', 'gtfs-rt', contributor='realtime.gtfs', status='KO', error='Http Error')
         assert len(RealTimeUpdate.query.all()) == 3
-        assert RealTimeUpdate.query.order_by(desc(RealTimeUpdate.created_at)).first().raw_data == 'toto'
+        assert RealTimeUpdate.query.order_by(desc(RealTimeUpdate.created_at)).first().get_raw_data() == 'toto'
         assert RealTimeUpdate.query.order_by(desc(RealTimeUpdate.created_at)).first().status == 'KO'
         assert RealTimeUpdate.query.order_by(desc(RealTimeUpdate.created_at)).first().error == 'Http Error'
         assert RealTimeUpdate.query.order_by(desc(RealTimeUpdate.created_at)).first().created_at != created_at
@@ -31,7 +31,11 @@
 from datetime import timedelta
 
 import pytest
-from kirin.core.handler import handle
+import pytz
+import sqlalchemy
+from kirin.core.handler import handle, index_by_dated_vj, _get_base_schedule, _batch_to_utc
+from kirin.utils import local_to_utc
+from kirin.core.populate_pb import serialize_entity
 from kirin.core.model import RealTimeUpdate, TripUpdate, VehicleJourney, StopTimeUpdate
 import datetime
 from kirin import app, db
@@ -503,6 +507,69 @@ def test_multiple_delays_in_2_updates(navitia_vj):
         assert len(StopTimeUpdate.query.all()) == 3
 
 
+def test_stop_time_updates_updated_in_place(navitia_vj):
+    """
+    when only one stop time is modified by a new trip update, the stop time updates in the db are kept
+    (no delete and insert of all of them), only the modified one is updated
+    """
+    with app.app_context():
+        trip_update = TripUpdate(VehicleJourney(navitia_vj, datetime.date(2015, 9, 8)), status='update')
+        real_time_update = RealTimeUpdate(raw_data=None, connector='ire', contributor='realtime.ire')
+        trip_update.stop_time_updates = [
+            StopTimeUpdate({'id': 'sa:1'}, departure_delay=timedelta(minutes=5), dep_status='update'),
+        ]
+        res, _ = handle(real_time_update, [trip_update], 'kisio-digital')
+        db_ids = [st.id for st in res.trip_updates[0].stop_time_updates]
+        first_updated_at = [st.updated_at for st in StopTimeUpdate.query.order_by(StopTimeUpdate.order)]
+        assert first_updated_at == [None, None, None]
+
+        trip_update = TripUpdate(VehicleJourney(navitia_vj, datetime.date(2015, 9, 8)), status='update')
+        real_time_update = RealTimeUpdate(raw_data=None, connector='ire', contributor='realtime.ire')
+        trip_update.stop_time_updates = [
+            StopTimeUpdate({'id': 'sa:1'}, departure_delay=timedelta(minutes=5), dep_status='update'),
+            StopTimeUpdate({'id': 'sa:2'}, arrival_delay=timedelta(minutes=2), arr_status='update'),
+        ]
+        res, _ = handle(real_time_update, [trip_update], 'kisio-digital')
+
+        stop_time_updates = StopTimeUpdate.query.order_by(StopTimeUpdate.order).all()
+        assert [st.id for st in stop_time_updates] == db_ids
+        assert [st.id for st in res.trip_updates[0].stop_time_updates] == db_ids
+        # only the second stop time has been updated
+        assert [st.updated_at is not None for st in stop_time_updates] == [False, True, False]
+        assert stop_time_updates[1].arrival == _dt("9:07")
+        assert stop_time_updates[1].arrival_delay == timedelta(minutes=2)
+        assert stop_time_updates[1].arrival_status == 'update'
+
+
+def test_serialized_entity_refreshed(navitia_vj):
+    """
+    the serialized entity of a trip update is refreshed each time the trip update is modified
+    """
+    with app.app_context():
+        trip_update = TripUpdate(VehicleJourney(navitia_vj, datetime.date(2015, 9, 8)), status='update')
+        real_time_update = RealTimeUpdate(raw_data=None, connector='ire', contributor='realtime.ire')
+        trip_update.stop_time_updates = [
+            StopTimeUpdate({'id': 'sa:1'}, departure_delay=timedelta(minutes=5), dep_status='update'),
+        ]
+        handle(real_time_update, [trip_update], 'kisio-digital')
+        db_trip_update = TripUpdate.query.one()
+        first_entity = db_trip_update.pb_entity
+        assert first_entity == serialize_entity(db_trip_update)
+
+        # only the message of the trip is modified, there is no change on the stop times
+        trip_update = TripUpdate(VehicleJourney(navitia_vj, datetime.date(2015, 9, 8)), status='update')
+        trip_update.message = 'bob is late'
+        real_time_update = RealTimeUpdate(raw_data=None, connector='ire', contributor='realtime.ire')
+        trip_update.stop_time_updates = [
+            StopTimeUpdate({'id': 'sa:1'}, departure_delay=timedelta(minutes=5), dep_status='update'),
+        ]
+        handle(real_time_update, [trip_update], 'kisio-digital')
+        db_trip_update = TripUpdate.query.one()
+        assert db_trip_update.message == 'bob is late'
+        assert db_trip_update.pb_entity != first_entity
+        assert db_trip_update.pb_entity == serialize_entity(db_trip_update)
+
+
 def test_delays_then_cancellation(setup_database, navitia_vj):
     """
     We have a delay on the first st of a vj in the db and we receive a cancellation on this vj,
@@ -633,3 +700,209 @@ def test_cancellation_then_delay_in_2_updates(navitia_vj):
         res, _ = handle(real_time_update, [trip_update], 'kisio-digital')
 
         _check_cancellation_then_delay(res)
+
+
+@pytest.mark.parametrize('nb_trip_updates', [10, 100, 1000, 10000])
+def test_index_by_dated_vj_scaling(nb_trip_updates, monkeypatch):
+    """
+    matching of the incoming TripUpdates with the ones already in db
+
+    the matching used to be a linear search for each incoming TripUpdate, it is now a lookup in an index
+    built once, so the dated vj of each TripUpdate in db must only be computed once
+    """
+    def make_trip_updates(circulation_date):
+        return [TripUpdate(VehicleJourney({
+                    'trip': {'id': 'vehicle_journey:{}'.format(i)},
+                    'stop_times': [
+                        {'arrival_time': datetime.time(8, 10), 'stop_point': {'stop_area': {'timezone': 'UTC'}}}
+                    ]},
+                    circulation_date)) for i in range(nb_trip_updates)]
+
+    with app.app_context():
+        db_trip_updates = make_trip_updates(datetime.date(2015, 9, 8))
+        # half of the incoming trip updates are on another day, and are thus not in the db
+        new_trip_updates = make_trip_updates(datetime.date(2015, 9, 8))[::2] + \
+            make_trip_updates(datetime.date(2015, 9, 9))[1::2]
+
+        calls = []
+        get_start_timestamp = VehicleJourney.get_start_timestamp
+
+        def counting_get_start_timestamp(vj):
+            calls.append(vj)
+            return get_start_timestamp(vj)
+        monkeypatch.setattr(VehicleJourney, 'get_start_timestamp', counting_get_start_timestamp)
+
+        index = index_by_dated_vj(db_trip_updates)
+        # with the former quadratic search, each incoming TripUpdate was compared to all the ones in db
+        assert len(calls) == nb_trip_updates
+        monkeypatch.undo()
+
+        matches = [index.get((tu.vj.navitia_trip_id, tu.vj.get_start_timestamp())) for tu in new_trip_updates]
+
+        assert len(index) == nb_trip_updates
+        assert len([m for m in matches if m is not None]) == len(range(0, nb_trip_updates, 2))
+        for new_tu, match in zip(new_trip_updates, matches):
+            if match is None:
+                assert new_tu.vj.get_utc_circulation_date() == datetime.date(2015, 9, 9)
+            else:
+                assert match.vj.navitia_trip_id == new_tu.vj.navitia_trip_id
+                assert match.vj.get_start_timestamp() == new_tu.vj.get_start_timestamp()
+
+
+@pytest.mark.parametrize('circulation_date', [datetime.date(2018, 6, 1),
+                                              datetime.date(2018, 3, 24),  # DST change during the night
+                                              datetime.date(2018, 3, 25),  # DST change during the day
+                                              datetime.date(2018, 10, 27)])
+def test_base_schedule_batch_conversion(circulation_date):
+    """
+    the base schedule is computed for the whole vj at once, it must give exactly the same datetimes
+    as localizing each stop_time on its own (pass-midnight and DST changes included)
+    """
+    def stop(arrival, departure, timezone='Europe/Paris'):
+        return {'arrival_time': arrival, 'departure_time': departure,
+                'stop_point': {'stop_area': {'timezone': timezone}}}
+
+    navitia_vj = {'trip': {'id': 'vehicle_journey:1'}, 'stop_times': [
+        stop(None, datetime.time(22, 15)),
+        stop(datetime.time(23, 10), datetime.time(0, 15)),
+        stop(datetime.time(1, 20), datetime.time(2, 25)),
+        stop(datetime.time(3, 20), datetime.time(3, 25), timezone='UTC'),
+        stop(datetime.time(9, 20), None),
+    ]}
+
+    def to_utc(date, time, timezone):
+        tz = pytz.timezone(timezone)
+        return tz.localize(datetime.datetime.combine(date, time)).astimezone(pytz.utc).replace(tzinfo=None)
+
+    next_day = circulation_date + timedelta(days=1)
+    expected = [
+        (None, to_utc(circulation_date, datetime.time(22, 15), 'Europe/Paris')),
+        (to_utc(circulation_date, datetime.time(23, 10), 'Europe/Paris'),
+         to_utc(next_day, datetime.time(0, 15), 'Europe/Paris')),
+        (to_utc(next_day, datetime.time(1, 20), 'Europe/Paris'),
+         to_utc(next_day, datetime.time(2, 25), 'Europe/Paris')),
+        (to_utc(next_day, datetime.time(3, 20), 'UTC'), to_utc(next_day, datetime.time(3, 25), 'UTC')),
+        (to_utc(next_day, datetime.time(9, 20), 'Europe/Paris'), None),
+    ]
+    assert _get_base_schedule(navitia_vj, circulation_date) == expected
+
+    # same with only one timezone
+    for st in navitia_vj['stop_times']:
+        st['stop_point']['stop_area']['timezone'] = 'Europe/Paris'
+    expected[3] = (to_utc(next_day, datetime.time(3, 20), 'Europe/Paris'),
+                   to_utc(next_day, datetime.time(3, 25), 'Europe/Paris'))
+    assert _get_base_schedule(navitia_vj, circulation_date) == expected
+
+
+@pytest.mark.parametrize('first_dt', [datetime.datetime(2018, 6, 1, 20, 15),
+                                      datetime.datetime(2018, 3, 24, 20, 15),  # DST change the next day
+                                      datetime.datetime(2018, 10, 27, 20, 15)])
+def test_batch_to_utc_same_as_per_stop(first_dt):
+    """
+    the batched conversion of a column must give the same datetimes as local_to_utc on each of them
+    """
+    paris = pytz.timezone('Europe/Paris')
+    local_dts = [first_dt + timedelta(minutes=35 * i) if i % 7 else None for i in range(50)]
+
+    def per_stop(timezones):
+        return [local_to_utc(dt, tz) if dt is not None else None for dt, tz in zip(local_dts, timezones)]
+
+    timezones = [paris] * len(local_dts)
+    assert _batch_to_utc(local_dts, timezones) == per_stop(timezones)
+
+    timezones[10] = pytz.utc
+    assert _batch_to_utc(local_dts, timezones) == per_stop(timezones)
+
+    assert _batch_to_utc([None, None], [paris, paris]) == [None, None]
+
+
+def _dump_trip_updates():
+    """
+    db content of the trip updates, without the generated ids
+    """
+    res = []
+    for tu in TripUpdate.query.all():
+        res.append((tu.vj.navitia_trip_id, tu.vj.get_start_timestamp(), tu.status, tu.message, tu.contributor,
+                    len(tu.real_time_updates),
+                    [(st.stop_id, st.order, st.message,
+                      st.arrival, st.arrival_delay, st.arrival_status,
+                      st.departure, st.departure_delay, st.departure_status) for st in tu.stop_time_updates]))
+    return sorted(res)
+
+
+def _handle_delays_then_cancellation(navitia_vj):
+    with app.app_context():
+        trip_update = TripUpdate(VehicleJourney(navitia_vj, datetime.date(2015, 9, 8)), status='update')
+        trip_update.stop_time_updates = [
+            StopTimeUpdate({'id': 'sa:1'}, departure_delay=timedelta(minutes=5), dep_status='update', order=0),
+        ]
+        real_time_update = RealTimeUpdate(raw_data=None, connector='ire', contributor='realtime.ire')
+        handle(real_time_update, [trip_update], 'kisio-digital')
+        first = _dump_trip_updates()
+
+        trip_update = TripUpdate(VehicleJourney(navitia_vj, datetime.date(2015, 9, 8)), status='update')
+        trip_update.stop_time_updates = [
+            StopTimeUpdate({'id': 'sa:2'}, arrival_delay=timedelta(minutes=10), arr_status='update', order=1),
+        ]
+        real_time_update = RealTimeUpdate(raw_data=None, connector='ire', contributor='realtime.ire')
+        res, _ = handle(real_time_update, [trip_update], 'kisio-digital')
+        assert len(res.trip_updates) == 1
+        second = _dump_trip_updates()
+
+        trip_update = TripUpdate(VehicleJourney(navitia_vj, datetime.date(2015, 9, 8)), status='delete')
+        real_time_update = RealTimeUpdate(raw_data=None, connector='ire', contributor='realtime.ire')
+        handle(real_time_update, [trip_update], 'kisio-digital')
+        third = _dump_trip_updates()
+
+        assert StopTimeUpdate.query.count() == 0
+        assert RealTimeUpdate.query.count() == 3
+
+    return first, second, third
+
+
+def test_bulk_persistence(navitia_vj, monkeypatch):
+    """
+    the bulk persistence must give the same db content as the ORM flush
+    """
+    orm_results = _handle_delays_then_cancellation(navitia_vj)
+    with app.app_context():
+        db.session.execute('TRUNCATE {} CASCADE;'.format(', '.join(str(t) for t in db.metadata.sorted_tables)))
+        db.session.commit()
+
+    monkeypatch.setitem(app.config, 'USE_BULK_PERSISTENCE', True)
+    bulk_results = _handle_delays_then_cancellation(navitia_vj)
+
+    assert bulk_results == orm_results
+    first, second, third = bulk_results
+    assert len(first) == 1 and len(first[0][6]) == 3
+    assert second[0][6][1][3] == _dt("9:15")
+    assert third[0][2] == 'delete' and third[0][6] == [] and third[0][5] == 3
+
+
+def test_bulk_persistence_session_state(navitia_vj, monkeypatch):
+    """
+    after a bulk persistence, the written objects must be persistent and clean in the session,
+    so that nothing is written again by the next flush
+    """
+    monkeypatch.setitem(app.config, 'USE_BULK_PERSISTENCE', True)
+    with app.app_context():
+        trip_update = TripUpdate(VehicleJourney(navitia_vj, datetime.date(2015, 9, 8)), status='update')
+        trip_update.stop_time_updates = [
+            StopTimeUpdate({'id': 'sa:1'}, departure_delay=timedelta(minutes=5), dep_status='update', order=0),
+        ]
+        real_time_update = RealTimeUpdate(raw_data=None, connector='ire', contributor='realtime.ire')
+        res, _ = handle(real_time_update, [trip_update], 'kisio-digital')
+
+        assert not db.session.new and not db.session.dirty and not db.session.deleted
+        db_trip_update = res.trip_updates[0]
+        assert sqlalchemy.inspect(res).persistent
+        assert sqlalchemy.inspect(db_trip_update).persistent
+        assert all(sqlalchemy.inspect(st).persistent for st in db_trip_update.stop_time_updates)
+        assert len(db_trip_update.stop_time_updates) == 3
+        assert db_trip_update.real_time_updates == [res]
+        assert db_trip_update.created_at is not None
+
+        db.session.commit()
+        assert TripUpdate.query.count() == 1
+        assert StopTimeUpdate.query.count() == 3
+        assert RealTimeUpdate.query.count() == 1
@@ -178,6 +178,34 @@ def test_ire_delayed_post_twice(mock_rabbitmq):
     assert mock_rabbitmq.call_count == 2
 
 
+def test_ire_delayed_post_twice_identical_skipped(mock_rabbitmq, monkeypatch):
+    """
+    double delayed stops post, with SKIP_IDENTICAL_FEEDS the second identical post only pokes the updated_at
+    of the first RealTimeUpdate: it is neither handled nor published again
+    """
+    monkeypatch.setitem(app.config, 'SKIP_IDENTICAL_FEEDS', True)
+    ire_96231 = get_fixture_data('train_96231_delayed.xml')
+    res = api_post('/ire', data=ire_96231)
+    assert res == 'OK'
+    with app.app_context():
+        first_updated_at = RealTimeUpdate.query.first().updated_at
+
+    res = api_post('/ire', data=ire_96231)
+    assert res == 'OK'
+
+    with app.app_context():
+        rtus = RealTimeUpdate.query.all()
+        assert len(rtus) == 1
+        assert rtus[0].status == 'OK'
+        assert rtus[0].updated_at is not None
+        assert rtus[0].updated_at != first_updated_at
+        assert len(TripUpdate.query.all()) == 1
+        assert len(StopTimeUpdate.query.all()) == 6
+    check_db_96231_delayed(contributor='realtime.ire')
+    # the rabbit mq has been called only for the first post
+    assert mock_rabbitmq.call_count == 1
+
+
 def test_ire_trip_delayed_then_removal(mock_rabbitmq):
     """
     post delayed stops then trip removal on the same trip
@@ -96,6 +96,66 @@ def test_find_stop():
         assert vj.find_stop('sa:4') is None
 
 
+def test_find_stop_index_invalidation():
+    """
+    find_stop uses an index on the stop_time_updates, it must follow the changes of the stop_time_updates
+    """
+    with app.app_context():
+        vj = create_trip_update('70866ce8-0638-4fa1-8556-1ddfa22d09d3', 'vj1', datetime.date(2015, 9, 8))
+        st1 = StopTimeUpdate({'id': 'sa:1'}, None, None, order=0)
+        st2 = StopTimeUpdate({'id': 'sa:2'}, None, None, order=1)
+        vj.stop_time_updates = [st1, st2]
+        assert vj.find_stop('sa:1', 0) == st1
+        assert vj.find_stop('sa:3', 2) is None
+
+        # lollipop: sa:1 is served twice
+        st3 = StopTimeUpdate({'id': 'sa:1'}, None, None, order=2)
+        vj.stop_time_updates.append(st3)
+        assert vj.find_stop('sa:1', 2) == st3
+        assert vj.find_stop('sa:1', 0) == st1
+        # without a matching order, the first stop_time_update on the stop is returned
+        assert vj.find_stop('sa:1', 42) == st1
+
+        st3.order = 3
+        assert vj.find_stop('sa:1', 3) == st3
+        assert vj.find_stop('sa:1', 2) == st1
+
+        vj.stop_time_updates.remove(st1)
+        assert vj.find_stop('sa:1', 0) == st3
+
+        vj.stop_time_updates = [st2]
+        assert vj.find_stop('sa:1') is None
+        assert vj.find_stop('sa:2') == st2
+
+        del vj.stop_time_updates[:]
+        assert vj.find_stop('sa:2') is None
+
+
+def test_stop_times_by_stop_area_code():
+    """
+    the stop_times of a vj are indexed by the codes of their stop_area, duplicates and missing stops included
+    """
+    def stop_time(stop_id, codes):
+        return {'arrival_time': datetime.time(8, 0),
+                'stop_point': {'id': stop_id,
+                               'stop_area': {'timezone': 'UTC',
+                                             'codes': [{'type': t, 'value': v} for t, v in codes]}}}
+
+    stop_times = [stop_time('sp:1', [('CR-CI-CH', '0087-1-BV'), ('CR-CI-CH', '0087-1-BV'), ('UIC8', '871')]),
+                  stop_time('sp:2', [('CR-CI-CH', '0087-2-BV'), ('CR-CI-CH', '0087-2-00')]),
+                  stop_time('sp:3', []),
+                  stop_time('sp:4', [('CR-CI-CH', '0087-1-BV')])]
+    stop_times[2]['stop_point'].pop('stop_area')
+    vj = VehicleJourney({'trip': {'id': 'vj1'}, 'stop_times': stop_times}, datetime.date(2015, 9, 8))
+
+    index = vj.get_stop_times_by_stop_area_code('CR-CI-CH')
+    assert sorted(index) == ['0087-1-BV', '0087-2-00', '0087-2-BV']
+    assert [st['stop_point']['id'] for st in index['0087-1-BV']] == ['sp:1', 'sp:4']
+    assert [st['stop_point']['id'] for st in index['0087-2-00']] == ['sp:2']
+    assert vj.get_stop_times_by_stop_area_code('CR-CI-CH') is index
+    assert vj.get_stop_times_by_stop_area_code('UIC8') == {'871': [stop_times[0]]}
+
+
 def test_find_activate():
     with app.app_context():
         create_real_time_update('70866ce8-0638-4fa1-8556-1ddfa22d09d3', 'C1', 'ire',
@@ -31,7 +31,7 @@
 from datetime import timedelta
 
 from kirin.core.model import RealTimeUpdate, TripUpdate, VehicleJourney, StopTimeUpdate
-from kirin.core.populate_pb import convert_to_gtfsrt, to_posix_time
+from kirin.core.populate_pb import convert_to_gtfsrt, to_posix_time, serialize_entity, serialize_feed
 import datetime
 from kirin import app, db
 from kirin import gtfs_realtime_pb2, kirin_pb2, chaos_pb2
@@ -344,3 +344,37 @@ def test_populate_pb_with_full_dataset():
         assert pb_trip_update.trip.Extensions[kirin_pb2.contributor] == 'kisio-digital'
 
         assert len(feed_entity.entity[0].trip_update.stop_time_update) == 0
+
+
+def test_serialize_feed_with_serialized_entities():
+    """
+    a feed built from the serialized entities is the same as the feed built from the trip updates
+    (the entities can be serialized before the flush of the trip updates)
+    """
+    with app.app_context():
+        real_time_update = RealTimeUpdate(raw_data=None, connector='ire', contributor='realtime.ire')
+        for trip_id, status in [('vehicle_journey:1', 'update'), ('vehicle_journey:2', 'delete')]:
+            navitia_vj = {'trip': {'id': trip_id},
+                          'stop_times': [
+                              {'arrival_time': datetime.time(8, 10), 'stop_point': {'stop_area': {'timezone': 'UTC'}}}
+                          ]}
+            trip_update = TripUpdate(VehicleJourney(navitia_vj, datetime.date(2015, 9, 8)), status=status,
+                                     contributor='kisio-digital')
+            trip_update.stop_time_updates.append(StopTimeUpdate({'id': 'sa:1'}, departure=_dt("8:15"),
+                                                                departure_delay=timedelta(minutes=5),
+                                                                message='bob is late'))
+            real_time_update.trip_updates.append(trip_update)
+        entities = [serialize_entity(tu) for tu in real_time_update.trip_updates]
+
+        db.session.add(real_time_update)
+        db.session.commit()
+
+        expected_feed = convert_to_gtfsrt(real_time_update.trip_updates, gtfs_realtime_pb2.FeedHeader.FULL_DATASET)
+        header_feed = convert_to_gtfsrt([], gtfs_realtime_pb2.FeedHeader.FULL_DATASET)
+        header_feed.header.timestamp = expected_feed.header.timestamp
+
+        feed = gtfs_realtime_pb2.FeedMessage()
+        feed.ParseFromString(serialize_feed(header_feed, entities))
+        assert feed == expected_feed
+        assert len(feed.entity) == 2
+        assert feed.entity[0].id == real_time_update.trip_updates[0].vj_id
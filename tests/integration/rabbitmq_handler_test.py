@@ -0,0 +1,304 @@
+# coding=utf-8
+
+# Copyright (c) 2001-2015, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+import collections
+import datetime
+import logging
+import socket
+import sys
+
+from kombu import BrokerConnection, Exchange, Queue
+import pytest
+
+import kirin
+from kirin import app, db, gtfs_realtime_pb2, task_pb2
+from kirin.core import handler
+from kirin.exceptions import MessageNotPublished
+from kirin.core.model import RealTimeUpdate, TripUpdate, VehicleJourney
+from kirin.core.populate_pb import serialize_entity
+from kirin.rabbitmq_handler import iter_serialized_entities, iter_chunks, RTReloader, RabbitMQHandler, \
+    PublishConfirms, PublishNacked
+
+# kirin.rabbitmq_handler is also the name of the RabbitMQHandler of the app
+rabbitmq_handler = sys.modules['kirin.rabbitmq_handler']
+
+
+def _create_trip_updates(nb_trip_updates, contributor='realtime.ire'):
+    """
+    create the trip updates in db, only the even ones have their serialized entity stored
+    return the trip_id of the trip updates
+    """
+    trip_ids = []
+    real_time_update = RealTimeUpdate(raw_data=None, connector='ire', contributor=contributor)
+    for i in range(nb_trip_updates):
+        trip_id = 'vehicle_journey:{}:{}'.format(contributor, i)
+        navitia_vj = {'trip': {'id': trip_id},
+                      'stop_times': [
+                          {'arrival_time': datetime.time(8, 10), 'stop_point': {'stop_area': {'timezone': 'UTC'}}}
+                      ]}
+        trip_update = TripUpdate(VehicleJourney(navitia_vj, datetime.date(2015, 9, 8)), status='delete',
+                                 contributor=contributor)
+        if i % 2 == 0:
+            trip_update.pb_entity = serialize_entity(trip_update)
+        real_time_update.trip_updates.append(trip_update)
+        trip_ids.append(trip_id)
+    db.session.add(real_time_update)
+    db.session.commit()
+    return trip_ids
+
+
+def _parse_entities(serialized_entities):
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.ParseFromString(b''.join(serialized_entities))
+    return feed.entity
+
+
+def test_iter_chunks():
+    assert list(iter_chunks(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(iter_chunks(range(4), 2)) == [[0, 1], [2, 3]]
+    assert list(iter_chunks(range(5), 0)) == [[0, 1, 2, 3, 4]]
+    # at least one (empty) chunk, to publish an empty full feed
+    assert list(iter_chunks([], 2)) == [[]]
+    assert list(iter_chunks([], 0)) == [[]]
+
+
+def test_iter_serialized_entities():
+    """
+    the stored entities are streamed, the trip updates without stored entity are serialized
+    """
+    with app.app_context():
+        trip_ids = _create_trip_updates(5)
+        assert TripUpdate.query.filter(TripUpdate.pb_entity.is_(None)).count() == 2
+        _create_trip_updates(1, contributor='realtime.cots')
+
+        entities = _parse_entities(iter_serialized_entities(['realtime.ire'], None, None))
+        assert sorted(e.trip_update.trip.trip_id for e in entities) == trip_ids
+        for entity in entities:
+            assert entity.trip_update.trip.schedule_relationship == gtfs_realtime_pb2.TripDescriptor.CANCELED
+
+        # the stored entities are the same as the ones serialized from the trip updates
+        for trip_update in TripUpdate.query.filter(TripUpdate.contributor == 'realtime.ire'):
+            expected = _parse_entities([serialize_entity(trip_update)])[0]
+            assert [e for e in entities if e.id == trip_update.vj_id] == [expected]
+
+        assert list(iter_serialized_entities(['realtime.ire'], datetime.date(2015, 9, 9), None)) == []
+
+
+class _Message(object):
+    def __init__(self, payload):
+        self.payload = payload
+
+
+def test_rt_reloader_chunks(monkeypatch):
+    """
+    the full feed is published by chunks of chunk_size trip updates, the last one being partial
+    """
+    published = []
+    calls = []
+    monkeypatch.setattr(rabbitmq_handler, 'record_call', lambda status, **kwargs: calls.append(kwargs))
+    reloader = RTReloader(connection=None, rpc_queue=None, exchange=None, max_retries=1, chunk_size=2)
+    monkeypatch.setattr(reloader, '_publish', lambda feed_str, queue_name: published.append((feed_str, queue_name)))
+
+    task = task_pb2.Task()
+    task.action = task_pb2.LOAD_REALTIME
+    task.load_realtime.queue_name = 'kraken_queue'
+    task.load_realtime.contributors.append('realtime.ire')
+
+    with app.app_context():
+        trip_ids = _create_trip_updates(5)
+        reloader._on_request(_Message(task.SerializeToString()))
+
+    feeds = []
+    for feed_str, queue_name in published:
+        assert queue_name == 'kraken_queue'
+        feed = gtfs_realtime_pb2.FeedMessage()
+        feed.ParseFromString(feed_str)
+        assert feed.header.incrementality == gtfs_realtime_pb2.FeedHeader.FULL_DATASET
+        feeds.append(feed)
+    assert [len(f.entity) for f in feeds] == [2, 2, 1]
+    assert sorted(e.trip_update.trip.trip_id for f in feeds for e in f.entity) == trip_ids
+
+    assert len(calls) == 1
+    assert calls[0]['message_count'] == 3
+    assert calls[0]['trip_update_count'] == 5
+    assert calls[0]['size'] == sum(len(feed_str) for feed_str, _ in published)
+
+
+def test_rt_reloader_without_chunks(monkeypatch):
+    """
+    without chunk_size, the full feed is published in one message, even if it is empty
+    """
+    published = []
+    monkeypatch.setattr(rabbitmq_handler, 'record_call', lambda status, **kwargs: None)
+    reloader = RTReloader(connection=None, rpc_queue=None, exchange=None, max_retries=1)
+    monkeypatch.setattr(reloader, '_publish', lambda feed_str, queue_name: published.append(feed_str))
+
+    task = task_pb2.Task()
+    task.action = task_pb2.LOAD_REALTIME
+    task.load_realtime.queue_name = 'kraken_queue'
+    task.load_realtime.contributors.append('realtime.cots')
+
+    with app.app_context():
+        _create_trip_updates(5)
+        reloader._on_request(_Message(task.SerializeToString()))
+
+    assert len(published) == 1
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.ParseFromString(published[0])
+    assert len(feed.entity) == 0
+
+
+def test_publish_with_pooled_producer():
+    """
+    the feeds are published with a pooled producer (checked with the in-memory transport of kombu)
+    """
+    rabbitmq = RabbitMQHandler('memory://', 'test_pooled_exchange')
+    exchange = Exchange('test_pooled_exchange', durable=True, type='topic')
+    with BrokerConnection('memory://') as connection:
+        queue = Queue('test_pooled_queue', exchange=exchange, routing_key='realtime.ire')(connection.default_channel)
+        queue.declare()
+
+        for i in range(3):
+            rabbitmq.publish('feed {}'.format(i), 'realtime.ire')
+        rabbitmq.publish('other feed', 'realtime.cots')
+
+        bodies = []
+        message = queue.get(no_ack=True)
+        while message is not None:
+            bodies.append(message.body)
+            message = queue.get(no_ack=True)
+    assert bodies == ['feed 0', 'feed 1', 'feed 2']
+    # the pooled connection is monitored by the heartbeat too
+    assert len(rabbitmq._connections) == 2
+
+
+class FakeBrokerConnection(object):
+    def __init__(self, channel):
+        self.channel = channel
+
+    def drain_events(self, timeout=None):
+        self.channel.drain_count += 1
+        if self.channel.silent:
+            raise socket.timeout()
+        self.channel.confirm_all()
+
+
+class FakeChannel(object):
+    """
+    a channel in confirm mode: the broker confirms all the published messages when the events are drained
+    (a nack for the delivery tags in nacked_tags)
+    """
+    def __init__(self, nacked_tags=(), silent=False):
+        self.events = collections.defaultdict(set)
+        self.connection = FakeBrokerConnection(self)
+        self.nacked_tags = set(nacked_tags)
+        self.silent = silent
+        self.in_confirm_mode = False
+        self.published = 0
+        self.confirmed = 0
+        self.drain_count = 0
+
+    def confirm_select(self):
+        self.in_confirm_mode = True
+
+    def publish(self, confirms):
+        self.published += 1
+        confirms.on_publish()
+
+    def confirm_all(self):
+        for delivery_tag in range(self.confirmed + 1, self.published + 1):
+            event = 'basic_nack' if delivery_tag in self.nacked_tags else 'basic_ack'
+            for callback in self.events[event]:
+                callback(delivery_tag, False)
+        self.confirmed = self.published
+
+
+def test_publish_confirms_by_batch():
+    """
+    the confirms of the broker are only waited for every batch_size messages
+    """
+    channel = FakeChannel()
+    confirms = PublishConfirms(channel, batch_size=3)
+    assert channel.in_confirm_mode
+
+    channel.publish(confirms)
+    channel.publish(confirms)
+    assert channel.drain_count == 0
+    channel.publish(confirms)
+    assert channel.drain_count == 1
+    assert confirms.last_acked == 3
+
+    channel.publish(confirms)
+    assert channel.drain_count == 1
+
+
+def test_publish_confirms_nack():
+    """
+    a nack of the broker raises a PublishNacked on the publication that waits for the batch
+    """
+    channel = FakeChannel(nacked_tags=[5])
+    confirms = PublishConfirms(channel, batch_size=3)
+
+    for _ in range(5):
+        channel.publish(confirms)
+    with pytest.raises(PublishNacked):
+        channel.publish(confirms)
+
+    # the nack is only reported once, the next batches are confirmed
+    for _ in range(3):
+        channel.publish(confirms)
+    assert confirms.last_acked == 9
+
+
+def test_publish_confirms_timeout():
+    channel = FakeChannel(silent=True)
+    confirms = PublishConfirms(channel, batch_size=1, timeout=0.01)
+    with pytest.raises(socket.timeout):
+        channel.publish(confirms)
+
+
+def test_publish_nacked_by_the_broker(monkeypatch, caplog):
+    """
+    a nack is logged and reported as a message not published
+    """
+    def publish(item, contributor):
+        raise PublishNacked('1 nack(s) received from the broker')
+    monkeypatch.setattr(kirin.rabbitmq_handler, 'publish', publish)
+
+    # the kirin loggers do not propagate to the root logger
+    logger = logging.getLogger(handler.__name__)
+    logger.addHandler(caplog.handler)
+    try:
+        with pytest.raises(MessageNotPublished):
+            handler.publish('feed', 'realtime.ire')
+    finally:
+        logger.removeHandler(caplog.handler)
+    assert 'impossible to publish in rabbitmq' in caplog.text
+    assert 'PublishNacked' in caplog.text
@@ -29,8 +29,20 @@
 # https://groups.google.com/d/forum/navitia
 # www.navitia.io
 
-from kirin.utils import str_to_date
+from kirin.utils import str_to_date, get_timezone, local_to_utc, bounded_memoize, navitia_concurrent_map, \
+    parse_iso_datetime, parse_dmy_datetime
+from kirin.exceptions import ObjectNotFound, SubServiceError
+from kirin import utils
+from kirin import app
+from tests.check_utils import get_fixture_data
+from dateutil import parser
 import datetime
+import gevent
+import os
+import pytest
+import pytz
+import re
+import threading
 
 
 def test_valid_date():
@@ -41,3 +53,141 @@ def test_valid_date():
 def test_invalid_date():
     res = str_to_date('aaaa')
     assert res == None
+
+
+def test_get_timezone():
+    stop_time = {'stop_point': {'stop_area': {'timezone': 'Europe/Paris'}}}
+    tz = get_timezone(stop_time)
+    assert tz.zone == 'Europe/Paris'
+    # the timezone object is cached
+    assert get_timezone(stop_time) is tz
+
+
+def test_local_to_utc():
+    paris = pytz.timezone('Europe/Paris')
+    for local_dt in [datetime.datetime(2018, 6, 1, 8, 15),
+                     # DST changes at 2:00 on 2018/03/25 and at 3:00 on 2018/10/28
+                     datetime.datetime(2018, 3, 25, 1, 30),
+                     datetime.datetime(2018, 3, 25, 2, 30),
+                     datetime.datetime(2018, 3, 25, 3, 30),
+                     datetime.datetime(2018, 10, 28, 2, 30),
+                     datetime.datetime(2018, 10, 28, 23, 59)]:
+        expected = paris.localize(local_dt).astimezone(pytz.utc).replace(tzinfo=None)
+        assert local_to_utc(local_dt, paris) == expected
+
+    assert local_to_utc(datetime.datetime(2018, 6, 1, 8, 15), pytz.utc) == datetime.datetime(2018, 6, 1, 8, 15)
+
+
+def test_bounded_memoize():
+    calls = []
+
+    @bounded_memoize(max_size=2)
+    def double(i):
+        calls.append(i)
+        return 2 * i
+
+    assert double(1) == 2
+    assert double(1) == 2
+    assert calls == [1]
+    assert double(2) == 4
+    assert double(3) == 6
+    assert len(double.cache) <= 2
+    assert double(3) == 6
+    assert calls == [1, 2, 3]
+
+
+class Navitia(object):
+    url = 'http://navitia/coverage/bob'
+
+
+def test_navitia_concurrent_map(monkeypatch):
+    """
+    with gevent's monkey patching, the calls are run in a pool of greenlets
+    """
+    monkeypatch.setattr(utils, '_use_greenlets', lambda: True)
+    running = []
+    max_running = []
+
+    def search(i):
+        running.append(i)
+        max_running.append(len(running))
+        gevent.sleep(0.01)
+        running.remove(i)
+        if i == 3:
+            raise ObjectNotFound('no train {}'.format(i))
+        return 2 * i
+
+    monkeypatch.setitem(app.config, 'NAVITIA_MAX_CONCURRENT_QUERIES', 2)
+    with app.app_context():
+        # the results are in the order of the items
+        assert navitia_concurrent_map(Navitia(), search, [5, 1, 2, 4]) == [10, 2, 4, 8]
+        assert max(max_running) == 2
+
+        with pytest.raises(ObjectNotFound):
+            navitia_concurrent_map(Navitia(), search, [1, 2, 3, 4])
+
+
+def test_navitia_concurrent_map_with_threads(monkeypatch):
+    """
+    without gevent's monkey patching, the calls are run in a pool of threads
+    """
+    monkeypatch.setattr(utils, '_use_greenlets', lambda: False)
+    lock = threading.Lock()
+    running = []
+    max_running = []
+    both_running = threading.Event()
+    release = threading.Event()
+
+    def search(i):
+        with lock:
+            running.append(i)
+            max_running.append(len(running))
+            if len(running) == 2:
+                both_running.set()
+        # the first call only ends when a second one is running concurrently
+        both_running.wait(5)
+        if i == 7:
+            # a blocking call, that cannot be interrupted
+            release.wait(5)
+        with lock:
+            running.remove(i)
+        if i == 3:
+            raise ObjectNotFound('no train {}'.format(i))
+        return 2 * i
+
+    monkeypatch.setitem(app.config, 'NAVITIA_MAX_CONCURRENT_QUERIES', 2)
+    monkeypatch.setitem(app.config, 'NAVITIA_CONCURRENT_QUERY_TIMEOUT', 0.1)
+    with app.app_context():
+        assert navitia_concurrent_map(Navitia(), search, [5, 1, 2, 4]) == [10, 2, 4, 8]
+        assert both_running.is_set()
+        assert max(max_running) == 2
+
+        with pytest.raises(ObjectNotFound):
+            navitia_concurrent_map(Navitia(), search, [1, 2, 3, 4])
+
+        # the blocking call is not waited for after the timeout
+        try:
+            with pytest.raises(SubServiceError):
+                navitia_concurrent_map(Navitia(), search, [1, 7])
+        finally:
+            release.set()
+
+
+def test_datetime_parsers_on_fixtures():
+    """
+    the format-specific parsers must give the same datetimes as dateutil on the COTS and IRE fixtures
+    """
+    fixtures = os.listdir(os.path.join(os.path.dirname(__file__), '..', 'fixtures'))
+    cots = [re.findall(r'"dateHeure"\s*:\s*"([^"]*)"', get_fixture_data(f)) for f in fixtures if f.startswith('cots_')]
+    ire = [re.findall(r'<DateHeure\w*>([^<]*)<', get_fixture_data(f)) for f in fixtures if f.startswith('train_')]
+    assert all(cots) and all(ire)
+
+    for messages, parse, parse_dateutil in [
+            (cots, parse_iso_datetime, lambda d: parser.parse(d, dayfirst=False, yearfirst=True, ignoretz=False)),
+            (ire, parse_dmy_datetime, lambda d: parser.parse(d, dayfirst=True, yearfirst=False))]:
+        expected = [[parse_dateutil(d) for d in dates] for dates in messages]
+        res = [[parse(d) for d in dates] for dates in messages]
+
+        assert res == expected
+        for dates, expected_dates in zip(res, expected):
+            assert [d.utcoffset() for d in dates] == [d.utcoffset() for d in expected_dates]
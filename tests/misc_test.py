@@ -30,7 +30,8 @@
 # www.navitia.io
 
 import xml.etree.cElementTree as ElementTree
-from kirin.ire.model_maker import get_node, get_value
+from kirin.ire.model_maker import get_node, get_value, KirinModelBuilder
+from tests.check_utils import get_fixture_data
 
 
 def test_get_nodes():
@@ -43,3 +44,46 @@ def test_get_nodes():
 
     assert get_node(xml, 'bob').tag == 'bob'
     assert get_value(xml, 'bob/bobette') == '42'
+
+
+def test_ire_parse_keeps_only_stations():
+    """
+    the IRE is parsed in one pass, keeping only the stations with the content needed by the builder
+    """
+    # the first of the 5 PointAval of the fixture is not a station anymore
+    ire = get_fixture_data('train_96231_delayed.xml').replace('<IndicateurPRGare>true', '<IndicateurPRGare>false', 1)
+    ire_message = KirinModelBuilder.parse(ire)
+
+    assert get_value(ire_message.root, 'Train/NumeroTrain') == '096231'
+    assert len(ire_message.downstream_points) == 4
+    assert ire_message.deleted_points == []
+    for point in ire_message.downstream_points:
+        assert get_value(point, 'IndicateurPRGare') == 'true'
+        assert get_value(point, 'CRPR') and get_value(point, 'CIPR') and get_value(point, 'CHPR')
+        assert point.find('LibellePR') is None
+    assert get_value(ire_message.downstream_points[0], 'TypeHoraire/Depart/EcartExterne') == '00:15'
+
+    # the other point is emptied, but is still in the delay
+    points = get_node(ire_message.root, 'TypeModification/HoraireProjete').findall('PointAval')
+    assert [len(p) > 0 for p in points] == [False, True, True, True, True]
+
+    ire_message = KirinModelBuilder.parse(get_fixture_data('train_840427_partial_removal.xml'))
+    assert ire_message.downstream_points == []
+    assert [get_value(p, 'CIPR') for p in ire_message.deleted_points] == ['118299', '118257']
+
+
+def test_ire_parse_keeps_only_the_points_of_the_modification():
+    """
+    like in the builder, only the PointAval of the HoraireProjete and the PointSupprime of the Suppression
+    (under the TypeModification) are gathered, the points elsewhere in the IRE are ignored
+    """
+    ire = get_fixture_data('train_96231_delayed.xml')
+    first_point = ire[ire.index('<PointAval>'):ire.index('</PointAval>') + len('</PointAval>')]
+    removed_point = first_point.replace('PointAval', 'PointSupprime')
+    ire = ire.replace('<TypeModification>',
+                      '<Autre>{}{}</Autre><TypeModification>'.format(first_point, removed_point), 1)
+    ire_message = KirinModelBuilder.parse(ire)
+
+    assert len(ire_message.downstream_points) == 5
+    assert ire_message.deleted_points == []
+    assert len(get_node(ire_message.root, 'Autre/PointAval')) == 0
@@ -39,6 +39,7 @@ import vj_870154
 import vj_840426
 import vj_R_vj1
 import vj_R_vj2
+import vj_R_vj1_vj2
 import vj_pass_midnight
 import vj_lollipop
 import vj_bad_order
@@ -55,6 +56,7 @@ mocks = [
     vj_840426.response,
     vj_R_vj1.response,
     vj_R_vj2.response,
+    vj_R_vj1_vj2.response,
     vj_pass_midnight.response,
     vj_lollipop.response,
     vj_bad_order.response,
@@ -0,0 +1,51 @@
+# coding=utf-8
+
+#  Copyright (c) 2001-2018, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of Navitia,
+#     the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+import json
+import navitia_response
+import vj_R_vj1
+import vj_R_vj2
+
+response = navitia_response.NavitiaResponse()
+
+response.query = 'vehicle_journeys/?count=4&since=20120615T120000Z' \
+                 '&filter=vehicle_journey.has_code(source, Code-R-vj1) or vehicle_journey.has_code(source, Code-R-vj2)' \
+                 '&depth=2&show_codes=true&until=20120615T190000Z'
+
+response.response_code = 200
+
+# the vjs of Code-R-vj1 and Code-R-vj2, with their codes
+_vjs = []
+for _r, _code in ((vj_R_vj1.response, 'Code-R-vj1'), (vj_R_vj2.response, 'Code-R-vj2')):
+    for _vj in json.loads(_r.json_response)['vehicle_journeys']:
+        _vj['codes'] = [{'type': 'source', 'value': _code}]
+        _vjs.append(_vj)
+
+response.json_response = json.dumps({'vehicle_journeys': _vjs})